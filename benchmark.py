@@ -0,0 +1,194 @@
+import argparse
+import glob
+import json
+import os.path
+import platform
+import subprocess
+import time
+
+import cv2 as cv
+import cv2.aruco as aruco
+import numpy as np
+
+from drawing_util import draw_axis
+from metrics_util import summarize
+from cli_tracker import UNDISTORT_MODES
+from tracking_util import load_cal_data, load_layout, find_markers, filter_markers, solve_pose, load_distortion, \
+    undistort_points, load_detector_params
+
+STAGES = ["imread", "remap", "cvtColor", "find_markers", "filter", "undistortPoints", "solvePnP", "draw"]
+
+
+def git_revision():
+    """
+    Gets the git revision of the repo, so results from different revisions can be told apart
+    :return: The short commit hash (with -dirty appended if there are uncommitted changes) or None if not in a git repo
+    """
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=repo, text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ("-dirty" if dirty.strip() else "")
+
+
+def benchmark_image(path, cal_path, marker_layout, marker_pos, scale, times, undistort="color"):
+    """
+    Runs the same steps as the cli tracker on one image, timing each stage separately
+    :param path: The path of the image
+    :param cal_path: The path to the npz camera calibration data
+    :param marker_layout: The marker layout returned by load_layout
+    :param marker_pos: The marker positions returned by load_layout
+    :param scale: The scale to initially search for the markers at (see find_markers)
+    :param times: A dictionary of stage name to a list of times to append to
+    :param undistort: How to undistort the image, one of cli_tracker.UNDISTORT_MODES (the markers are only drawn in
+    the color mode, since the other modes don't make an undistorted color image)
+    :return: True if a pose was found
+    """
+    start = time.perf_counter()
+    image = cv.imread(path, cv.IMREAD_COLOR)
+    times["imread"].append(time.perf_counter() - start)
+    if image is None:
+        return False
+
+    dist_coefficients, camera_mtx, roi, mapx, mapy = load_cal_data(cal_path, image.shape[1::-1])
+    if undistort == "color":
+        start = time.perf_counter()
+        image = cv.remap(image, mapx, mapy, cv.INTER_LINEAR)
+        times["remap"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    times["cvtColor"].append(time.perf_counter() - start)
+
+    if undistort == "gray":
+        start = time.perf_counter()
+        gray = cv.remap(gray, mapx, mapy, cv.INTER_LINEAR)
+        times["remap"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    bounding_boxes, ids = find_markers(gray, scale)
+    times["find_markers"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    bounding_boxes, ids, world_points, image_points = filter_markers(bounding_boxes, ids, marker_layout)
+    times["filter"].append(time.perf_counter() - start)
+    if ids is None:
+        return False
+
+    if undistort == "points":
+        start = time.perf_counter()
+        image_points = undistort_points(image_points, camera_mtx, load_distortion(cal_path))
+        times["undistortPoints"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    r_vec, t_vec = solve_pose(world_points, image_points, camera_mtx)
+    times["solvePnP"].append(time.perf_counter() - start)
+    if undistort != "color":
+        return True
+
+    start = time.perf_counter()
+    aruco.drawDetectedMarkers(image, bounding_boxes, ids)
+    rot_m, _ = cv.Rodrigues(r_vec)
+    for marker_id in ids:
+        draw_axis(image, r_vec, t_vec + rot_m @ marker_pos[marker_id]["pos"], camera_mtx,
+                  marker_pos[marker_id]["scale"], 2)
+    times["draw"].append(time.perf_counter() - start)
+    return True
+
+
+def print_report(report, baseline=None):
+    """
+    Prints the stage latencies, optionally next to the results of an earlier run
+    :param report: The report dictionary written to the json file
+    :param baseline: An optional report from an earlier run to compare with
+    """
+    print(f"{'stage':<14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}" + (f"{'p50 change':>12}" if baseline else ""))
+    for name, stats in list(report["stages"].items()) + [("total", report["total"])]:
+        if stats["count"] == 0:
+            continue
+        line = f"{name:<14}{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['p99']:>10.2f}"
+        if baseline:
+            old = baseline["total"] if name == "total" else baseline["stages"].get(name)
+            if old and old.get("count"):
+                line += f"{100 * (stats['p50'] / old['p50'] - 1):>+11.1f}%"
+        print(line)
+    print(f"throughput: {report['throughput']:.2f} images/s, "
+          f"poses found: {report['poses_found']}/{report['frames']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--src", type=str, help='The source folder containing the images and calibration data to '
+                                                      'use', required=True)
+    parser.add_argument("--cal", type=str, help="The path to the npz camera calibration data")
+    parser.add_argument("--layout", type=str, help='The marker layout json file')
+    parser.add_argument("--detection-scale", type=float, default=1,
+                        help="The scale to initially search for the markers at (1 searches the full resolution image)")
+    parser.add_argument("--undistort", choices=UNDISTORT_MODES, default="color",
+                        help="How to undistort the images (see cli_tracker.py)")
+    parser.add_argument("--detector-params", type=str,
+                        help="A json file of detector parameters from tune_detector.py to find the markers with")
+    parser.add_argument("--repeat", type=int, default=3, help="The number of times to run over the images")
+    parser.add_argument("--warmup", type=int, default=1, help="The number of images to run before timing")
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json", help="The json file to write results to")
+    parser.add_argument("--compare", type=str, help="A json file from an earlier run to compare the results with")
+
+    args = parser.parse_args()
+    if args.detector_params:
+        load_detector_params(args.detector_params)
+
+    paths = glob.glob(os.path.join(args.src, "*.jpg"))
+    paths += glob.glob(os.path.join(args.src, "*.png"))
+    paths.sort()
+
+    layout_path = args.layout if args.layout else os.path.join(args.src, 'marker_layout.json')
+    cal_path = args.cal if args.cal else os.path.join(args.src, 'camera_cal.npz')
+    marker_layout, marker_pos = load_layout(layout_path)
+
+    # Warm up the caches (calibration maps, OpenCV's thread pool, the OS file cache) so they aren't counted
+    warmup_times = {name: [] for name in STAGES}
+    for path in paths[:args.warmup]:
+        benchmark_image(path, cal_path, marker_layout, marker_pos, args.detection_scale, warmup_times, args.undistort)
+
+    times = {name: [] for name in STAGES}
+    totals = []
+    poses_found = 0
+    run_start = time.perf_counter()
+    for _ in range(args.repeat):
+        for path in paths:
+            start = time.perf_counter()
+            poses_found += benchmark_image(path, cal_path, marker_layout, marker_pos, args.detection_scale, times,
+                                           args.undistort)
+            totals.append(time.perf_counter() - start)
+    run_time = time.perf_counter() - run_start
+
+    report = {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "opencv": cv.__version__,
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "src": os.path.abspath(args.src),
+        "detection_scale": args.detection_scale,
+        "undistort": args.undistort,
+        "detector_params": args.detector_params,
+        "images": len(paths),
+        "frames": len(totals),
+        "poses_found": poses_found,
+        "throughput": len(totals) / run_time if run_time > 0 else 0.0,
+        # The stage times are summarized in milliseconds
+        "stages": {name: summarize(np.array(stage_times) * 1000) for name, stage_times in times.items()},
+        "total": summarize(np.array(totals) * 1000),
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,156 @@
+import collections
+import hashlib
+import os.path
+import threading
+
+import cv2.aruco as aruco
+import numpy as np
+
+from file_util import atomic_write
+
+# Bump this if the detection changes so old cache entries aren't used
+CACHE_VERSION = 1
+
+
+def detector_key(dictionary, parameters):
+    """
+    Makes a key for a detector configuration, so results from different dictionaries or parameters are kept apart
+    :param dictionary: The aruco dictionary
+    :param parameters: The aruco DetectorParameters
+    :return: The key as a hex string
+    """
+    sha = hashlib.sha1(f"{CACHE_VERSION} {dictionary.markerSize} {dictionary.maxCorrectionBits}".encode())
+    sha.update(np.ascontiguousarray(dictionary.bytesList).tobytes())
+    # detectMarkers overwrites minSideLengthCanonicalImg when it runs, but it only affects the Aruco3 detection
+    ignored = set() if getattr(parameters, "useAruco3Detection", False) else {"minSideLengthCanonicalImg"}
+    for name in sorted(dir(parameters)):
+        value = getattr(parameters, name)
+        if not name.startswith("_") and name not in ignored and not callable(value):
+            sha.update(f"{name}={value!r};".encode())
+    return sha.hexdigest()
+
+
+class DetectionCache:
+    """
+    Caches marker detection results by image content and detector settings, so running the same frames through the
+    detector again (e.g. the test suite or reprocessing a folder of images) only detects each image once. Results are
+    kept in memory and, if a folder is given, on disk so they are shared between runs and processes. The key is the
+    exact image detected on, so results are only shared between callers that prepare the image the same way (the
+    image tests detect on the raw image, cli_tracker on the undistorted one).
+    """
+
+    def __init__(self, path=None, max_entries=1024):
+        """
+        :param path: The folder to store the results in (None to only keep them in memory)
+        :param max_entries: The maximum number of results to keep in memory, the least recently used are dropped
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __getstate__(self):
+        # Only the settings are sent to worker processes, they build up their own memory cache
+        return {"path": self.path, "max_entries": self.max_entries}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, image, dictionary, parameters, *extra):
+        """
+        Makes the cache key for detecting markers on an image
+        :param image: The image the markers will be detected on
+        :param dictionary: The aruco dictionary
+        :param parameters: The aruco DetectorParameters
+        :param extra: Any other settings that change the result (e.g. the detection scale)
+        :return: The key as a hex string
+        """
+        sha = hashlib.sha1(f"{detector_key(dictionary, parameters)} {image.shape} {image.dtype} {extra}".encode())
+        sha.update(np.ascontiguousarray(image).data)
+        return sha.hexdigest()
+
+    def get(self, key):
+        """
+        Gets a cached detection result
+        :param key: The key from DetectionCache.key
+        :return: The same (bounding boxes, ids, rejected) tuple as aruco.detectMarkers, or None if it isn't cached. The
+        arrays are shared between callers and must not be modified.
+        """
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+        if self.path is not None:
+            result = self._load(key)
+            if result is not None:
+                self._remember(key, result)
+        # The counts are updated under the lock, since the cache is shared between loader and tracking threads
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """
+        Adds a detection result to the cache
+        :param key: The key from DetectionCache.key
+        :param result: The (bounding boxes, ids, rejected) tuple from aruco.detectMarkers
+        :return: The result as it will be returned by get
+        """
+        boxes, ids, rejected = result
+        # Store copies in the same form aruco returns, so cached and fresh results can't be told apart
+        result = (tuple(np.array(box, dtype=np.float32) for box in boxes),
+                  None if ids is None else np.array(ids, dtype=np.int32).reshape(-1, 1),
+                  tuple(np.array(box, dtype=np.float32) for box in rejected))
+        self._remember(key, result)
+        if self.path is not None:
+            self._save(key, result)
+        return result
+
+    def detect(self, image, dictionary, parameters):
+        """
+        Runs aruco.detectMarkers on an image, using the cached result if the image has been seen before
+        :param image: A greyscale image
+        :param dictionary: The aruco dictionary
+        :param parameters: The aruco DetectorParameters
+        :return: The same (bounding boxes, ids, rejected) tuple as aruco.detectMarkers
+        """
+        key = self.key(image, dictionary, parameters)
+        result = self.get(key)
+        if result is None:
+            result = self.put(key, aruco.detectMarkers(image, dictionary, parameters=parameters))
+        return result
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _load(self, key):
+        path = os.path.join(self.path, key + ".npz")
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            ids = data["ids"]
+            return (tuple(data["boxes"]), ids if ids.size else None, tuple(data["rejected"]))
+
+    def _save(self, key, result):
+        boxes, ids, rejected = result
+        path = os.path.join(self.path, key + ".npz")
+        with atomic_write(path) as f:
+            np.savez(f, boxes=np.array(boxes, dtype=np.float32).reshape(-1, 1, 4, 2),
+                     ids=np.zeros((0, 1), dtype=np.int32) if ids is None else ids,
+                     rejected=np.array(rejected, dtype=np.float32).reshape(-1, 1, 4, 2))
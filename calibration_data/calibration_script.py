@@ -3,66 +3,304 @@ import numpy as np
 import glob
 from pprint import pprint
 import argparse
+import functools
+import hashlib
+import multiprocessing
 import os.path
+import sys
+import time
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--show", help="displays the image before exiting", action="store_true")
-parser.add_argument("-s", "--src", help="the folder to load images from", required=True, type=str)
-parser.add_argument("--dst", help="the folder to save the calibration data to", default="./")
-
-args = parser.parse_args()
+# The script is run from this folder, so the shared modules are imported from the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from file_util import atomic_write
 
 CHECKERBOARD = (7, 9)
 criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+chessboard_flags = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_FAST_CHECK + cv2.CALIB_CB_NORMALIZE_IMAGE
 
-image_names = glob.glob(os.path.join(args.src, "*.jpg"))
-image_names += glob.glob(os.path.join(args.src, "*.png"))
+# Bump this if the corner detection changes so old cache entries aren't used
+CACHE_VERSION = 1
 
-objp = np.zeros((1, CHECKERBOARD[0] * CHECKERBOARD[1], 3), np.float32)
-objp[0, :, :2] = np.mgrid[0:CHECKERBOARD[0], 0:CHECKERBOARD[1]].T.reshape(-1, 2)
 
-# Arrays to store object points and image points from all the images.
-objpoints = []  # 3d point in real world space
-imgpoints = []  # 2d points in image plane.
-gray = None
-for fname in image_names:
+def find_corners(fname, downscale=1):
+    """
+    Finds the chess board corners in an image
+    :param fname: The path of the image
+    :param downscale: If less than 1 the board is searched for on a copy of the image downscaled by this factor, which
+    is much faster on high resolution images and quickly rejects images without a board. The corners are then refined
+    on the full resolution image.
+    :return: A tuple containing a boolean that is true if the board was found, the refined corners (None if not found)
+    and the image size as (width, height) (None if the image couldn't be loaded)
+    """
     img = cv2.imread(fname)
+    if img is None:
+        return False, None, None
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    # Find the chess board corners
-    ret, corners = cv2.findChessboardCorners(gray, CHECKERBOARD,
-                                             cv2.CALIB_CB_ADAPTIVE_THRESH +
-                                             cv2.CALIB_CB_FAST_CHECK +
-                                             cv2.CALIB_CB_NORMALIZE_IMAGE)
-    # If found, add object points, image points (after refining them)
-    if ret is True:
-        objpoints.append(objp)
+    win_size = 11
+    if downscale < 1:
+        small = cv2.resize(gray, None, fx=downscale, fy=downscale, interpolation=cv2.INTER_AREA)
+        ret, corners = cv2.findChessboardCorners(small, CHECKERBOARD, chessboard_flags)
+        if ret:
+            # Scale the corners back up (pixel centers are at +0.5) and make sure the refinement window covers the
+            # error from the downscaling
+            corners = (corners + 0.5) / downscale - 0.5
+            win_size = max(win_size, int(np.ceil(2 / downscale)))
+    else:
+        # Find the chess board corners
+        ret, corners = cv2.findChessboardCorners(gray, CHECKERBOARD, chessboard_flags)
+    # If found, refine the corners
+    if ret:
         # Iteratively improves the accuracy of the corner detection
-        corners2 = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
-        imgpoints.append(corners)
-        # Draw and display the corners
-        cv2.drawChessboardCorners(img, (7, 6), corners2, ret)
-        if args.show:
-            cv2.imshow('img', img)
-            cv2.waitKey(0)
-
-if gray is not None:
-    # Calculate Parameters
-    result, camera_matrix, distortion_coefficients, rvecs, tvecs = \
-        cv2.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
-    h, w = gray.shape[:2]
-
-    mean_error = 0
-    for i in range(len(objpoints)):
-        imgpoints2, _ = cv2.projectPoints(objpoints[i], rvecs[i], tvecs[i], camera_matrix, distortion_coefficients)
-        error = cv2.norm(imgpoints[i], imgpoints2, cv2.NORM_L2) / len(imgpoints2)
-        mean_error += error
-    print(f"total error: {mean_error / len(objpoints)}")
-
-    # todo: combine into one file
-    np.savez(os.path.join(args.dst, 'camera_cal.npz'), k=camera_matrix, d=distortion_coefficients)
-
-    print("Camera Matrix:")
-    pprint(camera_matrix)
-    print("Distortion Coefficients:")
-    pprint(distortion_coefficients)
-cv2.destroyAllWindows()
+        corners = cv2.cornerSubPix(gray, corners, (win_size, win_size), (-1, -1), criteria)
+    else:
+        corners = None
+    return ret, corners, gray.shape[::-1]
+
+
+def cache_key(fname, downscale=1):
+    """
+    Makes the corner cache key for an image from its contents and the detection settings
+    :param fname: The path of the image
+    :param downscale: The downscale factor passed to find_corners
+    :return: The key as a hex string
+    """
+    sha = hashlib.sha1(f"{CACHE_VERSION} {CHECKERBOARD} {chessboard_flags} {criteria} {downscale}".encode())
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_cached_corners(cache_dir, key):
+    """
+    Loads the corners found in an earlier run
+    :param cache_dir: The cache folder
+    :param key: The image's cache key
+    :return: The same tuple as find_corners, or None if the image isn't in the cache
+    """
+    path = os.path.join(cache_dir, key + ".npz")
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as data:
+        found = bool(data["found"])
+        return found, data["corners"] if found else None, tuple(int(x) for x in data["size"])
+
+
+def save_cached_corners(cache_dir, key, result):
+    """
+    Saves the corners found in an image to the cache
+    :param cache_dir: The cache folder
+    :param key: The image's cache key
+    :param result: The tuple returned by find_corners
+    """
+    found, corners, size = result
+    if size is None:
+        # Don't cache images that couldn't be read, they might be fixed or still being copied
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    # Workers and overlapping runs save entries at the same time, so they are written in full before they can be loaded
+    with atomic_write(os.path.join(cache_dir, key + ".npz"), "wb") as f:
+        np.savez(f, found=found, size=size, corners=corners if found else np.zeros((0, 1, 2), dtype=np.float32))
+
+
+def detect_all(image_names, downscale=1, workers=1, cache_dir=None):
+    """
+    Finds the chess board corners in a list of images, using the cache for images that have been searched before
+    :param image_names: The paths of the images
+    :param downscale: The downscale factor passed to find_corners
+    :param workers: The number of processes to search the images with
+    :param cache_dir: The cache folder (None to search every image)
+    :return: A list of the tuples returned by find_corners, in the same order as the images
+    """
+    # Only the images that are new or have changed since the last run need to be searched
+    keys = [cache_key(fname, downscale) for fname in image_names]
+    results = [None if cache_dir is None else load_cached_corners(cache_dir, key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    print(f"{len(image_names) - len(missing)} images cached, finding corners in {len(missing)}")
+
+    find = functools.partial(find_corners, downscale=downscale)
+    if workers > 1 and len(missing) > 1:
+        with multiprocessing.Pool(min(workers, len(missing))) as pool:
+            found = pool.map(find, [image_names[i] for i in missing])
+    else:
+        found = [find(image_names[i]) for i in missing]
+    for i, result in zip(missing, found):
+        results[i] = result
+        if cache_dir is not None:
+            save_cached_corners(cache_dir, keys[i], result)
+    return results
+
+
+def view_errors(objpoints, imgpoints, rvecs, tvecs, camera_matrix, distortion_coefficients):
+    """
+    Calculates the reprojection error of each view. The board corners of every view are transformed into camera
+    coordinates at once and projected with a single projectPoints call.
+    :param objpoints: The list of board corner coordinates for each view
+    :param imgpoints: The list of image corner coordinates for each view
+    :param rvecs: The rotation vector of each view
+    :param tvecs: The translation vector of each view
+    :param camera_matrix: The camera matrix
+    :param distortion_coefficients: The distortion coefficients
+    :return: The RMS reprojection error of each view in pixels and the mean of the per view errors in the same form as
+    the original total error (the L2 norm of the residuals divided by the number of corners)
+    """
+    counts = np.array([np.size(points) // 3 for points in objpoints])
+    world = np.concatenate([np.reshape(points, (-1, 3)) for points in objpoints]).astype(np.float64)
+    image = np.concatenate([np.reshape(points, (-1, 2)) for points in imgpoints]).astype(np.float64)
+    view = np.repeat(np.arange(len(counts)), counts)
+
+    # Rodrigues formula for every view at once
+    rvecs = np.reshape(rvecs, (-1, 3))
+    theta = np.linalg.norm(rvecs, axis=1)
+    k = rvecs / np.where(theta > 0, theta, 1)[:, None]
+    k_x = np.zeros((len(k), 3, 3))
+    k_x[:, 0, 1], k_x[:, 0, 2], k_x[:, 1, 2] = -k[:, 2], k[:, 1], -k[:, 0]
+    k_x -= k_x.transpose(0, 2, 1)
+    rot_m = np.eye(3) + np.sin(theta)[:, None, None] * k_x + (1 - np.cos(theta))[:, None, None] * (k_x @ k_x)
+
+    camera_points = np.einsum("nij,nj->ni", rot_m[view], world) + np.reshape(tvecs, (-1, 3))[view]
+    projected, _ = cv2.projectPoints(camera_points, np.zeros(3), np.zeros(3), camera_matrix, distortion_coefficients)
+    squared = np.sum((projected.reshape(-1, 2) - image) ** 2, axis=1)
+
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sums = np.add.reduceat(squared, starts)
+    return np.sqrt(sums / counts), float(np.mean(np.sqrt(sums) / counts))
+
+
+def calibrate(objpoints, imgpoints, image_size, camera_matrix=None, distortion_coefficients=None,
+              max_view_error=None, min_views=3):
+    """
+    Calibrates the camera from the chess board corners, optionally removing the worst views one at a time until every
+    view's reprojection error is under a threshold
+    :param objpoints: The list of board corner coordinates for each view
+    :param imgpoints: The list of image corner coordinates for each view
+    :param image_size: The image size as (width, height)
+    :param camera_matrix: An existing camera matrix to start from (None for a full solve)
+    :param distortion_coefficients: The distortion coefficients to start from (only used with camera_matrix)
+    :param max_view_error: The largest RMS reprojection error in pixels a view can have (None to keep every view)
+    :param min_views: The number of views to stop removing views at
+    :return: The camera matrix, distortion coefficients, rotation and translation vectors of each kept view, the RMS
+    error of each kept view, the mean reprojection error and the indices of the kept views
+    """
+    kept = np.arange(len(objpoints))
+    flags = 0
+    if camera_matrix is not None:
+        camera_matrix = np.array(camera_matrix, dtype=np.float64)
+        if distortion_coefficients is not None:
+            distortion_coefficients = np.array(distortion_coefficients, dtype=np.float64)
+        flags = cv2.CALIB_USE_INTRINSIC_GUESS
+
+    while True:
+        # Calculate Parameters
+        result, camera_matrix, distortion_coefficients, rvecs, tvecs = cv2.calibrateCamera(
+            [objpoints[i] for i in kept], [imgpoints[i] for i in kept], image_size, camera_matrix,
+            distortion_coefficients, flags=flags)
+        errors, mean_error = view_errors([objpoints[i] for i in kept], [imgpoints[i] for i in kept], rvecs, tvecs,
+                                         camera_matrix, distortion_coefficients)
+
+        worst = int(np.argmax(errors))
+        if max_view_error is None or errors[worst] <= max_view_error or len(kept) <= min_views:
+            return camera_matrix, distortion_coefficients, rvecs, tvecs, errors, mean_error, kept
+        # Drop the worst view and start the next solve from the current one, which converges much faster
+        kept = np.delete(kept, worst)
+        flags = cv2.CALIB_USE_INTRINSIC_GUESS
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--show", help="displays the image before exiting", action="store_true")
+    parser.add_argument("-s", "--src", help="the folder to load images from", required=True, type=str)
+    parser.add_argument("--dst", help="the folder to save the calibration data to", default="./")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="the number of processes to find the corners with (0 uses every core)")
+    parser.add_argument("--cache", type=str,
+                        help="the folder to cache the corners found in each image in (defaults to SRC/.corner_cache)")
+    parser.add_argument("--no-cache", help="find the corners in every image again", action="store_true")
+    parser.add_argument("--downscale", type=float, default=1,
+                        help="search for the board on the images downscaled by this factor, then refine the corners "
+                             "at full resolution (1 searches the full resolution images)")
+    parser.add_argument("--compare", action="store_true",
+                        help="time the full resolution and downscaled searches (without the cache) and print the "
+                             "calibration error of each")
+    parser.add_argument("--initial", type=str,
+                        help="an existing camera_cal.npz to start from instead of solving from scratch, which is much "
+                             "faster when only a few views have been added")
+    parser.add_argument("--max-view-error", type=float,
+                        help="remove the worst views one at a time until every view's RMS reprojection error (in "
+                             "pixels) is under this")
+    parser.add_argument("--min-views", type=int, default=3, help="the number of views to stop removing views at")
+
+    args = parser.parse_args()
+
+    image_names = glob.glob(os.path.join(args.src, "*.jpg"))
+    image_names += glob.glob(os.path.join(args.src, "*.png"))
+
+    objp = np.zeros((1, CHECKERBOARD[0] * CHECKERBOARD[1], 3), np.float32)
+    objp[0, :, :2] = np.mgrid[0:CHECKERBOARD[0], 0:CHECKERBOARD[1]].T.reshape(-1, 2)
+
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache if args.cache else os.path.join(args.src, ".corner_cache")
+
+    if args.compare:
+        for downscale in sorted({1, args.downscale}, reverse=True):
+            start = time.perf_counter()
+            compare_results = detect_all(image_names, downscale, workers)
+            detect_time = time.perf_counter() - start
+            views = [corners for ret, corners, size in compare_results if ret]
+            sizes = [size for ret, corners, size in compare_results if size is not None]
+            mean_error = calibrate([objp] * len(views), views, sizes[-1])[5] if views else float("nan")
+            print(f"downscale {downscale}: {detect_time:.2f} s to search {len(image_names)} images, "
+                  f"{len(views)} boards found, total error: {mean_error}")
+
+    start = time.perf_counter()
+    results = detect_all(image_names, args.downscale, workers, cache_dir)
+    print(f"corner detection took {time.perf_counter() - start:.2f} s")
+
+    # Arrays to store object points and image points from all the images.
+    objpoints = []  # 3d point in real world space
+    imgpoints = []  # 2d points in image plane.
+    view_names = []
+    image_size = None
+    for fname, (ret, corners, size) in zip(image_names, results):
+        if size is None:
+            print(f"failed to load {fname}")
+            continue
+        image_size = size
+        # If found, add object points, image points
+        if ret is True:
+            objpoints.append(objp)
+            imgpoints.append(corners)
+            view_names.append(fname)
+            # Draw and display the corners
+            if args.show:
+                img = cv2.imread(fname)
+                cv2.drawChessboardCorners(img, CHECKERBOARD, corners, ret)
+                cv2.imshow('img', img)
+                cv2.waitKey(0)
+
+    if image_size is not None:
+        initial_k, initial_d = None, None
+        if args.initial:
+            with np.load(args.initial) as initial:
+                initial_k, initial_d = initial["k"], initial["d"]
+        camera_matrix, distortion_coefficients, rvecs, tvecs, errors, mean_error, kept = calibrate(
+            objpoints, imgpoints, image_size, initial_k, initial_d, args.max_view_error, args.min_views)
+
+        print("Per view RMS reprojection error (px):")
+        view_error = dict(zip(kept, errors))
+        for i, fname in enumerate(view_names):
+            error = f"{view_error[i]:.4f}" if i in view_error else "removed"
+            print(f"  {os.path.basename(fname)}: {error}")
+        print(f"kept {len(kept)}/{len(view_names)} views")
+        print(f"total error: {mean_error}")
+
+        # todo: combine into one file
+        np.savez(os.path.join(args.dst, 'camera_cal.npz'), k=camera_matrix, d=distortion_coefficients)
+
+        print("Camera Matrix:")
+        pprint(camera_matrix)
+        print("Distortion Coefficients:")
+        pprint(distortion_coefficients)
+    cv2.destroyAllWindows()
@@ -1,107 +1,443 @@
 import argparse
+import collections
+import csv
+import functools
 import glob
+import multiprocessing
 import os.path
 import json
 import re
 
 import cv2 as cv
 import numpy as np
-from scipy.spatial.transform import Rotation
 from scipy.io import savemat
 
-from tracking_util import world_pos_from_image, load_cal_data, load_layout
+from cache_util import DetectionCache
+from metrics_util import metrics, PeriodicDump
+from tracking_util import world_pos_from_image, load_cal_data, load_layout, MarkerTracker, PoseTracker, \
+    load_distortion, load_detector_params
 from drawing_util import draw_axis
+from loader_util import read_image, prefetch_items
+from result_util import ResultStore, pose_results, STATUS_OK, STATUS_NO_MARKERS, STATUS_LOAD_FAILED
+
+LOAD_FAILED = "failed to load image"
+NO_MARKERS = "failed to find markers"
+
+# The ways the image can be undistorted before the markers are found, from slowest to fastest: remap the color image,
+# remap the greyscale image or find the markers on the raw image and only undistort their corners
+UNDISTORT_MODES = ["color", "gray", "points"]
+
+# The number of frames whose poses are converted and written together to the store and results.mat (poses streamed
+# to a csv file are written as soon as they are found)
+POSE_BATCH_SIZE = 256
+
+
+def track_image(source, cal_path, marker_layout, keep_image=False, tracker=None, scale=1, pose_tracker=None,
+                timestamp=None, cache=None, undistort="gray", reduced=1):
+    """
+    Loads an image, undistorts it and finds the position of the camera relative to the markers
+    :param source: The path of the image to process, or the image itself (e.g. a video frame or an image from
+    prefetch_items, which may be greyscale)
+    :param cal_path: The path to the npz camera calibration data
+    :param marker_layout: The marker layout returned by load_layout
+    :param keep_image: If true the undistorted image (with the markers drawn on it) is returned
+    :param tracker: An optional MarkerTracker to use the pose from the previous image to speed up the search
+    :param scale: The scale to initially search for the markers at (see find_markers), ignored if tracker is given
+    :param pose_tracker: An optional PoseTracker to warm start and smooth the pose with
+    :param timestamp: The time the image was captured in seconds, used by the pose tracker
+    :param cache: An optional DetectionCache to reuse the markers found in an identical image (ignored if tracker is
+    given, the tracker has its own)
+    :param undistort: How to undistort the image, one of UNDISTORT_MODES (the undistorted color image is only made
+    for keep_image in the gray and points modes, and without keep_image the image is decoded straight to greyscale)
+    :param reduced: The factor the image was downscaled by when it was decoded, or should be if source is a path (see
+    loader_util.read_image)
+    :return: A tuple containing an error message (None if successful), the rotation vector, translation vector, ids,
+    the camera matrix and the undistorted image (None if keep_image is false)
+    """
+    if isinstance(source, str):
+        # Only the color mode and drawing need the color image, decoding straight to greyscale is much faster
+        image = read_image(source, undistort != "color" and not keep_image, reduced)
+    else:
+        image = source
+    if image is None:
+        return LOAD_FAILED, None, None, None, None, None
+
+    dim = image.shape[1::-1]
+    # The calibration data is cached per image size, so this only recalculates the maps when the size changes
+    dist_coefficients, new_camera_mtx, roi, mapx, mapy = load_cal_data(cal_path, dim, reduced=reduced)
+
+    # Aruco detection runs on BW images
+    distortion = None
+    if undistort == "color" and image.ndim == 3:
+        # Undistorted the image
+        image = cv.remap(image, mapx, mapy, cv.INTER_LINEAR)
+        bw_img = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    else:
+        bw_img = image if image.ndim == 2 else cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+        if undistort == "points":
+            # The markers are found on the raw image and only their corners are undistorted
+            distortion = load_distortion(cal_path, reduced)
+        else:
+            # A third of the pixels to remap
+            bw_img = cv.remap(bw_img, mapx, mapy, cv.INTER_LINEAR)
+        if keep_image:
+            image = cv.remap(image, mapx, mapy, cv.INTER_LINEAR)
+
+    # Grab the translation and rotation vectors plus the ids of the found makers for debugging
+    # Only draw the markers if the image is going to be used, since the worker processes would have to send it back
+    draw_img = image if keep_image else None
+    if tracker is not None:
+        success, rvec, tvec, ids = tracker.world_pos_from_image(bw_img, new_camera_mtx, draw_img, timestamp,
+                                                                distortion)
+    else:
+        success, rvec, tvec, ids = world_pos_from_image(bw_img, marker_layout, new_camera_mtx, draw_img, scale,
+                                                        pose_tracker, timestamp, cache, distortion)
+
+    if not keep_image:
+        image = None
+
+    # Failed to find any markers
+    if not success:
+        return NO_MARKERS, None, None, None, new_camera_mtx, image
+
+    return None, rvec, tvec, ids, new_camera_mtx, image
+
+
+def track_item(item, **kwargs):
+    """
+    Runs track_image on a (name, timestamp, source) tuple from iter_images or iter_video
+    :param item: The (name, timestamp, source) tuple
+    :param kwargs: The rest of the arguments to track_image
+    :return: The name, the timestamp and the result of track_image
+    """
+    name, timestamp, source = item
+    return name, timestamp, track_image(source, timestamp=timestamp, **kwargs)
+
+
+def iter_images(paths, fps=30):
+    """
+    Generates the items to track for a list of image files
+    :param paths: The paths of the images
+    :param fps: The frame rate the images were captured at, used to make timestamps
+    :return: A generator of (file name, timestamp, path) tuples
+    """
+    for i, path in enumerate(paths):
+        yield os.path.basename(path), i / fps, path
+
+
+def iter_video(path):
+    """
+    Generates the items to track for a video file one frame at a time, so the video never has to fit in memory
+    :param path: The path of the video file
+    :return: A generator of ("video name:frame number", timestamp, frame) tuples
+    """
+    video = cv.VideoCapture(path)
+    if not video.isOpened():
+        print(f"Failed to open {path}")
+        return
+    name = os.path.basename(path)
+    index = 0
+    try:
+        while True:
+            status, frame = video.read()
+            if not status:
+                break
+            yield f"{name}:{index:06d}", video.get(cv.CAP_PROP_POS_MSEC) / 1000, frame
+            index += 1
+    finally:
+        video.release()
+
+
+def bounded_imap(pool, func, items, max_pending):
+    """
+    An ordered version of Pool.imap that only reads max_pending items ahead of the results, so memory stays constant
+    for long streams of frames (Pool.imap reads the whole input as fast as it can)
+    :param pool: The process pool
+    :param func: The function to run on each item
+    :param items: An iterable of items
+    :param max_pending: The maximum number of items submitted to the pool at once
+    :return: A generator of results in the same order as the items
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def print_pose(tvec, pvec, euler):
+    """
+    Prints a pose for a person to read
+    :param tvec: The translation vector
+    :param pvec: The position in world coordinates
+    :param euler: The zyx euler angles in degrees
+    """
+    print(f"Translation\n"
+          f"\t  {np.linalg.norm(tvec):+8.2f} cm\n"
+          f"\tX:{pvec[0]:+8.2f} cm\n"
+          f"\tY:{pvec[1]:+8.2f} cm\n"
+          f"\tZ:{pvec[2]:+8.2f} cm\n"
+          f"Rotation\n"
+          f"\tZ:{euler[0]:+8.2f} deg\n"
+          f"\tY:{euler[1]:+8.2f} deg\n"
+          f"\tX:{euler[2]:+8.2f} deg")
+
+
+def show_image(name, image, wait=True):
+    """
+    Displays an image
+    :param name: The window name
+    :param image: The image to display
+    :param wait: If true waits for a key press and closes the window, otherwise just refreshes it (for videos)
+    """
+    cv.imshow(name, image)
+    if wait:
+        cv.waitKey(0)
+        cv.destroyAllWindows()
+    else:
+        cv.waitKey(1)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--src", type=str, help='The source folder containing the images and calibration data to '
-                                                      'use', required=True)
+                                                      'use, or a video file to process frame by frame', required=True)
     parser.add_argument("--show", help="Displays the image before exiting", action="store_true")
 
     parser.add_argument("--cal", type=str, help="The path to the npz camera calibration data")
     parser.add_argument("--file-name", help="The name of the file in the folder to run on", )
     parser.add_argument("--layout", type=str, help='The marker layout json file')
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="The number of processes to spread the images across (0 uses every core)")
+    parser.add_argument("--track", action="store_true",
+                        help="Only search around the markers found in the previous image (for image sequences)")
+    parser.add_argument("--full-search-interval", type=int, default=30,
+                        help="The maximum number of images between searches of the whole image when tracking")
+    parser.add_argument("--detection-scale", type=float, default=1,
+                        help="Search for the markers on the image downscaled by this factor then refine the corners at "
+                             "full resolution (1 searches the full resolution image)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Write the poses to a csv file as they are found instead of keeping them for results.mat "
+                             "(always used for video files)")
+    parser.add_argument("--out", type=str, default="poses.csv", help="The csv file to stream the poses to")
+    parser.add_argument("--smooth", action="store_true",
+                        help="Warm start and smooth the pose using the previous frames (videos and image sequences)")
+    parser.add_argument("--fps", type=float, default=30, help="The frame rate of image sequences, used by --smooth")
+    parser.add_argument("--store", type=str,
+                        help="A folder to append the results to in chunks, frames that already have results in it are "
+                             "skipped (results.mat is only written with --export-mat)")
+    parser.add_argument("--chunk-size", type=int, default=256, help="The number of frames in each chunk of the store")
+    parser.add_argument("--export-mat", type=str, help="Export everything in the store to this mat file when done")
+    parser.add_argument("--detection-cache", type=str,
+                        help="A folder to cache the markers found in each image in, so rerunning on the same images "
+                             "skips the detection")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="The number of images to decode ahead of the one being tracked on a single process (0 "
+                             "decodes each image when it is needed)")
+    parser.add_argument("--reduced", type=int, choices=[1, 2, 4, 8], default=1,
+                        help="Decode the images at 1/REDUCED of their resolution and track at that resolution, which "
+                             "is much faster for JPEG images but less accurate (image folders only)")
+    parser.add_argument("--detector-params", type=str,
+                        help="A json file of detector parameters from tune_detector.py to find the markers with")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print the pose found in every image")
+    parser.add_argument("--metrics", type=str,
+                        help="Record the tracking stage timings and detection counts and write them to this json file")
+    parser.add_argument("--metrics-interval", type=float, default=10,
+                        help="The time between writing and logging the metrics in seconds")
+    parser.add_argument("--undistort", choices=UNDISTORT_MODES, default="gray",
+                        help="How to undistort the images: remap the color image, remap the greyscale image or find "
+                             "the markers on the raw image and only undistort their corners (the color image is still "
+                             "remapped for --show)")
 
     args = parser.parse_args()
 
-    if args.file_name:
-        paths = [os.path.join(args.src, args.file_name)]
+    # A video file is streamed from and the calibration data and layout are looked for next to it
+    video = os.path.isfile(args.src)
+    src_dir = os.path.dirname(args.src) if video else args.src
+    stream = video or args.stream
+
+    paths = []
+    if video:
+        items = iter_video(args.src)
     else:
-        paths = glob.glob(os.path.join(args.src, "*.jpg"))
-        paths += glob.glob(os.path.join(args.src, "*.png"))
+        if args.file_name:
+            paths = [os.path.join(args.src, args.file_name)]
+        else:
+            paths = glob.glob(os.path.join(args.src, "*.jpg"))
+            paths += glob.glob(os.path.join(args.src, "*.png"))
+            # Keep image sequences in order so the tracking mode can use the previous image
+            paths.sort()
+        items = iter_images(paths, args.fps)
 
     if args.layout:
         layout_path = args.layout
     else:
-        layout_path = os.path.join(args.src, 'marker_layout.json')
+        layout_path = os.path.join(src_dir, 'marker_layout.json')
 
     if args.cal:
         cal_path = args.cal
     else:
-        cal_path = os.path.join(args.src, 'camera_cal.npz')
+        cal_path = os.path.join(src_dir, 'camera_cal.npz')
+
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    if workers > 1 and args.show:
+        print("--show can't be used with multiple workers, running on a single process")
+        workers = 1
+    if workers > 1 and (args.track or args.smooth):
+        print("--track and --smooth need the images in order, running on a single process")
+        workers = 1
+    if workers > 1 and args.metrics:
+        print("--metrics only records the tracking done in this process, running on a single process")
+        workers = 1
+
+    reduced = args.reduced
+    if video and reduced != 1:
+        print("--reduced only applies to image folders, tracking the video at full resolution")
+        reduced = 1
+
+    dumper = None
+    if args.metrics:
+        metrics.enabled = True
+        dumper = PeriodicDump(metrics, args.metrics, args.metrics_interval)
+
+    if args.detector_params:
+        load_detector_params(args.detector_params)
 
     # Process the data from the marker layout json file into the format that world_pos_from_image needs
     marker_layout, marker_pos = load_layout(layout_path)
 
-    # Run on all images in the src directory
-    all_tvecs = np.zeros((len(paths), 3, 1))
-    all_tvecs2 = np.zeros((len(paths), 3, 1))
-    all_pvecs = np.zeros((len(paths), 3, 1))
-    all_rvecs = np.zeros((len(paths), 3, 3))
-    for i, path in enumerate(paths):
-        file_name = os.path.basename(path)
-        print(f"Loading {file_name}...")
+    store = None
+    if args.store:
+        store = ResultStore(args.store, args.chunk_size)
+        print(f"{len(store)} frames already in {args.store}, {store.failed} that failed to load will be retried")
+        items = (item for item in items if item[0] not in store)
+    # Without a csv file or store everything is kept in memory and saved to results.mat at the end
+    in_memory = not stream and store is None
 
-        image = cv.imread(path, cv.IMREAD_COLOR)
-        dim = image.shape[:-1][::-1]
-        # Inefficiently loading calibration data each time, but it doesn't matter in this case
-        # Done since image dimensions *might* be different so we should recalculate the camera matrix just in case
-        # and I don't want to write a separate function to do that since it would be of marginal value
-        dist_coefficients, new_camera_mtx, roi, mapx, mapy = load_cal_data(cal_path, dim)
+    cache = DetectionCache(args.detection_cache) if args.detection_cache else None
+    pose_tracker = PoseTracker() if args.smooth else None
+    tracker = None
+    if args.track:
+        tracker = MarkerTracker(marker_layout, args.full_search_interval, scale=args.detection_scale,
+                                pose_tracker=pose_tracker, cache=cache)
+    track = functools.partial(track_item, cal_path=cal_path, marker_layout=marker_layout, keep_image=args.show,
+                              tracker=tracker, scale=args.detection_scale, pose_tracker=pose_tracker, cache=cache,
+                              undistort=args.undistort, reduced=reduced)
+    if workers == 1 and not video and args.prefetch > 0:
+        # Decode the next images on threads while this one is tracked (the worker processes each decode their own)
+        items = prefetch_items(items, args.prefetch, gray=args.undistort != "color" and not args.show,
+                               reduced=reduced)
+    pool = None
+    if workers > 1:
+        # The results come back in the same order as the images, so they can be stored as they come back
+        # The workers may not be forked from this process, so they load the detector parameters themselves
+        if args.detector_params:
+            pool = multiprocessing.Pool(workers, initializer=load_detector_params, initargs=(args.detector_params,))
+        else:
+            pool = multiprocessing.Pool(workers)
+        results = bounded_imap(pool, track, items, 4 * workers)
+    else:
+        results = map(track, items)
 
-        # Undistorted the image
-        image = cv.remap(image, mapx, mapy, cv.INTER_LINEAR)
+    if stream:
+        # Only the current pose is kept in memory, everything else goes straight to the csv file
+        out_file = open(args.out, "w", newline="")
+        writer = csv.writer(out_file)
+        writer.writerow(["name", "timestamp", "status", "tx", "ty", "tz", "px", "py", "pz", "rz", "ry", "rx", "ids"])
+    if in_memory:
+        # Run on all images in the src directory
+        all_tvecs = np.zeros((len(paths), 3, 1))
+        all_tvecs2 = np.zeros((len(paths), 3, 1))
+        all_pvecs = np.zeros((len(paths), 3, 1))
+        all_rvecs = np.zeros((len(paths), 3, 3))
 
-        # Aruco detection runs on BW images
-        bw_img = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
-        # Grab the translation and rotation vectors plus the ids of the found makers for debugging
-        success, rvec, tvec, ids = world_pos_from_image(bw_img, marker_layout, new_camera_mtx, image)
-
-        # Failed to find any markers
-        if not success:
-            print("failed to find markers")
-            if args.show:
-                cv.imshow(file_name, image)
-                cv.waitKey(0)
-                cv.destroyAllWindows()
-            continue
-
-        # Use scipy's rotation class to simplify some things
-        rot = Rotation.from_rotvec(rvec.reshape(3, ))
-        # Grab standard euler angles
-        euler = rot.as_euler('zyx', degrees=True)
-        rot_m, _ = cv.Rodrigues(rvec)
-        tvec2 = rot_m.T @ tvec
-        all_tvecs[i, :] = tvec
-        all_tvecs2[i, :] = rot_m.T @ np.array([0,0,1]).reshape(3,1)
-        all_rvecs[i, :] = rot_m
-        all_pvecs[i, :] = tvec2
-        print(f"Translation\n"
-              f"\t  {np.linalg.norm(tvec):+8.2f} cm\n"
-              f"\tX:{tvec2[0, 0]:+8.2f} cm\n"
-              f"\tY:{tvec2[1, 0]:+8.2f} cm\n"
-              f"\tZ:{tvec2[2, 0]:+8.2f} cm\n"
-              f"Rotation\n"
-              f"\tZ:{euler[0]:+8.2f} deg\n"
-              f"\tY:{euler[1]:+8.2f} deg\n"
-              f"\tX:{euler[2]:+8.2f} deg")
-
-        if args.show:
-            for marker_id in ids:
-                marker_tvec = marker_pos[marker_id]["pos"]
-                marker_scale = marker_pos[marker_id]["scale"]
-                draw_axis(image, rvec, tvec + rot_m @ marker_tvec, new_camera_mtx, marker_scale, 2)
-            cv.imshow(file_name, image)
-            cv.waitKey(0)
-            cv.destroyAllWindows()
-    savemat("results.mat", {"tvec": all_tvecs.T.reshape(3, -1), "pvec": all_pvecs.T.reshape(3, -1), "d":all_tvecs2})
+    # The frames are written in batches, so the poses can be converted for the whole batch at once
+    pending = []
+    frames = 0
+    poses_found = 0
+    batched = store is not None or in_memory or args.verbose
+
+    def write_stream_row(file_name, timestamp, error, rvec, tvec, ids):
+        # Streamed poses are written and flushed straight away, so a live reader of the csv file isn't kept waiting
+        if error is not None:
+            writer.writerow([file_name, f"{timestamp:.4f}", error] + [""] * 10)
+        else:
+            poses = pose_results([rvec], [tvec])
+            pose = (*poses["tvec"][0], *poses["pvec"][0], *poses["euler"][0])
+            writer.writerow([file_name, f"{timestamp:.4f}", "ok"] + [f"{x:.4f}" for x in pose]
+                            + [" ".join(str(marker_id) for marker_id in ids)])
+        out_file.flush()
+
+    def write_pending():
+        found = [row for row in pending if row[3] is None]
+        poses = pose_results([row[4] for row in found], [row[5] for row in found])
+        j = 0
+        for i, file_name, timestamp, error, rvec, tvec, ids in pending:
+            if args.verbose:
+                print(f"Loading {file_name}...")
+            # Failed to find any markers
+            if error is not None:
+                if args.verbose:
+                    print(error)
+                if store is not None:
+                    status = STATUS_LOAD_FAILED if error == LOAD_FAILED else STATUS_NO_MARKERS
+                    store.append(file_name, status, timestamp)
+                continue
+
+            pvec, euler, rot_m = poses["pvec"][j], poses["euler"][j], poses["rmat"][j]
+            if store is not None:
+                store.append(file_name, STATUS_OK, timestamp, tvec, pvec, rot_m, ids)
+            if in_memory:
+                all_tvecs[i, :] = tvec
+                all_tvecs2[i, :] = poses["d"][j].reshape(3, 1)
+                all_rvecs[i, :] = rot_m
+                all_pvecs[i, :] = pvec.reshape(3, 1)
+            if args.verbose:
+                print_pose(tvec, pvec, euler)
+            j += 1
+        pending.clear()
+
+    # Frames are shown as they come, so they are written one at a time to keep the output in step
+    batch_size = 1 if args.show else POSE_BATCH_SIZE
+    try:
+        for i, (file_name, timestamp, result) in enumerate(results):
+            if dumper is not None:
+                dumper.tick()
+            error, rvec, tvec, ids, new_camera_mtx, image = result
+            if stream:
+                write_stream_row(file_name, timestamp, error, rvec, tvec, ids)
+            if batched:
+                pending.append((i, file_name, timestamp, error, rvec, tvec, ids))
+                if len(pending) >= batch_size:
+                    write_pending()
+            frames += 1
+            poses_found += error is None
+
+            if args.show and image is not None:
+                if error is None:
+                    rot_m, _ = cv.Rodrigues(rvec)
+                    for marker_id in ids:
+                        marker_tvec = marker_pos[marker_id]["pos"]
+                        marker_scale = marker_pos[marker_id]["scale"]
+                        draw_axis(image, rvec, tvec + rot_m @ marker_tvec, new_camera_mtx, marker_scale, 2)
+                show_image(file_name, image, not video)
+    finally:
+        # Save whatever was buffered even if the run is interrupted, so a rerun can pick up from there
+        write_pending()
+        if store is not None:
+            store.close()
+        if dumper is not None:
+            dumper.dump()
+
+    print(f"Found poses in {poses_found}/{frames} frames")
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if stream:
+        out_file.close()
+    if store is not None and args.export_mat:
+        store.export_mat(args.export_mat)
+    if in_memory:
+        savemat("results.mat", {"tvec": all_tvecs.T.reshape(3, -1), "pvec": all_pvecs.T.reshape(3, -1), "d":all_tvecs2})
@@ -46,3 +46,58 @@ def draw_movement_widget(terror, img, arrow_scale=500, max_arrow_len=150, widget
     cv.arrowedLine(img, widget_center, (widget_x + error_x, widget_y), (255, 0, 0), 3)
     cv.arrowedLine(img, widget_center, (widget_x, widget_y + error_y), (0, 255, 0), 3)
     cv.arrowedLine(img, widget_center, (widget_x + error_z, widget_y + error_z), (0, 0, 255), 3)
+
+
+def draw_alignment_widget(img, terror, euler, locks):
+    """
+    Draws the alignment widget used by the GUI on a 250x250 image
+    :param img: The image to draw on
+    :param terror: The translation error as a 3x1 vector (cm)
+    :param euler: The zyx euler angles of the rotation (deg)
+    :param locks: The tuple of xy position, z position, xy rotation and z rotation locked flags from check_alignment
+    """
+    xyPosLocked, zPosLocked, xyRotLocked, zRotLocked = locks
+
+    xPos = int(np.clip(terror[0, 0], -100, 100))
+    xPos += 125
+    yPos = int(np.clip(terror[1, 0], -100, 100))
+    yPos += 125
+    zPos = int(np.clip(terror[2, 0], -100, 100))
+    zPos += 125
+
+    cv.circle(img, (xPos, yPos), 15, color=(0, 0, 255) if not xyPosLocked else (0, 255, 0), thickness=2)
+    cv.line(img, (5, zPos), (20, zPos), color=(255, 0, 0) if not zPosLocked else (0, 255, 0), thickness=2)
+
+    xRot = np.clip(int(euler[2] * 2 + 125), -100, 100)
+    yRot = np.clip(int(euler[1] * 2 + 125), -100, 100)
+    zRot = np.deg2rad(np.clip(euler[0] - 90, -135, -45))
+
+    r = 100
+
+    p0 = (int((r - 5) * np.cos(zRot)) + 125, int((r - 5) * np.sin(zRot)) + 125)
+    p1 = (int((r + 5) * np.cos(zRot)) + 125, int((r + 5) * np.sin(zRot)) + 125)
+
+    cv.circle(img, (int(yRot), int(xRot)), 3, color=(255, 0, 255) if not xyRotLocked else (0, 255, 0), thickness=-1)
+    cv.line(img, p0, p1, color=(255, 0, 255) if not zRotLocked else (0, 255, 0), thickness=2)
+
+    cv.ellipse(img, (125, 125), (r, r), 0, -45, -135, color=(0, 0, 0), thickness=1)
+    cv.line(img, (125, 0), (125, 250), color=(0, 0, 0), thickness=1)
+    cv.line(img, (0, 125), (250, 125), color=(0, 0, 0), thickness=1)
+
+
+def encode_image(img, image_format="ppm", png_compression=1):
+    """
+    Encodes an image so it can be displayed by the GUI
+    :param img: The BGR image to encode
+    :param image_format: "ppm" for an uncompressed image, which is by far the fastest to encode and decode, or "png"
+    :param png_compression: The png compression level from 0 (fastest, largest) to 9 (slowest, smallest)
+    :return: The encoded image as bytes
+    """
+    if image_format == "ppm":
+        return cv.imencode(".ppm", img)[1].tobytes()
+    if image_format == "png":
+        # Run length encoding is what OpenCV uses when no compression level is given, and is much faster than the
+        # default zlib strategy on camera images
+        params = [cv.IMWRITE_PNG_COMPRESSION, png_compression, cv.IMWRITE_PNG_STRATEGY, cv.IMWRITE_PNG_STRATEGY_RLE]
+        return cv.imencode(".png", img, params)[1].tobytes()
+    raise ValueError(f"Unsupported image format {image_format}")
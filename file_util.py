@@ -0,0 +1,28 @@
+import contextlib
+import os.path
+import threading
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="wb", exclusive=False):
+    """
+    Opens a file to write that only appears at its path once it has been written in full, so readers in other
+    processes and a crash part way through never see a half written file
+    :param path: The path of the file
+    :param mode: The mode to open the file in ("wb" or "w")
+    :param exclusive: If true the write fails with FileExistsError instead of replacing an existing file
+    :return: A context manager that gives the open file
+    """
+    # Unique per process and thread, so concurrent writers of the same file never share a temporary file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        if exclusive:
+            # Linking fails if the path exists, where renaming would replace it
+            os.link(tmp_path, path)
+        else:
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -1,4 +1,8 @@
 import argparse
+import queue
+import threading
+import time
+
 from PySimpleGUI.PySimpleGUI import Window
 
 import cv2 as cv
@@ -9,8 +13,12 @@ import re
 
 from scipy.spatial.transform import Rotation
 
-from drawing_util import draw_axis
-from tracking_util import load_cal_data, world_pos_from_image, load_layout
+from drawing_util import draw_axis, draw_alignment_widget, encode_image
+from metrics_util import metrics, PeriodicDump
+from pipeline_util import DropOldestQueue, StageStats, ResolutionGovernor, RateLimiter, ReadRetry
+from recording_util import Recorder, ReplaySource, Recording, CAL_FILE, LAYOUT_FILE
+from tracking_util import load_cal_data, world_pos_from_image, load_layout, check_alignment, MarkerTracker, \
+    PoseTracker, load_detector_params
 
 EventFunctions = {}
 
@@ -19,17 +27,204 @@ H = 1080
 dim = (W, H)
 
 
+def capture_loop(cam, frames, stats, stop, recorder=None):
+    """
+    Reads frames from the camera until stopped, or until it fails to read too many frames in a row, in which case stop
+    is set
+    :param cam: The opened camera (or a ReplaySource)
+    :param frames: The queue to put (capture time, frame, recorded frame index) tuples on
+    :param stats: The StageStats for the capture stage
+    :param stop: An event that is set when the thread should exit
+    :param recorder: An optional Recorder to record every frame with, including the ones the tracking drops
+    """
+    retry = ReadRetry()
+    while not stop.is_set():
+        start = time.perf_counter()
+        status, frame = cam.read()
+        if not status:
+            # Back off so a failing camera doesn't hold the GIL against the tracking and display threads
+            if not retry.failed(stop):
+                print(f"Failed to read from the camera {retry.failures} times in a row, stopping")
+                stop.set()
+            continue
+        retry.succeeded()
+        stats.add(time.perf_counter() - start)
+        index = recorder.write(frame, start) if recorder is not None else None
+        frames.put((start, frame, index))
+
+
+def tracking_loop(frames, results, settings, settings_lock, stats, stop, recorder=None, governor_args=None):
+    """
+    Undistorts the camera frames, tracks the markers and draws the preview images until stopped. With the adaptive
+    resolution setting on a ResolutionGovernor picks the resolution each frame is undistorted and tracked at and skips
+    frames while the pose is far from the target.
+    :param frames: The queue to get (capture time, frame, recorded frame index) tuples from
+    :param results: The queue to put the result dictionaries for the GUI on
+    :param settings: The dictionary of settings set by the GUI (calibration, layout, target and drawing options)
+    :param settings_lock: The lock that protects settings
+    :param stats: The StageStats for the tracking stage
+    :param stop: An event that is set when the thread should exit
+    :param recorder: An optional Recorder to save the poses found for the recorded frames to
+    :param governor_args: The keyword arguments to make the ResolutionGovernor with
+    """
+    tracker = None
+    pose_tracker = None
+    governor = None
+    last_tracked = 0
+    while not stop.is_set():
+        try:
+            captured, frame, index = frames.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        start = time.perf_counter()
+        with settings_lock:
+            cal_path = settings['cal-path']
+            marker_layout = settings['marker-layout']
+            marker_pos = settings['marker-pos']
+            target_pos = settings['target-pos'].copy()
+            draw_options = dict(settings['draw'])
+            roi_tracking = settings['roi-tracking']
+            scale = settings['detection-scale']
+            smooth_pose = settings['smooth-pose']
+            adaptive = settings['governor']
+
+        # The governor is restarted from the full resolution whenever it is turned back on
+        if not adaptive:
+            governor = None
+        elif governor is None:
+            governor = ResolutionGovernor(**(governor_args or {}))
+        if governor is not None and captured - last_tracked < governor.interval:
+            continue
+        last_tracked = captured
+        preview_dim = (frame.shape[1] // 2, frame.shape[0] // 2)
+        marker_px = None
+        distance = None
+
+        # Smoothing is restarted from scratch whenever it is turned back on
+        if not smooth_pose:
+            pose_tracker = None
+        elif pose_tracker is None:
+            pose_tracker = PoseTracker()
+
+        # The tracker holds on to the last pose, so it needs to be replaced whenever the layout changes
+        if marker_layout is None or not roi_tracking:
+            tracker = None
+        elif tracker is None or tracker.marker_layout is not marker_layout:
+            tracker = MarkerTracker(marker_layout, scale=scale, pose_tracker=pose_tracker)
+        else:
+            tracker.scale = scale
+            tracker.pose_tracker = pose_tracker
+
+        result = {'captured': captured, 'widget': None, 'pose': None, 'aligned': False,
+                  'governor': str(governor) if governor is not None else None}
+
+        # Undistort the image and display it
+        if cal_path is not None:
+            # The maps are cached for each resolution, so this only recalculates them if the camera gives a different
+            # resolution or the governor picks one that hasn't been used yet. The remap downscales the frame too.
+            dim = frame.shape[1::-1]
+            out_dim = None if governor is None else (round(dim[0] * governor.scale), round(dim[1] * governor.scale))
+            cal_data = load_cal_data(cal_path, dim, 1, out_dim=out_dim)
+            dist_coefficients, camera_mtx, roi, mapx, mapy = cal_data
+            frame = cv.remap(frame, mapx, mapy, cv.INTER_LINEAR)
+            widget_img = 255 * np.ones((250, 250, 3), dtype=np.uint8)
+            result['widget'] = widget_img
+            if marker_layout is not None:
+                gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+
+                draw_img = None
+
+                if draw_options['draw-marker']:
+                    draw_img = frame
+
+                if tracker is not None:
+                    ret, rvec, tvec, ids = tracker.world_pos_from_image(gray, camera_mtx, draw_img, captured)
+                else:
+                    ret, rvec, tvec, ids = world_pos_from_image(gray, marker_layout, camera_mtx, draw_img, scale,
+                                                                pose_tracker, captured)
+                if recorder is not None and index is not None:
+                    recorder.add_pose(index, (ret, rvec, tvec, ids))
+
+                if ret:
+                    Rt, _ = cv.Rodrigues(rvec)
+                    # Use scipy's rotation class to simplify some things
+                    rot = Rotation.from_matrix(Rt)
+                    # Grab standard euler angles
+                    euler = rot.as_euler('zyx', degrees=True)
+
+                    terror = target_pos - tvec
+                    locks = check_alignment(terror, euler)
+                    result['pose'] = (tvec, euler)
+                    result['aligned'] = all(locks)
+                    distance = np.linalg.norm(terror)
+                    # The apparent side length of the smallest marker found, at the resolution it was tracked at
+                    min_size = min(marker_pos[marker_id]["scale"] for marker_id in np.reshape(ids, -1))
+                    marker_px = camera_mtx[0, 0] * min_size / max(tvec[2, 0], 1e-6)
+
+                    draw_alignment_widget(widget_img, terror, euler, locks)
+
+                    if draw_options['draw-axis']:
+                        for marker_id in ids:
+                            marker_tvec = marker_pos[marker_id]["pos"]
+                            marker_scale = marker_pos[marker_id]["scale"]
+                            draw_axis(frame, rvec, tvec + Rt @ marker_tvec, camera_mtx, marker_scale, 2)
+                    if draw_options['draw-origin']:
+                        draw_axis(frame, rvec, tvec, camera_mtx, 25, 2)
+
+        # todo crop image to only show roi
+        #  (https://stackoverflow.com/questions/39432322/what-does-the-getoptimalnewcameramatrix-do-in-opencv)
+        # The preview stays the same size whatever resolution the frame was tracked at
+        result['preview'] = cv.resize(frame, preview_dim)
+        latency = time.perf_counter() - start
+        stats.add(latency)
+        if governor is not None:
+            governor.update(latency, marker_px, distance)
+        results.put(result)
+
+
 def main():
     # Parse Arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--camera", default=0, help="The id of the camera to use")
     parser.add_argument("--cal", type=str, help="The path to the npz camera calibration data")
     parser.add_argument("--layout", type=str, help='The marker layout json file')
+    parser.add_argument("--preview-format", choices=["ppm", "png"], default="ppm",
+                        help="The format the preview images are sent to the GUI in (ppm is uncompressed and much "
+                             "faster)")
+    parser.add_argument("--png-compression", type=int, default=1, choices=range(10), metavar="{0-9}",
+                        help="The compression level to use for the png preview format")
+    parser.add_argument("--preview-fps", type=float, default=30,
+                        help="The maximum rate to update the preview images at, independent of the tracking rate (0 "
+                             "for no limit)")
+    parser.add_argument("--detector-params", type=str,
+                        help="A json file of detector parameters from tune_detector.py to find the markers with")
+    parser.add_argument("--record", type=str,
+                        help="A folder to record the camera frames, the poses found and the calibration and layout "
+                             "used to")
+    parser.add_argument("--replay", type=str,
+                        help="A recording folder to play back instead of using the camera (it uses the recorded "
+                             "calibration and layout unless --cal or --layout are given)")
+    parser.add_argument("--max-speed", action="store_true",
+                        help="Replay the recording as fast as it can be tracked instead of at the recorded rate")
+    parser.add_argument("--latency-budget", type=float, default=50,
+                        help="The tracking latency (ms) the adaptive resolution setting lowers the resolution to hold")
+    parser.add_argument("--far-fps", type=float, default=10,
+                        help="The rate the adaptive resolution setting tracks frames at while far from the target")
+    parser.add_argument("--metrics", type=str,
+                        help="Record the tracking stage timings and detection counts and write them to this json file")
+    parser.add_argument("--metrics-interval", type=float, default=10,
+                        help="The time between writing and logging the metrics in seconds")
 
     args = parser.parse_args()
-
-    loaded_cal = False
-    loaded_layout = False
+    if args.record and args.replay:
+        parser.error("--record and --replay can't be used together")
+    recording = None
+    if args.replay:
+        recording = Recording(args.replay)
+        args.cal = args.cal or recording.cal_path
+        args.layout = args.layout or recording.layout_path
+    if args.detector_params:
+        load_detector_params(args.detector_params)
 
     # Setup the GUI
     sg.theme('Black')
@@ -42,6 +237,11 @@ def main():
         [sg.Checkbox('Draw Axis', key='draw-axis', default=False)],
         [sg.Checkbox('Draw Marker', key='draw-marker', default=False)],
         [sg.Checkbox('Draw Origin', key='draw-origin', default=False)],
+        [sg.Checkbox('ROI Tracking', key='roi-tracking', default=False)],
+        [sg.Checkbox('Smooth Pose', key='smooth-pose', default=False)],
+        [sg.Checkbox('Adaptive Resolution', key='governor', default=False)],
+        [sg.Text('Detection Scale'),
+         sg.Combo([1, 0.75, 0.5, 0.25], default_value=1, key='detection-scale', readonly=True)],
     ]
 
     target_input = [
@@ -57,7 +257,8 @@ def main():
                         sg.FileBrowse('Browse', file_types=(('npz', '*.npz'),))]]),
             sg.Column([[sg.Text('Marker Layout')],
                        [sg.Input(key='layout-path', enable_events=True),
-                        sg.FileBrowse('Browse', file_types=(('json', '*.json'),))]])
+                        sg.FileBrowse('Browse', file_types=(('json', '*.json'),))],
+                       [sg.Text('', key='layout-error', size=(50, 1), text_color='red')]])
         ],
         [sg.Column([[sg.Frame('Control Panel', layout=control_panel, vertical_alignment='top')],
                     [sg.Frame('Target', layout=target_input)],
@@ -76,6 +277,12 @@ def main():
                  [sg.Text('X: N/A', key='x-rot', size=(15, 1))],
                  [sg.Text('Y: N/A', key='y-rot', size=(15, 1))],
                  [sg.Text('Z: N/A', key='z-rot', size=(15, 1))],
+             ])],
+             [sg.Frame('Performance', vertical_alignment='top', layout=[
+                 [sg.Text('Capture: N/A', key='capture-stats', size=(28, 1))],
+                 [sg.Text('Tracking: N/A', key='tracking-stats', size=(28, 1))],
+                 [sg.Text('Display: N/A', key='display-stats', size=(28, 1))],
+                 [sg.Text('Resolution: N/A', key='governor-stats', size=(28, 1))],
              ])]], vertical_alignment='top')
          ]
     ]
@@ -98,7 +305,11 @@ def main():
 
     # Get the camera
     camera_id = args.camera
-    cam = cv.VideoCapture(camera_id, cv.CAP_DSHOW)
+    if recording is not None:
+        # Loop the recording so it can be tuned on for as long as needed
+        cam = ReplaySource(recording, realtime=not args.max_speed, loop=True)
+    else:
+        cam = cv.VideoCapture(camera_id, cv.CAP_DSHOW)
 
     if not cam.isOpened():
         print("Failed to load camera")
@@ -106,151 +317,158 @@ def main():
 
     cam.set(cv.CAP_PROP_FRAME_WIDTH, W)
     cam.set(cv.CAP_PROP_FRAME_HEIGHT, H)
-    widget_img = 255 * np.ones((250, 250, 3), dtype=np.uint8)
+    recorder = Recorder(args.record, source=str(camera_id)) if args.record else None
     target_pos = np.zeros((3, 1))
 
+    # The settings shared with the tracking thread, only replaced or modified while holding the lock
+    settings_lock = threading.Lock()
+    settings = {
+        'cal-path': None,
+        'marker-layout': None,
+        'marker-pos': None,
+        'target-pos': target_pos,
+        'draw': {'draw-axis': False, 'draw-marker': False, 'draw-origin': False},
+        'roi-tracking': False,
+        'detection-scale': 1,
+        'smooth-pose': False,
+        'governor': False,
+    }
+    governor_args = {'budget': args.latency_budget / 1000, 'far_fps': args.far_fps}
+
+    # Each stage runs on its own thread and only the newest frame/result is kept between them, so a slow stage drops
+    # frames instead of stalling the stages around it
+    frames = DropOldestQueue(1)
+    results = DropOldestQueue(1)
+    stop = threading.Event()
+    capture_stats = StageStats()
+    tracking_stats = StageStats()
+    display_stats = StageStats()
+    threads = [
+        threading.Thread(target=capture_loop, args=(cam, frames, capture_stats, stop, recorder), daemon=True),
+        threading.Thread(target=tracking_loop,
+                         args=(frames, results, settings, settings_lock, tracking_stats, stop, recorder, governor_args),
+                         daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    dumper = None
+    if args.metrics:
+        metrics.enabled = True
+        dumper = PeriodicDump(metrics, args.metrics, args.metrics_interval)
+
+    preview_limiter = RateLimiter(args.preview_fps)
+    last_widget = None
+
     # Event loop
     while True:
-        # todo call functions to find camera pos from markers
-        # todo update GUI as needed
         event, values = window.read(timeout=20)
 
-        if event == 'x-target':
-            text = values[event]
-            try:
-                target_pos[0, 0] = float(text)
-            except ValueError:
-                pass
-
-        if event == 'y-target':
-            text = values[event]
-            try:
-                target_pos[1, 0] = float(text)
-            except ValueError:
-                pass
-
-        if event == 'z-target':
-            text = values[event]
-            try:
-                target_pos[2, 0] = float(text)
-            except ValueError:
-                pass
-
-        if event == 'cal-path':
-            cal_path = values[event]
-            if os.path.isfile(cal_path):
-                loaded_cal = True
-                cal_data = load_cal_data(cal_path, dim, 1)
-                dist_coefficients, camera_mtx, roi, mapx, mapy = cal_data
-
-        if event == 'layout-path':
-            layout_path = values[event]
-            if os.path.isfile(layout_path):
-                loaded_layout = True
-                marker_layout, marker_pos = load_layout(values[event])
-
         if event in ('Exit', None):
             break
 
-        xyPosLocked = False
-        zPosLocked = False
-        xyRotLocked = False
-        zRotLocked = False
-
-        status, frame = cam.read()
-        if status:
-            # Undistort the image and display it
-            if loaded_cal:
-                frame = cv.remap(frame, mapx, mapy, cv.INTER_LINEAR)
-                widget_img.fill(255)
-                if loaded_layout:
-                    gray = cv.cvtColor(frame, cv.COLOR_RGB2GRAY)
-
-                    draw_img = None
-
-                    if values['draw-marker']:
-                        draw_img = frame
-
-                    ret, rvec, tvec, ids = world_pos_from_image(gray, marker_layout, camera_mtx, draw_img)
-
-                    if ret:
-                        Rt, _ = cv.Rodrigues(rvec)
-                        # Use scipy's rotation class to simplify some things
-                        rot = Rotation.from_matrix(Rt)
-                        # Grab standard euler angles
-                        euler = rot.as_euler('zyx', degrees=True)
-
-                        window['pos'].update(f"{np.linalg.norm(tvec):+8.2f}cm")
-                        window['x-pos'].update(f"X: {tvec[0, 0]:+8.2f}cm")
-                        window['y-pos'].update(f"Y: {tvec[1, 0]:+8.2f}cm")
-                        window['z-pos'].update(f"Z: {tvec[2, 0]:+8.2f}cm")
-
-                        terror = target_pos - tvec
-                        xPos = int(np.clip(terror[0, 0], -100, 100))
-                        xPos += 125
-                        yPos = int(np.clip(terror[1, 0], -100, 100))
-                        yPos += 125
-                        zPos = int(np.clip(terror[2, 0], -100, 100))
-                        zPos += 125
-
-                        xyPosLocked = np.linalg.norm(terror[0:2]) < 0.5
-                        xyRotLocked = np.linalg.norm(euler[1:]) < 5
-                        zPosLocked = abs(terror[2]) < 0.5
-                        zRotLocked = abs(euler[0]) < 5
-
-                        if all([xyRotLocked, xyPosLocked, zRotLocked, zPosLocked]):
-                            window['status'].update('Aligned')
-                        else:
-                            window['status'].update('Not Aligned')
-
-                        cv.circle(widget_img, (xPos, yPos), 15, color=(0, 0, 255) if not xyPosLocked else (0, 255, 0),
-                                  thickness=2)
-                        cv.line(widget_img, (5, zPos), (20, zPos), color=(255, 0, 0) if not zPosLocked else (0, 255, 0),
-                                thickness=2)
-
-                        xRot = np.clip(int(euler[2]*2 + 125), -100, 100)
-                        yRot = np.clip(int(euler[1]*2 + 125), -100, 100)
-                        zRot = np.deg2rad(np.clip(euler[0] - 90, -135, -45))
-
-                        r = 100
-
-                        p0 = (int((r - 5) * np.cos(zRot)) + 125, int((r - 5) * np.sin(zRot)) + 125)
-                        p1 = (int((r + 5) * np.cos(zRot)) + 125, int((r + 5) * np.sin(zRot)) + 125)
-
-                        cv.circle(widget_img, (yRot, xRot), 3, color=(255, 0, 255) if not xyRotLocked else (0, 255, 0),
-                                  thickness=-1)
-                        cv.line(widget_img, p0, p1, color=(255, 0, 255) if not zRotLocked else (0, 255, 0), thickness=2)
-
-                        cv.ellipse(widget_img, (125, 125), (r, r), 0, -45, -135, color=(0, 0, 0), thickness=1)
-                        cv.line(widget_img, (125, 0), (125, 250), color=(0, 0, 0), thickness=1)
-                        cv.line(widget_img, (0, 125), (250, 125), color=(0, 0, 0), thickness=1)
-
-                        window['x-rot'].update(f"X: {euler[2]:+8.2f}deg")
-                        window['y-rot'].update(f"Y: {euler[1]:+8.2f}deg")
-                        window['z-rot'].update(f"Z: {euler[0]:+8.2f}deg")
-                        if values['draw-axis']:
-                            for marker_id in ids:
-                                marker_tvec = marker_pos[marker_id]["pos"]
-                                marker_scale = marker_pos[marker_id]["scale"]
-                                draw_axis(frame, rvec, tvec + Rt @ marker_tvec, camera_mtx, marker_scale, 2)
-                        if values['draw-origin']:
-                            draw_axis(frame, rvec, tvec, camera_mtx, 25, 2)
-                else:
-                    window['x-pos'].update(f"X: N/A")
-                    window['y-pos'].update(f"Y: N/A")
-                    window['z-pos'].update(f"Z: N/A")
-                    window['x-rot'].update(f"X: N/A")
-                    window['y-rot'].update(f"Y: N/A")
-                    window['z-rot'].update(f"Z: N/A")
-
-            # todo crop image to only show roi
-            #  (https://stackoverflow.com/questions/39432322/what-does-the-getoptimalnewcameramatrix-do-in-opencv)
-            imgbytes = cv.imencode('.png', cv.resize(frame, None, fy=0.5, fx=0.5))[1].tobytes()
-            window['image'].update(data=imgbytes)
-            imgbytes = cv.imencode('.png', widget_img)[1].tobytes()
-            window['widget'].update(data=imgbytes)
-
+        with settings_lock:
+            if event == 'x-target':
+                text = values[event]
+                try:
+                    target_pos[0, 0] = float(text)
+                except ValueError:
+                    pass
+
+            if event == 'y-target':
+                text = values[event]
+                try:
+                    target_pos[1, 0] = float(text)
+                except ValueError:
+                    pass
+
+            if event == 'z-target':
+                text = values[event]
+                try:
+                    target_pos[2, 0] = float(text)
+                except ValueError:
+                    pass
+
+            if event == 'cal-path':
+                cal_path = values[event]
+                if os.path.isfile(cal_path):
+                    settings['cal-path'] = cal_path
+                    if recorder is not None:
+                        recorder.add_file(cal_path, CAL_FILE)
+
+            if event == 'layout-path':
+                layout_path = values[event]
+                if os.path.isfile(layout_path):
+                    try:
+                        marker_layout, marker_pos = load_layout(layout_path)
+                    except ValueError as e:
+                        # Keep tracking with the previous layout until the file is fixed
+                        window['layout-error'].update(f"Invalid layout: {e}")
+                    else:
+                        window['layout-error'].update('')
+                        settings['marker-layout'], settings['marker-pos'] = marker_layout, marker_pos
+                        if recorder is not None:
+                            recorder.add_file(layout_path, LAYOUT_FILE)
+
+            for key in settings['draw']:
+                settings['draw'][key] = values[key]
+            settings['roi-tracking'] = values['roi-tracking']
+            settings['detection-scale'] = values['detection-scale']
+            settings['smooth-pose'] = values['smooth-pose']
+            settings['governor'] = values['governor']
+
+        try:
+            result = results.get_nowait()
+        except queue.Empty:
+            result = None
+
+        if result is not None:
+            if result['pose'] is not None:
+                tvec, euler = result['pose']
+                window['pos'].update(f"{np.linalg.norm(tvec):+8.2f}cm")
+                window['x-pos'].update(f"X: {tvec[0, 0]:+8.2f}cm")
+                window['y-pos'].update(f"Y: {tvec[1, 0]:+8.2f}cm")
+                window['z-pos'].update(f"Z: {tvec[2, 0]:+8.2f}cm")
+                window['x-rot'].update(f"X: {euler[2]:+8.2f}deg")
+                window['y-rot'].update(f"Y: {euler[1]:+8.2f}deg")
+                window['z-rot'].update(f"Z: {euler[0]:+8.2f}deg")
+                window['status'].update('Aligned' if result['aligned'] else 'Not Aligned')
+            elif settings['cal-path'] is not None and settings['marker-layout'] is None:
+                window['x-pos'].update(f"X: N/A")
+                window['y-pos'].update(f"Y: N/A")
+                window['z-pos'].update(f"Z: N/A")
+                window['x-rot'].update(f"X: N/A")
+                window['y-rot'].update(f"Y: N/A")
+                window['z-rot'].update(f"Z: N/A")
+
+            # Encoding and drawing the images is the slowest part of the GUI loop, so the preview is rate limited and
+            # the widget is only updated when it changes
+            if preview_limiter.ready():
+                window['image'].update(data=encode_image(result['preview'], args.preview_format,
+                                                         args.png_compression))
+                widget = result['widget']
+                if widget is not None and (last_widget is None or not np.array_equal(widget, last_widget)):
+                    last_widget = widget
+                    window['widget'].update(data=encode_image(widget, args.preview_format, args.png_compression))
+            window['governor-stats'].update(f"Resolution: {result['governor'] or 'N/A'}")
+            # The display latency is measured from when the frame was captured, so it covers the whole pipeline
+            display_stats.add(time.perf_counter() - result['captured'])
+
+        if stop.is_set():
+            window['capture-stats'].update("Capture: stopped, the camera isn't responding")
+        else:
+            window['capture-stats'].update(f"Capture: {capture_stats}")
+        window['tracking-stats'].update(f"Tracking: {tracking_stats}")
+        window['display-stats'].update(f"Display: {display_stats}")
+        if dumper is not None:
+            dumper.tick()
+
+    stop.set()
+    for thread in threads:
+        thread.join()
     cam.release()
+    if recorder is not None:
+        recorder.close()
 
 
 if __name__ == "__main__":
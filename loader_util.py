@@ -0,0 +1,147 @@
+import collections
+import concurrent.futures
+import threading
+
+import cv2 as cv
+
+# The imread flags for each (greyscale, reduction factor) combination, the reduced flags make the JPEG decoder skip
+# most of the work instead of decoding the full image and resizing it
+READ_FLAGS = {
+    (False, 1): cv.IMREAD_COLOR,
+    (False, 2): cv.IMREAD_REDUCED_COLOR_2,
+    (False, 4): cv.IMREAD_REDUCED_COLOR_4,
+    (False, 8): cv.IMREAD_REDUCED_COLOR_8,
+    (True, 1): cv.IMREAD_GRAYSCALE,
+    (True, 2): cv.IMREAD_REDUCED_GRAYSCALE_2,
+    (True, 4): cv.IMREAD_REDUCED_GRAYSCALE_4,
+    (True, 8): cv.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def read_image(path, gray=False, reduced=1):
+    """
+    Decodes an image file
+    :param path: The path of the image
+    :param gray: If true the image is decoded straight to greyscale, which skips the color conversion in the decoder
+    :param reduced: Decode the image at 1/reduced of its resolution (1, 2, 4 or 8)
+    :return: The image, or None if it couldn't be read
+    """
+    if (gray, reduced) not in READ_FLAGS:
+        raise ValueError(f"Images can only be reduced by 1, 2, 4 or 8, not {reduced}")
+    return cv.imread(path, READ_FLAGS[gray, reduced])
+
+
+class ImageLoader:
+    """
+    Decodes a list of images on a thread pool ahead of when they are needed. Getting an image starts decoding the next
+    depth images in the list, and anything outside of that window is dropped, so memory stays bounded by the depth no
+    matter how many images there are. imread releases the GIL, so the decoding runs in parallel with the tracking.
+    """
+
+    def __init__(self, paths, depth=4, workers=2, gray=False, reduced=1):
+        """
+        :param paths: The paths of the images, in the order they will usually be used in
+        :param depth: The number of images to decode ahead of the current one
+        :param workers: The number of threads to decode on
+        :param gray: If true the images are decoded straight to greyscale
+        :param reduced: Decode the images at 1/reduced of their resolution (1, 2, 4 or 8)
+        """
+        if (gray, reduced) not in READ_FLAGS:
+            raise ValueError(f"Images can only be reduced by 1, 2, 4 or 8, not {reduced}")
+        self.paths = list(paths)
+        self.depth = depth
+        self.gray = gray
+        self.reduced = reduced
+        self._index = {}
+        for i, path in enumerate(self.paths):
+            self._index.setdefault(path, i)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max(1, workers))
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        """
+        :return: A generator of (path, image) tuples in order, the image is None if it couldn't be read
+        """
+        for i, path in enumerate(self.paths):
+            yield path, self._get(i)
+
+    def get(self, path):
+        """
+        Gets an image, waiting for it to finish decoding if it is still in progress. Paths that aren't in the list are
+        decoded on the spot.
+        :param path: The path of the image
+        :return: The image (shared with other callers, so it must not be modified), or None if it couldn't be read
+        """
+        if path not in self._index:
+            return read_image(path, self.gray, self.reduced)
+        return self._get(self._index[path])
+
+    def close(self):
+        """
+        Stops decoding and drops the decoded images
+        """
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+        self._executor.shutdown(wait=True)
+
+    def _get(self, index):
+        with self._lock:
+            window = range(index, min(index + self.depth + 1, len(self.paths)))
+            for i in list(self._futures):
+                if i not in window:
+                    self._futures.pop(i).cancel()
+            for i in window:
+                if i not in self._futures:
+                    self._futures[i] = self._executor.submit(read_image, self.paths[i], self.gray, self.reduced)
+            future = self._futures[index]
+        return future.result()
+
+
+def prefetch_items(items, depth=4, workers=2, gray=False, reduced=1):
+    """
+    Decodes the images from a stream of items on a thread pool ahead of when they are needed, keeping at most depth
+    decoded images waiting. Items that already hold an image (e.g. video frames) are passed through.
+    :param items: An iterable of (name, timestamp, image path or image) tuples
+    :param depth: The number of images to decode ahead of the current one
+    :param workers: The number of threads to decode on
+    :param gray: If true the images are decoded straight to greyscale
+    :param reduced: Decode the images at 1/reduced of their resolution (1, 2, 4 or 8)
+    :return: A generator of (name, timestamp, image) tuples in the same order, the image is None if it couldn't be read
+    """
+    if (gray, reduced) not in READ_FLAGS:
+        raise ValueError(f"Images can only be reduced by 1, 2, 4 or 8, not {reduced}")
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+        try:
+            for name, timestamp, source in items:
+                if isinstance(source, str):
+                    source = executor.submit(read_image, source, gray, reduced)
+                pending.append((name, timestamp, source))
+                if len(pending) > depth:
+                    yield _finish(pending.popleft())
+            while pending:
+                yield _finish(pending.popleft())
+        finally:
+            # Stopped early, so don't wait for images that won't be used
+            for _, _, source in pending:
+                if isinstance(source, concurrent.futures.Future):
+                    source.cancel()
+
+
+def _finish(item):
+    name, timestamp, source = item
+    if isinstance(source, concurrent.futures.Future):
+        source = source.result()
+    return name, timestamp, source
@@ -0,0 +1,171 @@
+import collections
+import json
+import threading
+import time
+
+import numpy as np
+
+from file_util import atomic_write
+
+
+class Metrics:
+    """
+    Collects timers, counters and rolling histograms from the tracking code. Recording is skipped entirely while
+    disabled, and the instrumented code checks enabled before timing anything, so it costs next to nothing when off.
+    Timers and histograms keep the last window values, counters are totals since the last reset.
+    """
+
+    def __init__(self, window=1000, enabled=False):
+        """
+        :param window: The number of recent values to keep for each timer and histogram
+        :param enabled: If true values are recorded
+        """
+        self.window = window
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clears every recorded value
+        """
+        with self._lock:
+            self._timers = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+            self._histograms = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+            self._counters = collections.Counter()
+            self._start = time.time()
+
+    def add_time(self, name, seconds):
+        """
+        Records how long a stage took
+        :param name: The name of the stage
+        :param seconds: The time it took in seconds
+        """
+        if self.enabled:
+            with self._lock:
+                self._timers[name].append(seconds)
+
+    def count(self, name, n=1):
+        """
+        Adds to a counter
+        :param name: The name of the counter
+        :param n: The amount to add
+        """
+        if self.enabled:
+            with self._lock:
+                self._counters[name] += n
+
+    def observe(self, name, value):
+        """
+        Records a value in a rolling histogram
+        :param name: The name of the histogram
+        :param value: The value
+        """
+        if self.enabled:
+            with self._lock:
+                self._histograms[name].append(value)
+
+    def snapshot(self):
+        """
+        Summarizes everything recorded so far
+        :return: A dictionary of counters, timers (in milliseconds) and histograms that can be encoded as json
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            timers = {name: np.array(values) * 1000 for name, values in self._timers.items()}
+            histograms = {name: np.array(values) for name, values in self._histograms.items()}
+            start = self._start
+        return {
+            "time": time.time(),
+            "elapsed": time.time() - start,
+            "counters": counters,
+            "timers_ms": {name: summarize(values) for name, values in timers.items()},
+            "histograms": {name: summarize(values, bins=True) for name, values in histograms.items()},
+        }
+
+    def dump(self, path):
+        """
+        Writes a snapshot to a json file, replacing it so readers never see a half written file
+        :param path: The path of the json file
+        """
+        with atomic_write(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def summary(self):
+        """
+        Makes a one line summary for logging
+        :return: The summary string
+        """
+        snapshot = self.snapshot()
+        counters = " ".join(f"{name}={value}" for name, value in sorted(snapshot["counters"].items()))
+        timers = " ".join(f"{name}={stats['p50']:.1f}/{stats['p95']:.1f}ms"
+                          for name, stats in sorted(snapshot["timers_ms"].items()))
+        return f"{counters} {timers} (p50/p95)"
+
+
+class PeriodicDump:
+    """
+    Dumps and logs metrics at a fixed interval from a loop that calls tick
+    """
+
+    def __init__(self, metrics, path=None, interval=10.0, log=print):
+        """
+        :param metrics: The Metrics to dump
+        :param path: The json file to write (None to only log)
+        :param interval: The time between dumps in seconds
+        :param log: The function to log the summary with (None to not log)
+        """
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.log = log
+        self._last = time.perf_counter()
+
+    def tick(self):
+        """
+        Dumps the metrics if the interval has passed since the last dump
+        """
+        now = time.perf_counter()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.dump()
+
+    def dump(self):
+        """
+        Dumps the metrics now
+        """
+        if self.path is not None:
+            self.metrics.dump(self.path)
+        if self.log is not None:
+            self.log(f"metrics: {self.metrics.summary()}")
+
+
+def summarize(values, bins=False):
+    """
+    Summarizes a list of values, such as stage times
+    :param values: The values
+    :param bins: If true a histogram of the values is included
+    :return: A dictionary of the count, mean, min, percentiles and max of the values (only the count if there aren't
+    any)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    stats = {
+        "count": int(values.size),
+        "mean": float(values.mean()),
+        "min": float(values.min()),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": float(values.max()),
+    }
+    if bins:
+        counts, edges = np.histogram(values, bins=min(10, max(1, len(np.unique(values)))))
+        stats["bins"] = {"counts": counts.tolist(), "edges": edges.tolist()}
+    return stats
+
+
+# The metrics recorded by tracking_util, disabled until a tracker turns them on
+metrics = Metrics()
@@ -0,0 +1,264 @@
+import argparse
+import csv
+import json
+import os.path
+import queue
+import threading
+import time
+
+import cv2 as cv
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from pipeline_util import DropOldestQueue, StageStats, ReadRetry
+from tracking_util import load_cal_data, load_layout, find_markers, filter_markers, solve_pose, pose_covariance, \
+    transform_pose, fuse_poses, load_detector_params
+
+
+def load_rig(path):
+    """
+    Loads a camera rig config file. Relative paths in the file are relative to the file itself.
+
+    {
+        "layout": "marker_layout.json",
+        "cameras": [
+            {"name": "left", "source": 0, "cal": "left_cal.npz", "rvec": [0, 0, 0], "tvec": [0, 0, 0]},
+            {"name": "right", "source": "right.avi", "cal": "right_cal.npz", "rvec": [0, 0.3, 0], "tvec": [30, 0, 0]}
+        ]
+    }
+
+    The source is a camera id or a video file and rvec/tvec move points from the camera's coordinates into the rig's
+    coordinates (rig = R @ camera + t, in cm).
+    :param path: The path of the json file
+    :return: The path of the marker layout file and a list of camera dictionaries
+    """
+    with open(path) as f:
+        config = json.load(f)
+    root = os.path.dirname(os.path.abspath(path))
+
+    cameras = []
+    for i, camera in enumerate(config["cameras"]):
+        source = camera["source"]
+        if isinstance(source, str):
+            source = os.path.join(root, source)
+        cameras.append({
+            "name": camera.get("name", str(i)),
+            "source": source,
+            "cal": os.path.join(root, camera["cal"]),
+            "rvec": np.array(camera.get("rvec", [0, 0, 0]), dtype=np.float64),
+            "tvec": np.array(camera.get("tvec", [0, 0, 0]), dtype=np.float64),
+        })
+    return os.path.join(root, config["layout"]), cameras
+
+
+def open_source(source):
+    """
+    Opens a camera or video file
+    :param source: A camera id or the path of a video file
+    :return: The opened VideoCapture
+    """
+    if isinstance(source, int):
+        return cv.VideoCapture(source, cv.CAP_DSHOW)
+    return cv.VideoCapture(source)
+
+
+def track_frame(frame, cal_path, marker_layout, scale=1):
+    """
+    Finds the pose of the markers in one camera's frame along with its covariance
+    :param frame: The BGR frame
+    :param cal_path: The path to the camera's npz calibration data
+    :param marker_layout: The marker layout returned by load_layout
+    :param scale: The scale to initially search for the markers at (see find_markers)
+    :return: A tuple of the rotation vector, translation vector and covariance in the camera's coordinates, or None if
+    no known markers were found
+    """
+    dist_coefficients, camera_mtx, roi, mapx, mapy = load_cal_data(cal_path, frame.shape[1::-1])
+    # Nothing is displayed, so only the greyscale image is undistorted
+    gray = cv.remap(cv.cvtColor(frame, cv.COLOR_BGR2GRAY), mapx, mapy, cv.INTER_LINEAR)
+    bounding_boxes, ids = find_markers(gray, scale)
+    bounding_boxes, ids, world_points, image_points = filter_markers(bounding_boxes, ids, marker_layout)
+    if ids is None:
+        return None
+    r_vec, t_vec = solve_pose(world_points, image_points, camera_mtx)
+    return r_vec, t_vec, pose_covariance(world_points, image_points, r_vec, t_vec, camera_mtx)
+
+
+def camera_loop(camera, marker_layout, results, stats, stop, scale=1, read_time=False):
+    """
+    Reads and tracks the frames from one camera until the source ends, a live camera fails to read too many frames in a
+    row or the loop is stopped
+    :param camera: The camera dictionary from load_rig
+    :param marker_layout: The marker layout returned by load_layout
+    :param results: The queue to put (timestamp, pose) tuples on, with the pose in rig coordinates or None if no
+    markers were found. None is put on the queue when the source ends.
+    :param stats: The StageStats for the camera
+    :param stop: An event that is set when the thread should exit
+    :param scale: The scale to initially search for the markers at (see find_markers)
+    :param read_time: If true video files are timed by when the frame was read, like live cameras, so they can be
+    compared with the live cameras in the same rig
+    """
+    source = open_source(camera["source"])
+    if not source.isOpened():
+        print(f"Failed to open {camera['name']} ({camera['source']})")
+    live = isinstance(camera["source"], int)
+    retry = ReadRetry()
+    try:
+        while source.isOpened() and not stop.is_set():
+            status, frame = source.read()
+            if not status:
+                if live and retry.failed(stop):
+                    continue
+                if live:
+                    print(f"Failed to read from {camera['name']} {retry.failures} times in a row, stopping it")
+                break
+            retry.succeeded()
+            # Video files are timed from the file so they line up, live cameras by when the frame was read
+            timestamp = time.perf_counter() if live or read_time else source.get(cv.CAP_PROP_POS_MSEC) / 1000
+            start = time.perf_counter()
+            pose = track_frame(frame, camera["cal"], marker_layout, scale)
+            if pose is not None:
+                pose = transform_pose(*pose, camera["rvec"], camera["tvec"])
+            stats.add(time.perf_counter() - start)
+            put(results, (timestamp, pose), stop)
+    finally:
+        source.release()
+        put(results, None, stop)
+
+
+def collect_live(queues, latest, ended, max_age, timeout=0.1):
+    """
+    Gets the newest pose from every camera in a rig with live cameras
+    :param queues: The DropOldestQueue of each camera
+    :param latest: The newest (timestamp, pose) tuple from each camera so far (None if there hasn't been one), updated
+    in place
+    :param ended: Whether each camera's source has ended, updated in place
+    :param max_age: The oldest a pose can be (s), relative to the newest pose from any camera, to be fused
+    :param timeout: The longest to wait for the first running camera's next pose (s)
+    :return: The (timestamp, pose) tuple to fuse from each camera (None for cameras without a recent enough pose), or
+    None if no camera had a new pose within the timeout or every camera has ended
+    """
+    new = False
+    for i, results in enumerate(queues):
+        if ended[i]:
+            continue
+        try:
+            item = results.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        finally:
+            # Only wait on one camera, the rest are checked for whatever they have
+            timeout = 0
+        if item is None:
+            ended[i] = True
+        else:
+            latest[i] = item
+            new = True
+    if not new:
+        return None
+    # Poses are kept until they are too old, so a slower camera still adds its last pose to the faster ones
+    newest = max(item[0] for item in latest if item is not None)
+    return [item if item is not None and newest - item[0] <= max_age else None for item in latest]
+
+
+def put(results, item, stop):
+    """
+    Puts an item on a results queue, giving up if the loop is stopped while the queue is full
+    :param results: The queue
+    :param item: The item to put on it
+    :param stop: An event that is set when the thread should exit
+    """
+    if isinstance(results, DropOldestQueue):
+        results.put(item)
+        return
+    while not stop.is_set():
+        try:
+            results.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", type=str, help="The camera rig json file (see load_rig)")
+    parser.add_argument("--detection-scale", type=float, default=1,
+                        help="Search for the markers on the image downscaled by this factor then refine the corners at "
+                             "full resolution (1 searches the full resolution image)")
+    parser.add_argument("--max-age", type=float, default=0.1,
+                        help="The oldest a camera's pose can be (s) and still be fused with the newest one (live "
+                             "rigs only, a camera's last pose is reused until it is this old)")
+    parser.add_argument("--out", type=str, help="A csv file to write the fused poses to")
+    parser.add_argument("--detector-params", type=str,
+                        help="A json file of detector parameters from tune_detector.py to find the markers with")
+
+    args = parser.parse_args()
+    if args.detector_params:
+        load_detector_params(args.detector_params)
+
+    layout_path, cameras = load_rig(args.config)
+    marker_layout, marker_pos = load_layout(layout_path)
+
+    # Video files are read in lockstep so every run fuses the same frames, live cameras only keep their newest pose
+    live = any(isinstance(camera["source"], int) for camera in cameras)
+    # With live cameras the video files are played along with them and the run ends when they have all ended
+    videos = [i for i, camera in enumerate(cameras) if not isinstance(camera["source"], int)]
+    stop = threading.Event()
+    queues = [DropOldestQueue(1) if live else queue.Queue(4) for _ in cameras]
+    stats = [StageStats() for _ in cameras]
+    threads = [threading.Thread(target=camera_loop, daemon=True,
+                                args=(camera, marker_layout, results, camera_stats, stop, args.detection_scale, live))
+               for camera, results, camera_stats in zip(cameras, queues, stats)]
+    for thread in threads:
+        thread.start()
+
+    out_file = None
+    if args.out:
+        out_file = open(args.out, "w", newline="")
+        writer = csv.writer(out_file)
+        writer.writerow(["frame", "timestamp", "cameras", "tx", "ty", "tz", "rz", "ry", "rx", "sx", "sy", "sz"])
+
+    latest = [None] * len(cameras)
+    ended = [False] * len(cameras)
+    frame = 0
+    try:
+        # Live rigs end when every camera has, or when their videos have all ended
+        while not all(ended) and not (videos and all(ended[i] for i in videos)):
+            if live:
+                # Use the newest pose from every camera that is recent enough
+                items = collect_live(queues, latest, ended, args.max_age)
+                if items is None:
+                    continue
+            else:
+                items = [results.get() for results in queues]
+                if any(item is None for item in items):
+                    break
+
+            used = [(camera["name"], item) for camera, item in zip(cameras, items) if item is not None and item[1]]
+            timestamp = max(item[0] for item in items if item is not None)
+            if not used:
+                print(f"{frame:6d} {timestamp:8.3f}s no markers found")
+                frame += 1
+                continue
+
+            rvec, tvec, covariance = fuse_poses([item[1] for name, item in used])
+            euler = Rotation.from_rotvec(rvec.reshape(3)).as_euler('zyx', degrees=True)
+            std = np.sqrt(np.diag(covariance)[3:])
+            names = " ".join(name for name, item in used)
+            print(f"{frame:6d} {timestamp:8.3f}s [{names}] "
+                  f"X:{tvec[0, 0]:+8.2f} Y:{tvec[1, 0]:+8.2f} Z:{tvec[2, 0]:+8.2f} cm "
+                  f"(+/- {std[0]:.2f} {std[1]:.2f} {std[2]:.2f}) "
+                  f"Z:{euler[0]:+7.2f} Y:{euler[1]:+7.2f} X:{euler[2]:+7.2f} deg")
+            if out_file is not None:
+                writer.writerow([frame, f"{timestamp:.4f}", names]
+                                + [f"{x:.4f}" for x in (*tvec.reshape(3), *euler, *std)])
+            frame += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        if out_file is not None:
+            out_file.close()
+        for camera, camera_stats in zip(cameras, stats):
+            print(f"{camera['name']}: {camera_stats}")
@@ -0,0 +1,250 @@
+import collections
+import queue
+import threading
+import time
+
+# How long to wait after a failed camera read, doubling with each failure in a row up to the maximum (seconds)
+READ_RETRY_DELAY = 0.01
+MAX_READ_RETRY_DELAY = 1.0
+# The number of failed reads in a row before the camera is given up on
+MAX_READ_FAILURES = 50
+
+
+class DropOldestQueue:
+    """
+    A bounded queue for passing frames between threads. When the queue is full the oldest item is dropped instead of
+    blocking the producer, so the consumer always gets the newest data.
+    """
+
+    def __init__(self, maxsize=1):
+        """
+        :param maxsize: The maximum number of items to hold before the oldest ones are dropped
+        """
+        self._items = collections.deque(maxlen=maxsize)
+        self._not_empty = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        """
+        Adds an item to the queue, dropping the oldest item if it is full
+        :param item: The item to add
+        """
+        with self._not_empty:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._not_empty.notify()
+
+    def get(self, timeout=None):
+        """
+        Removes and returns the oldest item in the queue
+        :param timeout: The maximum time to wait for an item in seconds (None waits forever)
+        :return: The oldest item in the queue
+        :raises queue.Empty: If no item was available before the timeout
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._items, timeout):
+                raise queue.Empty
+            return self._items.popleft()
+
+    def get_nowait(self):
+        """
+        Removes and returns the oldest item in the queue without waiting
+        :raises queue.Empty: If the queue is empty
+        """
+        return self.get(timeout=0)
+
+
+class StageStats:
+    """
+    Tracks the rate and latency of one stage of a pipeline over a sliding window of recent items
+    """
+
+    def __init__(self, window=30):
+        """
+        :param window: The number of recent items to average over
+        """
+        self._times = collections.deque(maxlen=window)
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        """
+        Records that the stage finished an item
+        :param latency: The time the item took in seconds
+        """
+        with self._lock:
+            self._times.append(time.perf_counter())
+            self._latencies.append(latency)
+
+    @property
+    def fps(self):
+        """
+        The number of items per second the stage has finished recently
+        """
+        with self._lock:
+            if len(self._times) < 2 or self._times[-1] == self._times[0]:
+                return 0.0
+            return (len(self._times) - 1) / (self._times[-1] - self._times[0])
+
+    @property
+    def latency(self):
+        """
+        The mean latency of the recent items in seconds
+        """
+        with self._lock:
+            if not self._latencies:
+                return 0.0
+            return sum(self._latencies) / len(self._latencies)
+
+    def __str__(self):
+        return f"{self.fps:5.1f} fps {self.latency * 1000:6.1f} ms"
+
+
+class ReadRetry:
+    """
+    Backs off after failed camera reads, waiting longer after each failure in a row, and gives up after too many so a
+    camera that has been unplugged doesn't keep a thread spinning
+    """
+
+    def __init__(self, max_failures=MAX_READ_FAILURES):
+        """
+        :param max_failures: The number of failed reads in a row to give up after
+        """
+        self.max_failures = max_failures
+        self.failures = 0
+
+    def failed(self, stop=None):
+        """
+        Records a failed read and waits before the next one
+        :param stop: An optional event that cuts the wait short when it is set
+        :return: True if the read should be retried, False if the camera should be given up on
+        """
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            return False
+        delay = min(READ_RETRY_DELAY * 2 ** (self.failures - 1), MAX_READ_RETRY_DELAY)
+        if stop is not None:
+            stop.wait(delay)
+        else:
+            time.sleep(delay)
+        return True
+
+    def succeeded(self):
+        """
+        Records a successful read, so the next failure waits the shortest time again
+        """
+        self.failures = 0
+
+
+class RateLimiter:
+    """
+    Limits how often something is done, such as redrawing a preview, by skipping it until enough time has passed
+    """
+
+    def __init__(self, max_rate):
+        """
+        :param max_rate: The most times per second to allow (0 for no limit)
+        """
+        self.interval = 1 / max_rate if max_rate > 0 else 0
+        self._last = None
+
+    def ready(self, now=None):
+        """
+        Checks whether enough time has passed since it was last ready, and if so starts the next interval
+        :param now: The current time in seconds (defaults to time.perf_counter())
+        :return: True if it is ready
+        """
+        if now is None:
+            now = time.perf_counter()
+        if self._last is not None and now - self._last < self.interval:
+            return False
+        self._last = now
+        return True
+
+
+class ResolutionGovernor:
+    """
+    Picks the resolution to track live frames at, and how often to track them, to hold a latency budget while keeping
+    full precision where it matters. The resolution steps down when the frames take too long and the markers would
+    still be big enough to find, and steps back up when there is time to spare, the markers get small or they are lost.
+    Close to the target the full resolution and every frame are always used. After each change the level is held for
+    a number of frames, so the latency average can settle at the new resolution before it is judged again.
+    """
+
+    def __init__(self, scales=(1, 0.75, 0.5), budget=0.05, min_marker_px=40, near_distance=10, far_distance=50,
+                 far_fps=10, smoothing=0.2, hold_frames=15):
+        """
+        :param scales: The resolutions to choose from as fractions of the full resolution, from highest to lowest
+        :param budget: The latency budget for tracking a frame in seconds
+        :param min_marker_px: The smallest the markers' sides can get in pixels before a higher resolution is needed
+        :param near_distance: The distance to the target (cm) within which the full resolution is always used
+        :param far_distance: The distance to the target (cm) beyond which only far_fps frames a second are tracked
+        :param far_fps: The rate to track frames at when far from the target
+        :param smoothing: The weight of the newest latency in its exponential moving average
+        :param hold_frames: The number of frames to wait after a change before changing again
+        """
+        self.scales = tuple(scales)
+        self.budget = budget
+        self.min_marker_px = min_marker_px
+        self.near_distance = near_distance
+        self.far_distance = far_distance
+        self.far_fps = far_fps
+        self.smoothing = smoothing
+        self.hold_frames = hold_frames
+        self.level = 0
+        self.interval = 0.0
+        self.latency = None
+        self._held = 0
+
+    @property
+    def scale(self):
+        """
+        The fraction of the full resolution to track the next frame at
+        """
+        return self.scales[self.level]
+
+    def update(self, latency, marker_px=None, distance=None):
+        """
+        Records how a frame went and picks the resolution and rate for the next frames
+        :param latency: The time it took to track the frame in seconds
+        :param marker_px: The side length in pixels of the smallest marker found at the current resolution (None if
+        no markers were found)
+        :param distance: The distance from the pose to the target in cm (None if no pose was found)
+        :return: The scale to track the next frame at
+        """
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+
+        # Only track every frame where the precision matters, or when the markers have to be found again
+        self.interval = 1 / self.far_fps if distance is not None and distance > self.far_distance else 0.0
+
+        level = self.level
+        if marker_px is None or (distance is not None and distance < self.near_distance):
+            # Lost the markers or lining up, so use the full resolution straight away
+            level = 0
+        elif marker_px < self.min_marker_px:
+            level = max(0, level - 1)
+        elif self._held >= self.hold_frames:
+            lower = min(level + 1, len(self.scales) - 1)
+            # The marker size is for the current resolution, so scale it to what it would be at the lower one
+            lower_px = marker_px * self.scales[lower] / self.scales[level]
+            if self.latency > self.budget and lower_px >= self.min_marker_px:
+                level = lower
+            elif self.latency < self.budget / 2 * self.scales[level] / self.scales[max(0, level - 1)]:
+                # There is room for the higher resolution even if it takes proportionally longer
+                level = max(0, level - 1)
+
+        if level != self.level:
+            self.level = level
+            self._held = 0
+        else:
+            self._held += 1
+        return self.scale
+
+    def __str__(self):
+        latency = "N/A" if self.latency is None else f"{self.latency * 1000:.1f} ms"
+        rate = f"{self.far_fps:g} fps" if self.interval else "every frame"
+        return f"{self.scale:.2f}x {rate} {latency}"
@@ -0,0 +1,262 @@
+import csv
+import json
+import os.path
+import shutil
+import time
+
+import numpy as np
+
+from file_util import atomic_write
+
+RECORDING_VERSION = 1
+# The names of the files in a recording folder
+FRAMES_FILE = "frames.bin"
+TIMESTAMPS_FILE = "timestamps.bin"
+POSES_FILE = "poses.csv"
+META_FILE = "meta.json"
+CAL_FILE = "camera_cal.npz"
+LAYOUT_FILE = "marker_layout.json"
+
+
+class Recorder:
+    """
+    Records camera frames to a folder that can be replayed with ReplaySource. The frames are appended uncompressed to
+    one file so they can be memory mapped when replayed, and the capture times (in seconds since the first frame) go
+    to another, so a recording cut short by a crash can still be read up to the last whole frame. The poses found for
+    the frames, and the calibration and layout files used, are saved next to them.
+    """
+
+    def __init__(self, path, source=None):
+        """
+        Starts a new recording, replacing any recording already in the folder
+        :param path: The folder to record to (created if it doesn't exist)
+        :param source: A description of where the frames come from (e.g. the camera id), saved in the metadata
+        """
+        self.path = path
+        self.source = source
+        self.shape = None
+        self.frames = 0
+        os.makedirs(path, exist_ok=True)
+        self._start = None
+        self._frames_file = open(os.path.join(path, FRAMES_FILE), "wb")
+        self._timestamps_file = open(os.path.join(path, TIMESTAMPS_FILE), "wb")
+        self._poses_file = open(os.path.join(path, POSES_FILE), "w", newline="")
+        self._poses = csv.writer(self._poses_file)
+        self._poses.writerow(["frame", "found", "tx", "ty", "tz", "rx", "ry", "rz", "ids"])
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_file(self, src, name):
+        """
+        Saves a copy of a file used to track the frames, replacing any earlier copy
+        :param src: The path of the file
+        :param name: The name to save it as in the recording (CAL_FILE or LAYOUT_FILE)
+        """
+        shutil.copyfile(src, os.path.join(self.path, name))
+
+    def write(self, frame, timestamp=None):
+        """
+        Appends a frame to the recording, every frame must be the same size
+        :param frame: The frame as an 8 bit image
+        :param timestamp: The time the frame was captured in seconds (defaults to now), only the differences between
+        the frames are kept
+        :return: The index of the frame in the recording
+        """
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        if self.shape is None:
+            self.shape = frame.shape
+            self._start = timestamp
+            self._write_meta()
+        elif frame.shape != self.shape:
+            raise ValueError(f"Frame is {frame.shape} but the recording is {self.shape}")
+        self._frames_file.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        self._timestamps_file.write(np.float64(timestamp - self._start).tobytes())
+        index = self.frames
+        self.frames += 1
+        return index
+
+    def add_pose(self, index, result):
+        """
+        Saves the pose found for a frame (frames dropped by the tracking simply have no pose)
+        :param index: The index of the frame returned by write
+        :param result: The (success, rotation vector, translation vector, ids) tuple from world_pos_from_image
+        """
+        success, rvec, tvec, ids = result
+        if success:
+            self._poses.writerow([index, 1] + [f"{x:.6f}" for x in np.reshape(tvec, 3)]
+                                 + [f"{x:.6f}" for x in np.reshape(rvec, 3)]
+                                 + [" ".join(str(marker_id) for marker_id in np.reshape(ids, -1))])
+        else:
+            self._poses.writerow([index, 0] + [""] * 7)
+
+    def close(self):
+        """
+        Finishes the recording
+        """
+        if self._frames_file.closed:
+            return
+        self._frames_file.close()
+        self._timestamps_file.close()
+        self._poses_file.close()
+        self._write_meta()
+
+    def _write_meta(self):
+        meta = {
+            "version": RECORDING_VERSION,
+            "shape": None if self.shape is None else list(self.shape),
+            "dtype": "uint8",
+            "frames": self.frames,
+            "source": self.source,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with atomic_write(os.path.join(self.path, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+
+
+class Recording:
+    """
+    A recording made by Recorder. The frames and timestamps are memory mapped, so opening a recording of any length is
+    instant and only the frames that are used are read from disk.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The recording folder
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] > RECORDING_VERSION:
+            raise ValueError(f"{path} was recorded by a newer version (version {self.meta['version']})")
+        self.shape = None if self.meta["shape"] is None else tuple(self.meta["shape"])
+
+        frames_path = os.path.join(path, FRAMES_FILE)
+        timestamps_path = os.path.join(path, TIMESTAMPS_FILE)
+        # The metadata is only updated when the recording is closed, so the frame count comes from the file sizes
+        count = 0
+        if self.shape is not None:
+            count = min(os.path.getsize(frames_path) // int(np.prod(self.shape)), os.path.getsize(timestamps_path) // 8)
+        if count == 0:
+            # Empty files can't be memory mapped
+            self.frames = np.zeros((0,) + (self.shape or (0,)), dtype=np.uint8)
+            self.timestamps = np.zeros(0)
+        else:
+            self.frames = np.memmap(frames_path, dtype=np.uint8, mode="r", shape=(count,) + self.shape)
+            self.timestamps = np.memmap(timestamps_path, dtype=np.float64, mode="r", shape=(count,))
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def cal_path(self):
+        """
+        The path of the calibration data used while recording, or None if there wasn't any
+        """
+        path = os.path.join(self.path, CAL_FILE)
+        return path if os.path.isfile(path) else None
+
+    @property
+    def layout_path(self):
+        """
+        The path of the marker layout used while recording, or None if there wasn't one
+        """
+        path = os.path.join(self.path, LAYOUT_FILE)
+        return path if os.path.isfile(path) else None
+
+    def load_poses(self):
+        """
+        Loads the poses found while recording
+        :return: A dictionary of arrays with one row per tracked frame: the frame indices ("frame"), whether a pose
+        was found ("found") and the translation ("tvec") and rotation ("rvec") vectors (NaN if no pose was found)
+        """
+        frames, found, tvecs, rvecs = [], [], [], []
+        with open(os.path.join(self.path, POSES_FILE), newline="") as f:
+            for row in csv.DictReader(f):
+                frames.append(int(row["frame"]))
+                found.append(row["found"] == "1")
+                tvecs.append([float(row[name]) if row[name] else np.nan for name in ("tx", "ty", "tz")])
+                rvecs.append([float(row[name]) if row[name] else np.nan for name in ("rx", "ry", "rz")])
+        return {
+            "frame": np.array(frames, dtype=np.int64),
+            "found": np.array(found, dtype=bool),
+            "tvec": np.array(tvecs, dtype=np.float64).reshape(-1, 3),
+            "rvec": np.array(rvecs, dtype=np.float64).reshape(-1, 3),
+        }
+
+
+class ReplaySource:
+    """
+    Plays a recording back through the same read interface as cv.VideoCapture, at the rate it was recorded at or as
+    fast as the frames are read. The frames are read only views of the memory mapped recording, so they must not be
+    modified.
+    """
+
+    def __init__(self, recording, realtime=True, loop=False):
+        """
+        :param recording: The Recording or the path of the recording folder
+        :param realtime: If true read waits until each frame is due, otherwise the frames are returned immediately
+        :param loop: If true the recording starts over after the last frame
+        """
+        self.recording = recording if isinstance(recording, Recording) else Recording(recording)
+        self.realtime = realtime
+        self.loop = loop
+        # The index of the last frame read
+        self.index = -1
+        self._start = None
+
+    def isOpened(self):
+        return len(self.recording) > 0
+
+    def read(self):
+        """
+        Gets the next frame
+        :return: A (status, frame) tuple like cv.VideoCapture.read, status is false once the recording has ended
+        """
+        index = self.index + 1
+        if index >= len(self.recording):
+            if not self.loop or len(self.recording) == 0:
+                return False, None
+            index = 0
+        if index == 0:
+            self._start = time.perf_counter()
+        if self.realtime:
+            time.sleep(max(0.0, self._start + self.recording.timestamps[index] - time.perf_counter()))
+        self.index = index
+        return True, self.recording.frames[index]
+
+    def set(self, prop_id, value):
+        # The recording's resolution can't be changed
+        return False
+
+    def release(self):
+        pass
+
+
+def is_recording(path):
+    """
+    Checks if a path is a recording folder
+    :param path: The path to check
+    """
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+def iter_recording(path, realtime=False):
+    """
+    Generates the items to track for a recording, like cli_tracker.iter_video
+    :param path: The recording folder
+    :param realtime: If true the frames are generated at the rate they were recorded at
+    :return: A generator of ("recording name:frame number", timestamp, frame) tuples
+    """
+    source = ReplaySource(path, realtime)
+    name = os.path.basename(os.path.normpath(path))
+    while True:
+        status, frame = source.read()
+        if not status:
+            break
+        yield f"{name}:{source.index:06d}", float(source.recording.timestamps[source.index]), frame
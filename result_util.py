@@ -0,0 +1,205 @@
+import glob
+import os.path
+
+import numpy as np
+from scipy.io import savemat
+from scipy.spatial.transform import Rotation
+
+from file_util import atomic_write
+
+# Per frame status codes
+STATUS_OK = 1
+STATUS_NO_MARKERS = 0
+STATUS_LOAD_FAILED = -1
+
+FIELDS = ["names", "status", "timestamp", "tvec", "pvec", "rmat", "ids_count", "ids"]
+
+
+def pose_results(r_vecs, t_vecs):
+    """
+    Converts the poses found in a run into the forms the results are saved in, for every frame at once
+    :param r_vecs: The rotation vectors, N of any shape with 3 elements
+    :param t_vecs: The translation vectors, N of any shape with 3 elements
+    :return: A dictionary with the Nx3x3 rotation matrices ("rmat"), the Nx3 translation vectors ("tvec"), the Nx3
+    positions in world coordinates ("pvec", rmat.T @ tvec), the Nx3 zyx euler angles in degrees ("euler"), the Nx3
+    directions the camera is pointing in world coordinates ("d", rmat.T @ [0, 0, 1]) and the N distances to the
+    markers ("distance")
+    """
+    r_vecs = np.asarray(r_vecs, dtype=np.float64).reshape(-1, 3)
+    t_vecs = np.asarray(t_vecs, dtype=np.float64).reshape(-1, 3)
+    rotations = Rotation.from_rotvec(r_vecs)
+    rmats = rotations.as_matrix()
+    return {
+        "rmat": rmats,
+        "tvec": t_vecs,
+        "pvec": np.einsum("nji,nj->ni", rmats, t_vecs),
+        "euler": rotations.as_euler("zyx", degrees=True),
+        # The last row of each rotation matrix, the same as rmat.T @ [0, 0, 1]
+        "d": rmats[:, 2, :],
+        "distance": np.linalg.norm(t_vecs, axis=1),
+    }
+
+
+class ResultStore:
+    """
+    Stores the poses found for each frame in a folder of chunk files that are appended to as the frames are processed,
+    so a crash only loses the last partial chunk and a rerun can skip the frames that already have results.
+    Each chunk is an uncompressed npz file with one row per frame, keyed by the frame's file name.
+    """
+
+    def __init__(self, path, chunk_size=256):
+        """
+        Opens a result store, creating the folder if it doesn't exist
+        :param path: The folder to store the chunk files in
+        :param chunk_size: The number of frames to buffer before writing a chunk
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+        self._chunk_paths = sorted(glob.glob(os.path.join(path, "chunk_*.npz")))
+        self._buffer = []
+        # Name of every frame with a result mapped to its status
+        self._status = {}
+        for chunk_path in self._chunk_paths:
+            with np.load(chunk_path) as chunk:
+                self._status.update(zip(chunk["names"].tolist(), chunk["status"].tolist()))
+
+    def __contains__(self, name):
+        """
+        Checks if a frame has a result that doesn't need to be recomputed (frames that failed to load are retried)
+        :param name: The frame's file name
+        """
+        return self._status.get(name, STATUS_LOAD_FAILED) != STATUS_LOAD_FAILED
+
+    def __len__(self):
+        """
+        The number of frames with a result that doesn't need to be recomputed (frames that failed to load aren't
+        counted, see failed)
+        """
+        return sum(status != STATUS_LOAD_FAILED for status in self._status.values())
+
+    @property
+    def failed(self):
+        """
+        The number of frames whose last result is that they failed to load, which are retried by the next run
+        """
+        return sum(status == STATUS_LOAD_FAILED for status in self._status.values())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, name, status, timestamp=np.nan, tvec=None, pvec=None, rmat=None, ids=()):
+        """
+        Adds the result for a frame
+        :param name: The frame's file name
+        :param status: One of STATUS_OK, STATUS_NO_MARKERS or STATUS_LOAD_FAILED
+        :param timestamp: The time the frame was captured in seconds
+        :param tvec: The translation vector (None if no pose was found)
+        :param pvec: The position of the camera in world coordinates (None if no pose was found)
+        :param rmat: The rotation matrix (None if no pose was found)
+        :param ids: The ids of the markers used to find the pose
+        """
+        self._buffer.append((name, status, timestamp, tvec, pvec, rmat, ids))
+        self._status[name] = status
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered results to a new chunk file
+        """
+        if not self._buffer:
+            return
+        rows = self._buffer
+        nan_vec = np.full(3, np.nan)
+        nan_mat = np.full((3, 3), np.nan)
+        chunk = {
+            "names": np.array([row[0] for row in rows], dtype=str),
+            "status": np.array([row[1] for row in rows], dtype=np.int8),
+            "timestamp": np.array([row[2] for row in rows], dtype=np.float64),
+            "tvec": np.array([nan_vec if row[3] is None else np.reshape(row[3], 3) for row in rows]),
+            "pvec": np.array([nan_vec if row[4] is None else np.reshape(row[4], 3) for row in rows]),
+            "rmat": np.array([nan_mat if row[5] is None else row[5] for row in rows]),
+            # The ids are a different length for every frame, so they are stored flattened with a count per frame
+            "ids_count": np.array([len(row[6]) for row in rows], dtype=np.int32),
+            "ids": np.array([marker_id for row in rows for marker_id in row[6]], dtype=np.int32),
+        }
+
+        # Another run may be writing to the same store, so the name is taken after the newest chunk on disk, and the
+        # chunk is never written over an existing one
+        while True:
+            chunk_path = os.path.join(self.path, f"chunk_{self._next_chunk_index():06d}.npz")
+            try:
+                with atomic_write(chunk_path, exclusive=True) as f:
+                    np.savez(f, **chunk)
+                break
+            except FileExistsError:
+                pass
+        self._chunk_paths.append(chunk_path)
+        self._buffer = []
+
+    def close(self):
+        """
+        Writes any buffered results
+        """
+        self.flush()
+
+    def _next_chunk_index(self):
+        # One after the highest chunk number in the folder, so a deleted chunk's number is never reused for a chunk
+        # written before it
+        indices = [-1]
+        for chunk_path in glob.glob(os.path.join(self.path, "chunk_*.npz")):
+            name = os.path.splitext(os.path.basename(chunk_path))[0]
+            if name[len("chunk_"):].isdigit():
+                indices.append(int(name[len("chunk_"):]))
+        return max(indices) + 1
+
+    def load(self):
+        """
+        Loads every result in the store. If a frame was stored more than once only the newest result is kept.
+        :return: A dictionary of arrays with one row per frame (see FIELDS), with the ids as a list of arrays
+        """
+        self.flush()
+        chunks = []
+        for chunk_path in self._chunk_paths:
+            with np.load(chunk_path) as chunk:
+                chunks.append({field: chunk[field] for field in FIELDS})
+        if not chunks:
+            return {"names": np.array([], dtype=str), "status": np.array([], dtype=np.int8),
+                    "timestamp": np.zeros(0), "tvec": np.zeros((0, 3)), "pvec": np.zeros((0, 3)),
+                    "rmat": np.zeros((0, 3, 3)), "ids": []}
+
+        results = {field: np.concatenate([chunk[field] for chunk in chunks]) for field in FIELDS}
+        ids = np.split(results.pop("ids"), np.cumsum(results.pop("ids_count"))[:-1])
+
+        # Keep the last row for each name (reruns of failed frames are appended after the original)
+        _, last = np.unique(results["names"][::-1], return_index=True)
+        keep = np.sort(len(results["names"]) - 1 - last)
+        results = {field: values[keep] for field, values in results.items()}
+        results["ids"] = [ids[i] for i in keep]
+        return results
+
+    def export_mat(self, path):
+        """
+        Exports the results to a mat file in the same format as the cli tracker's results.mat, with the frames sorted
+        by name (frames without a pose are NaN)
+        :param path: The path of the mat file to write
+        """
+        results = self.load()
+        order = np.argsort(results["names"], kind="stable")
+        tvecs = results["tvec"][order]
+        pvecs = results["pvec"][order]
+        rmats = results["rmat"][order]
+        savemat(path, {
+            "tvec": tvecs.T,
+            "pvec": pvecs.T,
+            # The direction the camera is pointing in world coordinates, rot_m.T @ [0, 0, 1]
+            "d": rmats[:, 2, :].reshape(-1, 3, 1),
+            "rmat": rmats,
+            "names": results["names"][order],
+            "status": results["status"][order],
+            "timestamp": results["timestamp"][order],
+        })
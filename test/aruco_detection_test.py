@@ -5,18 +5,15 @@ import glob
 import pytest
 import os
 
-aruco_dict = aruco.getPredefinedDictionary(aruco.DICT_4X4_1000)
-aruco_param = aruco.DetectorParameters_create()
-aruco_param.adaptiveThreshWinSizeMax = 100
-aruco_param.adaptiveThreshWinSizeMin = 16
-aruco_param.perspectiveRemovePixelPerCell = 15
-aruco_param.perspectiveRemoveIgnoredMarginPerCell = 0.2
+# Test the same dictionary and parameters the trackers use (--detector-params replaces the parameters)
+from tracking_util import aruco_dict, aruco_param
 
 
-def test_for_markers(valid_id, path):
-    color_img = cv.imread(path, cv.IMREAD_COLOR)
-    greyscale_img = cv.cvtColor(color_img, cv.COLOR_RGB2GRAY)
-    bounding_boxes, ids, rejected = aruco.detectMarkers(greyscale_img, aruco_dict, parameters=aruco_param)
+def test_for_markers(valid_id, path, detection_cache, image_loader):
+    # The loaded image is shared between the tests, so draw on a copy
+    color_img = image_loader.get(path).copy()
+    greyscale_img = cv.cvtColor(color_img, cv.COLOR_BGR2GRAY)
+    bounding_boxes, ids, rejected = detection_cache.detect(greyscale_img, aruco_dict, aruco_param)
     aruco.drawDetectedMarkers(color_img, bounding_boxes)
     if ids is None:
         ids = []
@@ -25,10 +22,11 @@ def test_for_markers(valid_id, path):
     assert valid_id in ids
 
 
-def test_for_false_markers(valid_ids, path):
-    color_img = cv.imread(path, cv.IMREAD_COLOR)
-    greyscale_img = cv.cvtColor(color_img, cv.COLOR_RGB2GRAY)
-    bounding_boxes, ids, rejected = aruco.detectMarkers(greyscale_img, aruco_dict, parameters=aruco_param)
+def test_for_false_markers(valid_ids, path, detection_cache, image_loader):
+    # The loaded image is shared between the tests, so draw on a copy
+    color_img = image_loader.get(path).copy()
+    greyscale_img = cv.cvtColor(color_img, cv.COLOR_BGR2GRAY)
+    bounding_boxes, ids, rejected = detection_cache.detect(greyscale_img, aruco_dict, aruco_param)
     aruco.drawDetectedMarkers(color_img, bounding_boxes)
     if ids is None:
         ids = []
@@ -46,10 +44,11 @@ def test_for_false_markers(valid_ids, path):
     assert extra_ids == list()
 
 
-def test_for_any_valid_ids(valid_ids, path):
-    color_img = cv.imread(path, cv.IMREAD_COLOR)
-    greyscale_img = cv.cvtColor(color_img, cv.COLOR_RGB2GRAY)
-    bounding_boxes, ids, rejected = aruco.detectMarkers(greyscale_img, aruco_dict, parameters=aruco_param)
+def test_for_any_valid_ids(valid_ids, path, detection_cache, image_loader):
+    # The loaded image is shared between the tests, so draw on a copy
+    color_img = image_loader.get(path).copy()
+    greyscale_img = cv.cvtColor(color_img, cv.COLOR_BGR2GRAY)
+    bounding_boxes, ids, rejected = detection_cache.detect(greyscale_img, aruco_dict, aruco_param)
     aruco.drawDetectedMarkers(color_img, bounding_boxes)
     if ids is None:
         ids = []
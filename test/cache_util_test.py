@@ -0,0 +1,72 @@
+import threading
+
+import cv2 as cv
+import cv2.aruco as aruco
+import numpy as np
+
+from cache_util import DetectionCache
+from tracking_util import aruco_dict, aruco_param, find_markers
+
+
+def marker_image(marker_id=3):
+    image = np.full((400, 600), 255, dtype=np.uint8)
+    image[100:300, 200:400] = aruco.drawMarker(aruco_dict, marker_id, 200)
+    return image
+
+
+def test_detect_is_cached_in_memory():
+    cache = DetectionCache()
+    image = marker_image()
+    boxes, ids, _ = cache.detect(image, aruco_dict, aruco_param)
+    assert list(ids.reshape(-1)) == [3] and (cache.hits, cache.misses) == (0, 1)
+    cached_boxes, cached_ids, _ = cache.detect(image.copy(), aruco_dict, aruco_param)
+    assert cached_ids is ids and cached_boxes is boxes and cache.hits == 1
+    # A different image or different parameters are detected again
+    cache.detect(marker_image(4), aruco_dict, aruco_param)
+    params = aruco.DetectorParameters_create()
+    cache.detect(image, aruco_dict, params)
+    assert cache.misses == 3
+
+
+def test_detect_is_cached_on_disk(tmp_path):
+    image = marker_image()
+    first = DetectionCache(str(tmp_path)).detect(image, aruco_dict, aruco_param)
+    blank = np.full_like(image, 255)
+    assert DetectionCache(str(tmp_path)).detect(blank, aruco_dict, aruco_param)[1] is None
+
+    cache = DetectionCache(str(tmp_path))
+    boxes, ids, rejected = cache.detect(image, aruco_dict, aruco_param)
+    assert cache.hits == 1
+    assert np.array_equal(ids, first[1]) and np.array_equal(boxes[0], first[0][0])
+    assert len(rejected) == len(first[2])
+    assert cache.detect(blank, aruco_dict, aruco_param)[1] is None and cache.hits == 2
+
+
+def test_find_markers_uses_cache():
+    cache = DetectionCache()
+    image = cv.resize(marker_image(), None, fx=2, fy=2, interpolation=cv.INTER_NEAREST)
+    full = find_markers(image, 1, cache)
+    coarse = find_markers(image, 0.5, cache)
+    assert cache.misses == 2
+    assert find_markers(image, 0.5, cache)[0] is coarse[0] and cache.hits == 1
+    assert np.abs(full[0][0] - coarse[0][0]).max() < 1
+
+
+def test_counts_are_thread_safe():
+    cache = DetectionCache()
+    image = marker_image()
+    key = cache.key(image, aruco_dict, aruco_param)
+    cache.put(key, aruco.detectMarkers(image, aruco_dict, parameters=aruco_param))
+    missing = cache.key(marker_image(4), aruco_dict, aruco_param)
+
+    def lookup():
+        for _ in range(2000):
+            cache.get(key)
+            cache.get(missing)
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert (cache.hits, cache.misses) == (8000, 8000)
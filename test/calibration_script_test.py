@@ -0,0 +1,144 @@
+import os.path
+
+import cv2
+import numpy as np
+import pytest
+
+from calibration_data import calibration_script
+from calibration_data.calibration_script import CHECKERBOARD, find_corners, detect_all, view_errors, calibrate, \
+    load_cached_corners, save_cached_corners
+
+
+def board_image(path, square=40, margin=60):
+    """
+    Draws a chess board with CHECKERBOARD inner corners and saves it, returning the true corner positions
+    """
+    cols, rows = CHECKERBOARD[0] + 1, CHECKERBOARD[1] + 1
+    image = np.full((rows * square + 2 * margin, cols * square + 2 * margin), 255, dtype=np.uint8)
+    for row in range(rows):
+        for col in range(cols):
+            if (row + col) % 2 == 0:
+                y, x = margin + row * square, margin + col * square
+                image[y:y + square, x:x + square] = 0
+    cv2.imwrite(str(path), image)
+    # Pixel edges are at integer coordinates, so the corner between four squares is half a pixel up and left of it
+    grid = np.mgrid[1:cols, 1:rows].T.reshape(-1, 2)
+    return margin + grid * square - 0.5
+
+
+def test_find_corners_downscaled(tmp_path):
+    path = tmp_path / "board.png"
+    expected = board_image(path)
+    found, corners, size = find_corners(str(path))
+    assert found and size == (8 * 40 + 120, 10 * 40 + 120)
+    found_small, small_corners, _ = find_corners(str(path), downscale=0.5)
+    assert found_small
+    # The corners found on the downscaled image are mapped back and refined at full resolution
+    assert np.abs(np.sort(small_corners.reshape(-1, 2), axis=0) - np.sort(corners.reshape(-1, 2), axis=0)).max() < 0.1
+    assert np.abs(np.sort(corners.reshape(-1, 2), axis=0) - np.sort(expected, axis=0)).max() < 0.5
+    cv2.imwrite(str(tmp_path / "blank.png"), np.full((480, 640), 255, dtype=np.uint8))
+    assert find_corners(str(tmp_path / "blank.png"), downscale=0.5) == (False, None, (640, 480))
+    assert find_corners(str(tmp_path / "missing.png")) == (False, None, None)
+
+
+def test_detect_all_uses_cache(tmp_path, monkeypatch):
+    names = []
+    for i in range(3):
+        path = tmp_path / f"board_{i}.png"
+        board_image(path, margin=60 + 10 * i)
+        names.append(str(path))
+    cv2.imwrite(str(tmp_path / "blank.png"), np.full((480, 640), 255, dtype=np.uint8))
+    names.append(str(tmp_path / "blank.png"))
+    cache_dir = str(tmp_path / "cache")
+    first = detect_all(names, cache_dir=cache_dir)
+    assert [found for found, _, _ in first] == [True, True, True, False]
+
+    # The second run is served from the cache without searching any image
+    def fail(*args, **kwargs):
+        raise AssertionError("searched a cached image")
+
+    monkeypatch.setattr(calibration_script, "find_corners", fail)
+    second = detect_all(names, cache_dir=cache_dir)
+    for (found, corners, size), (cached_found, cached_corners, cached_size) in zip(first, second):
+        assert found == cached_found and size == cached_size
+        assert (corners is None and cached_corners is None) or np.array_equal(corners, cached_corners)
+
+    # Changing an image or the settings searches again
+    board_image(tmp_path / "board_0.png", margin=100)
+    with pytest.raises(AssertionError):
+        detect_all(names, cache_dir=cache_dir)
+    with pytest.raises(AssertionError):
+        detect_all(names[1:], downscale=0.5, cache_dir=cache_dir)
+
+
+
+def test_interrupted_cache_write_leaves_no_entry(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    result = True, np.zeros((CHECKERBOARD[0] * CHECKERBOARD[1], 1, 2), dtype=np.float32), (640, 480)
+    save_cached_corners(cache_dir, "good", result)
+
+    def interrupted(f, **arrays):
+        f.write(b"PK")
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(calibration_script.np, "savez", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        save_cached_corners(cache_dir, "partial", result)
+    # The half written entry is never seen, and the temporary file is cleaned up
+    assert load_cached_corners(cache_dir, "partial") is None
+    assert sorted(os.listdir(cache_dir)) == ["good.npz"]
+    found, corners, size = load_cached_corners(cache_dir, "good")
+    assert found and np.array_equal(corners, result[1]) and size == (640, 480)
+
+
+camera_matrix = np.array([[800, 0, 320], [0, 800, 240], [0, 0, 1]], dtype=np.float64)
+distortion_coefficients = np.array([-0.2, 0.05, 0.001, -0.001, 0])
+
+
+def synthetic_views(count=10, noise=0.1, seed=0):
+    """
+    Projects the board from different poses with the test camera, adding noise to the image corners
+    """
+    rng = np.random.default_rng(seed)
+    board = np.zeros((CHECKERBOARD[0] * CHECKERBOARD[1], 3), np.float32)
+    board[:, :2] = np.mgrid[0:CHECKERBOARD[0], 0:CHECKERBOARD[1]].T.reshape(-1, 2)
+    objpoints, imgpoints, rvecs, tvecs = [], [], [], []
+    for _ in range(count):
+        rvec = rng.uniform(-0.4, 0.4, 3)
+        tvec = np.array([-3, -4, 0]) + rng.uniform([-1, -1, 14], [1, 1, 20])
+        points, _ = cv2.projectPoints(board, rvec, tvec, camera_matrix, distortion_coefficients)
+        points += rng.normal(scale=noise, size=points.shape)
+        objpoints.append(board.reshape(1, -1, 3))
+        imgpoints.append(points.astype(np.float32))
+        rvecs.append(rvec.reshape(3, 1))
+        tvecs.append(tvec.reshape(3, 1))
+    return objpoints, imgpoints, rvecs, tvecs
+
+
+def test_view_errors_match_project_points():
+    objpoints, imgpoints, rvecs, tvecs = synthetic_views(noise=0.5)
+    errors, mean_error = view_errors(objpoints, imgpoints, rvecs, tvecs, camera_matrix, distortion_coefficients)
+    expected = []
+    total = 0
+    for points, corners, rvec, tvec in zip(objpoints, imgpoints, rvecs, tvecs):
+        projected, _ = cv2.projectPoints(points, rvec, tvec, camera_matrix, distortion_coefficients)
+        residual = corners.reshape(-1, 2) - projected.reshape(-1, 2)
+        expected.append(np.sqrt(np.mean(np.sum(residual ** 2, axis=1))))
+        # The error the script printed before, the L2 norm of the residuals divided by the number of corners
+        total += cv2.norm(corners, projected.astype(np.float32), cv2.NORM_L2) / len(projected)
+    assert np.allclose(errors, expected, rtol=1e-5)
+    assert mean_error == pytest.approx(total / len(objpoints), rel=1e-5)
+
+
+def test_calibrate_prunes_outlier_view():
+    objpoints, imgpoints, _, _ = synthetic_views(count=10)
+    # Shift part of one view's corners, as if the board was detected wrong
+    imgpoints[4] = imgpoints[4].copy()
+    imgpoints[4][:20] += 8
+    _, _, _, _, errors, _, kept = calibrate(objpoints, imgpoints, (640, 480))
+    assert len(kept) == 10 and np.argmax(errors) == 4
+
+    camera_mtx, _, _, _, errors, mean_error, kept = calibrate(objpoints, imgpoints, (640, 480), max_view_error=1)
+    assert 4 not in kept and len(kept) == 9
+    assert errors.max() < 1
+    assert np.allclose(camera_mtx, camera_matrix, rtol=0.02, atol=2)
@@ -0,0 +1,100 @@
+import csv
+import functools
+import json
+import multiprocessing
+import os.path
+import shutil
+import subprocess
+import sys
+
+import cv2 as cv
+import cv2.aruco as aruco
+import numpy as np
+
+from cli_tracker import bounded_imap, iter_images, iter_video, track_item, LOAD_FAILED, NO_MARKERS
+from tracking_util import aruco_dict, load_layout
+
+repo = os.path.join(os.path.dirname(__file__), "..")
+cal_path = os.path.join(repo, "calibration_data", "camera_cal.npz")
+
+
+def marker_frame(offset):
+    """
+    Draws two markers on a white 640x480 frame, moved right by offset pixels
+    """
+    image = np.full((480, 640, 3), 255, dtype=np.uint8)
+    for marker_id, x in ((0, 100), (1, 300)):
+        image[140:300, x + offset:x + offset + 160] = aruco.drawMarker(aruco_dict, marker_id, 160)[..., None]
+    return image
+
+
+def write_layout(tmp_path):
+    path = str(tmp_path / "marker_layout.json")
+    with open(path, "w") as f:
+        json.dump([{"id": 0, "size": 10, "x": 0, "y": 0}, {"id": 1, "size": 10, "x": 12.5, "y": 0}], f)
+    return path
+
+
+def test_bounded_imap_keeps_order(tmp_path):
+    marker_layout, _ = load_layout(write_layout(tmp_path))
+    paths = []
+    for i in range(8):
+        path = str(tmp_path / f"img_{i}.png")
+        # A blank frame, and a file that isn't an image, in among the frames with markers
+        if i == 3:
+            with open(path, "w") as f:
+                f.write("not an image")
+        else:
+            cv.imwrite(path, marker_frame(10 * i) if i != 5 else np.full((480, 640, 3), 255, dtype=np.uint8))
+        paths.append(path)
+
+    track = functools.partial(track_item, cal_path=cal_path, marker_layout=marker_layout)
+    expected = list(map(track, iter_images(paths)))
+    with multiprocessing.Pool(2) as pool:
+        results = list(bounded_imap(pool, track, iter_images(paths), 3))
+
+    assert [name for name, _, _ in results] == [os.path.basename(path) for path in paths]
+    assert [result[0] for _, _, result in results] == \
+        [None, None, None, LOAD_FAILED, None, NO_MARKERS, None, None]
+    for (_, _, result), (_, _, single) in zip(results, expected):
+        assert result[0] == single[0]
+        if result[0] is None:
+            assert np.allclose(result[2], single[2]) and list(result[3]) == list(single[3])
+
+
+def write_video(path, frames, fps=10):
+    video = cv.VideoWriter(path, cv.VideoWriter_fourcc(*"MJPG"), fps, (640, 480))
+    for frame in frames:
+        video.write(frame)
+    video.release()
+
+
+def test_iter_video(tmp_path):
+    path = str(tmp_path / "clip.avi")
+    write_video(path, [marker_frame(10 * i) for i in range(5)])
+    items = list(iter_video(path))
+    assert [name for name, _, _ in items] == [f"clip.avi:{i:06d}" for i in range(5)]
+    # The frames are timed from the video, not by when they were read
+    assert np.allclose([timestamp for _, timestamp, _ in items], np.arange(5) / 10)
+    assert all(frame.shape == (480, 640, 3) for _, _, frame in items)
+    assert list(iter_video(str(tmp_path / "missing.avi"))) == []
+
+
+def test_video_is_streamed(tmp_path):
+    video_path = str(tmp_path / "clip.avi")
+    frames = [marker_frame(10 * i) for i in range(4)]
+    frames.insert(2, np.full((480, 640, 3), 255, dtype=np.uint8))
+    write_video(video_path, frames)
+    write_layout(tmp_path)
+    shutil.copyfile(cal_path, str(tmp_path / "camera_cal.npz"))
+    out_path = str(tmp_path / "poses.csv")
+    subprocess.run([sys.executable, os.path.join(repo, "cli_tracker.py"), "-s", video_path, "--out", out_path],
+                   cwd=str(tmp_path), check=True, capture_output=True)
+
+    with open(out_path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["name"] for row in rows] == [f"clip.avi:{i:06d}" for i in range(5)]
+    assert [row["status"] for row in rows] == ["ok", "ok", NO_MARKERS, "ok", "ok"]
+    assert [float(row["timestamp"]) for row in rows] == [0, 0.1, 0.2, 0.3, 0.4]
+    assert sorted(rows[0]["ids"].split()) == ["0", "1"]
+    assert float(rows[0]["tz"]) > 0 and rows[2]["tz"] == ""
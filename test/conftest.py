@@ -1,25 +1,60 @@
 import glob
 import os.path
+import sys
 
 import pytest
 
+# Let the tests import the tracking modules from the top level of the repo
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
 
 def pytest_addoption(parser):
     parser.addoption("--src", action="store", help="Source folder of test images")
     parser.addoption("--ids", action="store", help="Expected ids", nargs="*", type=int)
+    parser.addoption("--detection-cache", action="store",
+                     help="Folder to cache the detected markers in between runs (they are always cached in memory)")
+    parser.addoption("--detector-params", action="store", help="Detector parameters json file from tune_detector.py")
+
+
+def pytest_configure(config):
+    if config.option.detector_params is not None:
+        from tracking_util import load_detector_params
+        load_detector_params(config.option.detector_params)
+
+
+@pytest.fixture(scope="session")
+def detection_cache(request):
+    # Every test and valid_id runs on the same images, so each image only needs to be detected once
+    from cache_util import DetectionCache
+    return DetectionCache(request.config.option.detection_cache, max_entries=4096)
+
+
+def image_paths(config):
+    # Without a source folder the image tests get an empty parameter set and are skipped
+    source = config.option.src
+    if source is None:
+        return []
+    return glob.glob(os.path.join(source, "*.jpg")) + glob.glob(os.path.join(source, "*.png"))
+
+
+@pytest.fixture(scope="session")
+def image_loader(request):
+    # The tests run through the images in the same order, so the next few are decoded while one is being tested
+    from loader_util import ImageLoader
+    with ImageLoader(image_paths(request.config)) as loader:
+        yield loader
 
 
 def pytest_generate_tests(metafunc):
     # This is called for every test. Only get/set command line arguments
     # if the argument is specified in the list of test "fixturenames".
-    source = metafunc.config.option.src
     ids = metafunc.config.option.ids
-    option_value = metafunc.config.option.src
-    img_paths = glob.glob(os.path.join(source, "*.jpg"))
-    img_paths += glob.glob(os.path.join(source, "*.png"))
-    if 'path' in metafunc.fixturenames and option_value is not None:
+    img_paths = image_paths(metafunc.config)
+    if ids is None:
+        ids = []
+    if 'path' in metafunc.fixturenames:
         metafunc.parametrize("path", img_paths)
-    if 'valid_id' in metafunc.fixturenames and option_value is not None:
+    if 'valid_id' in metafunc.fixturenames:
         metafunc.parametrize("valid_id", ids)
-    if 'valid_ids' in metafunc.fixturenames and option_value is not None:
+    if 'valid_ids' in metafunc.fixturenames:
         metafunc.parametrize("valid_ids", [ids])
@@ -0,0 +1,31 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from drawing_util import encode_image
+
+
+def make_image():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("image_format, png_compression", [("ppm", 1), ("png", 0), ("png", 1), ("png", 9)])
+def test_encode_image_round_trip(image_format, png_compression):
+    img = make_image()
+    data = encode_image(img, image_format, png_compression)
+    assert isinstance(data, bytes)
+    # Both formats are lossless, so the decoded image is the same as the original
+    decoded = cv.imdecode(np.frombuffer(data, np.uint8), cv.IMREAD_COLOR)
+    assert np.array_equal(decoded, img)
+
+
+def test_encode_image_format_headers():
+    img = make_image()
+    assert encode_image(img, "ppm").startswith(b"P6")
+    assert encode_image(img, "png").startswith(b"\x89PNG")
+
+
+def test_encode_image_unknown_format():
+    with pytest.raises(ValueError):
+        encode_image(make_image(), "jpg")
@@ -0,0 +1,25 @@
+import pytest
+
+from file_util import atomic_write
+
+
+def test_atomic_write(tmp_path):
+    path = tmp_path / "data.json"
+    with atomic_write(str(path), "w") as f:
+        f.write("first")
+        assert not path.exists()
+    with atomic_write(str(path), "w") as f:
+        f.write("second")
+    assert path.read_text() == "second"
+
+    # A failed write leaves the old file alone and cleans up after itself
+    with pytest.raises(RuntimeError):
+        with atomic_write(str(path), "w") as f:
+            f.write("partial")
+            raise RuntimeError()
+    assert path.read_text() == "second"
+    with pytest.raises(FileExistsError):
+        with atomic_write(str(path), "w", exclusive=True) as f:
+            f.write("third")
+    assert path.read_text() == "second"
+    assert [p.name for p in tmp_path.iterdir()] == ["data.json"]
@@ -0,0 +1,34 @@
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("PySimpleGUI")
+
+import pipeline_util
+from gui_tracker import capture_loop
+from pipeline_util import DropOldestQueue, StageStats
+
+
+class FlakyCamera:
+    def __init__(self, frames):
+        self.frames = frames
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        if self.reads <= self.frames:
+            return True, np.zeros((4, 4, 3), dtype=np.uint8)
+        return False, None
+
+
+def test_capture_loop_stops_after_failed_reads(monkeypatch):
+    monkeypatch.setattr(pipeline_util, "READ_RETRY_DELAY", 0.001)
+    monkeypatch.setattr(pipeline_util, "MAX_READ_RETRY_DELAY", 0.001)
+    cam = FlakyCamera(2)
+    frames = DropOldestQueue(2)
+    stop = threading.Event()
+    capture_loop(cam, frames, StageStats(), stop)
+    # Both frames are captured, then the loop gives up and stops the other stages
+    assert stop.is_set() and cam.reads == 2 + pipeline_util.MAX_READ_FAILURES
+    assert frames.get_nowait()[2] is None and frames.get_nowait()[2] is None
@@ -0,0 +1,53 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from loader_util import ImageLoader, read_image, prefetch_items
+
+
+def write_images(tmp_path, n=6):
+    paths = []
+    for i in range(n):
+        image = np.zeros((64, 96, 3), dtype=np.uint8)
+        image[:, :, i % 3] = 40 * i
+        path = str(tmp_path / f"img_{i}.png")
+        cv.imwrite(path, image)
+        paths.append(path)
+    return paths
+
+
+def test_read_image(tmp_path):
+    path = write_images(tmp_path, 1)[0]
+    assert read_image(path).shape == (64, 96, 3)
+    assert read_image(path, gray=True, reduced=2).shape == (32, 48)
+    assert read_image(str(tmp_path / "missing.png")) is None
+    with pytest.raises(ValueError):
+        read_image(path, reduced=3)
+
+
+def test_image_loader_prefetches_in_order(tmp_path):
+    paths = write_images(tmp_path)
+    with ImageLoader(paths, depth=2) as loader:
+        for path, image in loader:
+            assert np.array_equal(image, cv.imread(path, cv.IMREAD_COLOR))
+            # Only the current image and the next two are kept
+            assert len(loader._futures) <= 3
+        # Going back to an earlier image decodes it again
+        assert np.array_equal(loader.get(paths[0]), cv.imread(paths[0], cv.IMREAD_COLOR))
+        assert sorted(loader._futures) == [0, 1, 2]
+        assert loader.get(str(tmp_path / "missing.png")) is None
+
+
+def test_prefetch_items(tmp_path):
+    paths = write_images(tmp_path)
+    frame = np.zeros((8, 8, 3), dtype=np.uint8)
+    items = [(f"{i}", i / 30, path) for i, path in enumerate(paths)] + [("frame", 1.0, frame)]
+    results = list(prefetch_items(iter(items), depth=2, gray=True))
+    assert [name for name, _, _ in results] == [name for name, _, _ in items]
+    for (_, _, path), (_, _, image) in zip(items[:-1], results):
+        assert np.array_equal(image, cv.imread(path, cv.IMREAD_GRAYSCALE))
+    assert results[-1][2] is frame
+    # Stopping early doesn't decode the rest
+    generator = prefetch_items(iter(items), depth=2)
+    next(generator)
+    generator.close()
@@ -0,0 +1,34 @@
+import json
+
+from metrics_util import Metrics, PeriodicDump
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    metrics.add_time("detect", 0.01)
+    metrics.count("frames")
+    metrics.observe("markers_found", 3)
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {} and snapshot["timers_ms"] == {} and snapshot["histograms"] == {}
+
+
+def test_snapshot_and_dump(tmp_path):
+    metrics = Metrics(window=4, enabled=True)
+    for i in range(6):
+        metrics.add_time("detect", 0.001 * (i + 1))
+        metrics.count("frames")
+        metrics.observe("markers_found", i % 2)
+    metrics.count("misses", 2)
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {"frames": 6, "misses": 2}
+    # Only the last window values are kept
+    assert snapshot["timers_ms"]["detect"]["count"] == 4
+    assert abs(snapshot["timers_ms"]["detect"]["min"] - 3) < 1e-9
+    assert snapshot["histograms"]["markers_found"]["bins"]["counts"] == [2, 2]
+
+    path = str(tmp_path / "metrics.json")
+    PeriodicDump(metrics, path, interval=0, log=None).tick()
+    with open(path) as f:
+        assert json.load(f)["counters"]["frames"] == 6
+    metrics.reset()
+    assert metrics.snapshot()["counters"] == {}
@@ -0,0 +1,53 @@
+import threading
+
+import multi_tracker
+import pipeline_util
+from multi_tracker import collect_live, camera_loop
+from pipeline_util import DropOldestQueue, StageStats
+
+
+def test_collect_live_keeps_poses_until_stale():
+    queues = [DropOldestQueue(1), DropOldestQueue(1)]
+    latest = [None, None]
+    ended = [False, False]
+    queues[0].put((1.0, "a"))
+    queues[1].put((1.02, "b"))
+    assert collect_live(queues, latest, ended, 0.1, timeout=0) == [(1.0, "a"), (1.02, "b")]
+    # Nothing new, so nothing to fuse
+    assert collect_live(queues, latest, ended, 0.1, timeout=0) is None
+    # The second camera's last pose is reused while it is recent enough
+    queues[0].put((1.05, "c"))
+    assert collect_live(queues, latest, ended, 0.1, timeout=0) == [(1.05, "c"), (1.02, "b")]
+    queues[0].put((1.2, "d"))
+    queues[1].put(None)
+    assert collect_live(queues, latest, ended, 0.1, timeout=0) == [(1.2, "d"), None]
+    assert ended == [False, True]
+
+
+class UnpluggedCamera:
+    def __init__(self):
+        self.reads = 0
+        self.released = False
+
+    def isOpened(self):
+        return not self.released
+
+    def read(self):
+        self.reads += 1
+        return False, None
+
+    def release(self):
+        self.released = True
+
+
+def test_camera_loop_gives_up_on_failed_reads(monkeypatch):
+    cam = UnpluggedCamera()
+    monkeypatch.setattr(multi_tracker, "open_source", lambda source: cam)
+    monkeypatch.setattr(pipeline_util, "READ_RETRY_DELAY", 0.001)
+    monkeypatch.setattr(pipeline_util, "MAX_READ_RETRY_DELAY", 0.001)
+    camera = {"name": "unplugged", "source": 7}
+    results = DropOldestQueue(1)
+    camera_loop(camera, None, results, StageStats(), threading.Event())
+    # The camera is ended the same way as a finished video once it has failed too many times in a row
+    assert cam.reads == pipeline_util.MAX_READ_FAILURES and cam.released
+    assert results.get_nowait() is None
@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+
+import pytest
+
+import pipeline_util
+from pipeline_util import DropOldestQueue, StageStats, ResolutionGovernor, RateLimiter
+
+
+def test_drop_oldest_queue():
+    frames = DropOldestQueue(2)
+    for i in range(5):
+        frames.put(i)
+    # Only the newest two are kept
+    assert frames.dropped == 3
+    assert frames.get() == 3 and frames.get_nowait() == 4
+    with pytest.raises(queue.Empty):
+        frames.get_nowait()
+    start = time.perf_counter()
+    with pytest.raises(queue.Empty):
+        frames.get(timeout=0.05)
+    assert time.perf_counter() - start >= 0.04
+
+
+def test_drop_oldest_queue_wakes_consumer():
+    frames = DropOldestQueue(1)
+    timer = threading.Timer(0.05, frames.put, ("frame",))
+    timer.start()
+    assert frames.get(timeout=5) == "frame" and frames.dropped == 0
+    timer.join()
+
+
+def test_stage_stats(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(pipeline_util.time, "perf_counter", lambda: now[0])
+    stats = StageStats(window=3)
+    assert stats.fps == 0 and stats.latency == 0
+    for latency in (0.01, 0.02, 0.03, 0.04):
+        stats.add(latency)
+        now[0] += 0.1
+    # The window holds the last three items, finished 0.1 s apart
+    assert stats.fps == pytest.approx(10)
+    assert stats.latency == pytest.approx(0.03)
+    assert str(stats) == " 10.0 fps   30.0 ms"
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(4)
+    # The first call is always ready, then only once every 0.25 s
+    assert [limiter.ready(t) for t in (5.0, 5.125, 5.25, 5.375, 5.75)] == [True, False, True, False, True]
+    unlimited = RateLimiter(0)
+    assert all(unlimited.ready(5.0) for _ in range(3))
+
+
+def make_governor():
+    return ResolutionGovernor(scales=(1, 0.5), budget=0.05, min_marker_px=40, near_distance=10, far_distance=50,
+                              far_fps=10, smoothing=1, hold_frames=2)
+
+
+def test_governor_steps_down_when_slow():
+    governor = make_governor()
+    for _ in range(3):
+        governor.update(0.1, marker_px=200, distance=30)
+    assert governor.scale == 0.5 and governor.interval == 0
+    # Fast enough now, but not fast enough to expect the full resolution to hold the budget
+    for _ in range(5):
+        governor.update(0.02, marker_px=100, distance=30)
+    assert governor.scale == 0.5
+    for _ in range(3):
+        governor.update(0.01, marker_px=100, distance=30)
+    assert governor.scale == 1
+
+
+def test_governor_keeps_markers_big_enough():
+    governor = make_governor()
+    for _ in range(5):
+        governor.update(0.1, marker_px=60, distance=30)
+    assert governor.scale == 1
+    governor.scales = (0.5, 0.25)
+    governor.level = 1
+    governor.update(0.1, marker_px=30, distance=30)
+    assert governor.scale == 0.5
+
+
+def test_governor_uses_full_resolution_near_target_or_when_lost():
+    governor = make_governor()
+    for _ in range(3):
+        governor.update(0.1, marker_px=200, distance=100)
+    assert governor.scale == 0.5 and governor.interval == 0.1
+    governor.update(0.1, marker_px=200, distance=5)
+    assert governor.scale == 1 and governor.interval == 0
+    for _ in range(3):
+        governor.update(0.1, marker_px=200, distance=30)
+    assert governor.scale == 0.5
+    governor.update(0.1)
+    assert governor.scale == 1 and governor.interval == 0
+    assert str(governor) == "1.00x every frame 100.0 ms"
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from recording_util import Recorder, Recording, ReplaySource, iter_recording, is_recording, FRAMES_FILE
+
+
+def record(path, n=5):
+    frames = [np.full((4, 6, 3), i, dtype=np.uint8) for i in range(n)]
+    with Recorder(str(path), source="test") as recorder:
+        for i, frame in enumerate(frames):
+            assert recorder.write(frame, 10 + i / 30) == i
+        recorder.add_pose(1, (True, np.array([0.1, 0.2, 0.3]), np.array([[1.0], [2.0], [3.0]]), np.array([[4], [7]])))
+        recorder.add_pose(3, (False, None, None, None))
+        with pytest.raises(ValueError):
+            recorder.write(np.zeros((4, 7, 3), dtype=np.uint8))
+    return frames
+
+
+def test_recording_round_trip(tmp_path):
+    frames = record(tmp_path)
+    assert is_recording(str(tmp_path)) and not is_recording(str(tmp_path / "missing"))
+    recording = Recording(str(tmp_path))
+    assert len(recording) == 5 and recording.meta["source"] == "test"
+    assert isinstance(recording.frames, np.memmap) and np.array_equal(recording.frames, frames)
+    assert np.allclose(recording.timestamps, np.arange(5) / 30)
+    assert recording.cal_path is None and recording.layout_path is None
+
+    poses = recording.load_poses()
+    assert list(poses["frame"]) == [1, 3] and list(poses["found"]) == [True, False]
+    assert np.allclose(poses["tvec"][0], [1, 2, 3]) and np.allclose(poses["rvec"][0], [0.1, 0.2, 0.3])
+    assert np.isnan(poses["tvec"][1]).all()
+
+
+def test_recording_cut_short(tmp_path):
+    record(tmp_path)
+    # A crash part way through writing a frame leaves a partial frame at the end
+    with open(tmp_path / FRAMES_FILE, "ab") as f:
+        f.write(b"\0" * 10)
+    assert len(Recording(str(tmp_path))) == 5
+
+
+def test_replay_source(tmp_path):
+    frames = record(tmp_path, 3)
+    source = ReplaySource(str(tmp_path), realtime=False)
+    assert source.isOpened()
+    for frame in frames:
+        status, replayed = source.read()
+        assert status and np.array_equal(replayed, frame)
+    assert source.read() == (False, None)
+
+    looped = ReplaySource(str(tmp_path), realtime=False, loop=True)
+    assert [looped.read()[1][0, 0, 0] for _ in range(5)] == [0, 1, 2, 0, 1]
+
+    items = list(iter_recording(str(tmp_path)))
+    assert [name for name, _, _ in items] == [f"{tmp_path.name}:{i:06d}" for i in range(3)]
+    assert np.isclose(items[2][1], 2 / 30)
@@ -0,0 +1,80 @@
+import cv2 as cv
+import numpy as np
+from scipy.io import loadmat
+from scipy.spatial.transform import Rotation
+
+from result_util import ResultStore, pose_results, STATUS_OK, STATUS_NO_MARKERS, STATUS_LOAD_FAILED
+
+
+def test_store_round_trip(tmp_path):
+    rmat = np.eye(3)
+    with ResultStore(str(tmp_path), chunk_size=2) as store:
+        store.append("b.jpg", STATUS_OK, 0.1, np.array([1, 2, 3]), np.array([4, 5, 6]), rmat, np.array([0, 3]))
+        store.append("a.jpg", STATUS_NO_MARKERS, 0.0)
+        store.append("c.jpg", STATUS_LOAD_FAILED)
+    assert len(list(tmp_path.glob("chunk_*.npz"))) == 2
+
+    store = ResultStore(str(tmp_path))
+    assert "a.jpg" in store and "b.jpg" in store
+    # Frames that failed to load are retried on the next run, so they aren't counted as done
+    assert "c.jpg" not in store
+    assert len(store) == 2 and store.failed == 1
+
+    results = store.load()
+    assert list(results["names"]) == ["b.jpg", "a.jpg", "c.jpg"]
+    assert np.array_equal(results["tvec"][0], [1, 2, 3])
+    assert np.isnan(results["tvec"][1]).all()
+    assert [list(ids) for ids in results["ids"]] == [[0, 3], [], []]
+
+
+def test_store_keeps_newest_result(tmp_path):
+    with ResultStore(str(tmp_path)) as store:
+        store.append("a.jpg", STATUS_LOAD_FAILED)
+    with ResultStore(str(tmp_path)) as store:
+        assert len(store) == 0 and store.failed == 1
+        store.append("a.jpg", STATUS_OK, 0.0, np.ones(3), np.ones(3), np.eye(3), [1])
+        assert len(store) == 1 and store.failed == 0
+        results = store.load()
+    assert list(results["status"]) == [STATUS_OK]
+
+
+def test_store_export_mat(tmp_path):
+    mat_path = str(tmp_path / "results.mat")
+    with ResultStore(str(tmp_path / "store")) as store:
+        store.append("b.jpg", STATUS_OK, 0.0, np.array([1, 2, 3]), np.array([4, 5, 6]), np.eye(3), [1])
+        store.append("a.jpg", STATUS_NO_MARKERS)
+        store.export_mat(mat_path)
+    mat = loadmat(mat_path)
+    assert mat["tvec"].shape == (3, 2)
+    assert np.array_equal(mat["tvec"][:, 1], [1, 2, 3])
+    assert np.array_equal(mat["d"][1].reshape(-1), [0, 0, 1])
+
+
+def test_pose_results_match_single_frames():
+    rng = np.random.default_rng(0)
+    r_vecs = rng.normal(scale=0.5, size=(20, 3, 1))
+    t_vecs = rng.normal(scale=50, size=(20, 3, 1))
+    poses = pose_results(r_vecs, t_vecs)
+    for i in range(20):
+        rot_m, _ = cv.Rodrigues(r_vecs[i])
+        assert np.allclose(poses["rmat"][i], rot_m)
+        assert np.allclose(poses["pvec"][i], (rot_m.T @ t_vecs[i]).reshape(3))
+        assert np.allclose(poses["d"][i], (rot_m.T @ np.array([0, 0, 1]).reshape(3, 1)).reshape(3))
+        assert np.allclose(poses["euler"][i], Rotation.from_rotvec(r_vecs[i].reshape(3)).as_euler('zyx', degrees=True))
+        assert np.isclose(poses["distance"][i], np.linalg.norm(t_vecs[i]))
+    assert pose_results([], [])["pvec"].shape == (0, 3)
+
+
+def test_store_never_overwrites_chunks(tmp_path):
+    first = ResultStore(str(tmp_path), chunk_size=1)
+    second = ResultStore(str(tmp_path), chunk_size=1)
+    first.append("a.jpg", STATUS_NO_MARKERS)
+    # Both stores were opened on an empty folder, but the second one still writes a new chunk
+    second.append("b.jpg", STATUS_NO_MARKERS)
+    assert sorted(p.name for p in tmp_path.glob("chunk_*.npz")) == ["chunk_000000.npz", "chunk_000001.npz"]
+
+    # A deleted chunk's number isn't reused while newer chunks exist
+    (tmp_path / "chunk_000000.npz").unlink()
+    ResultStore(str(tmp_path), chunk_size=1).append("c.jpg", STATUS_NO_MARKERS)
+    assert sorted(p.name for p in tmp_path.glob("chunk_*.npz")) == ["chunk_000001.npz", "chunk_000002.npz"]
+    assert sorted(ResultStore(str(tmp_path)).load()["names"]) == ["b.jpg", "c.jpg"]
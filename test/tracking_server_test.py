@@ -0,0 +1,96 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+
+import pipeline_util
+import tracking_server
+from tracking_server import PoseServer, make_message, iter_camera
+
+
+def test_make_message_alignment():
+    result = True, np.zeros((3, 1)), np.array([[0.1], [-0.2], [30.0]]), np.array([[1], [4]])
+    message = make_message("frame", 1.5, result, np.array([[0.0], [0.0], [30.2]]), 0.01)
+    assert message["found"] and message["aligned"] and message["ids"] == [1, 4]
+    assert message["tvec"] == [0.1, -0.2, 30.0]
+    json.dumps(message)
+
+    message = make_message("frame", 1.5, result, np.array([[5.0], [0.0], [30.0]]), 0.01)
+    assert not message["aligned"] and not message["locks"]["xy_pos"] and message["locks"]["z_pos"]
+    assert make_message("frame", 2.0, (False, None, None, None), np.zeros((3, 1)), 0.01) == \
+        {"frame": "frame", "timestamp": 2.0, "latency": 0.01, "found": False}
+
+
+def test_pose_server_sends_latest_to_every_client():
+    async def run():
+        pose_server = PoseServer()
+        server = await asyncio.start_server(pose_server.handle_client, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            pose_server.publish({"frame": 0})
+            first = await asyncio.open_connection("127.0.0.1", port)
+            second = await asyncio.open_connection("127.0.0.1", port)
+            # New clients get the current message straight away
+            for reader, writer in (first, second):
+                assert json.loads(await reader.readline()) == {"frame": 0}
+
+            # Messages published before a client is sent the last one replace it, so clients skip to the newest
+            for frame in range(1, 4):
+                pose_server.publish({"frame": frame})
+            for reader, writer in (first, second):
+                assert json.loads(await reader.readline()) == {"frame": 3}
+
+            # A client disconnecting doesn't affect the others
+            first[1].close()
+            await asyncio.sleep(0.05)
+            assert len(pose_server) == 1
+            pose_server.publish({"frame": 4})
+            await pose_server.close()
+            assert json.loads(await second[0].readline()) == {"frame": 4}
+            assert await second[0].readline() == b""
+            second[1].close()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+
+
+class FailingCamera:
+    def __init__(self, *args, frames=2, frame_time=0.0):
+        self.frames = frames
+        self.frame_time = frame_time
+        self.reads = 0
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        self.reads += 1
+        # A number of frames then nothing but failures
+        if self.reads <= self.frames:
+            time.sleep(self.frame_time)
+            return True, np.zeros((4, 4, 3), dtype=np.uint8)
+        return False, None
+
+    def release(self):
+        pass
+
+
+def test_iter_camera_gives_up_after_failures(monkeypatch):
+    monkeypatch.setattr(tracking_server.cv, "VideoCapture", FailingCamera)
+    monkeypatch.setattr(pipeline_util, "READ_RETRY_DELAY", 0.001)
+    names = [name for name, _, _ in iter_camera(0, max_failures=5)]
+    # The first frame may be replaced by the second before it is taken, but the newest one is never dropped
+    assert names[-1] == "0:000001" and set(names) <= {"0:000000", "0:000001"}
+
+
+def test_iter_camera_skips_stale_frames(monkeypatch):
+    monkeypatch.setattr(tracking_server.cv, "VideoCapture",
+                        lambda *args: FailingCamera(frames=20, frame_time=0.005))
+    monkeypatch.setattr(pipeline_util, "READ_RETRY_DELAY", 0.001)
+    names = []
+    for name, _, _ in iter_camera(0, max_failures=5):
+        names.append(name)
+        # Tracking slower than the camera only gets the newest frames
+        time.sleep(0.03)
+    assert names[-1] == "0:000019" and len(names) < 20
+    assert names == sorted(names)
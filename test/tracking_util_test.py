@@ -0,0 +1,356 @@
+import json
+import os.path
+
+import cv2 as cv
+import cv2.aruco as aruco
+import numpy as np
+import pytest
+
+from metrics_util import metrics
+from tracking_util import load_cal_data, find_markers, filter_markers, solve_pose, world_pos_from_image, \
+    MarkerTracker, MarkerLayout, PoseTracker, aruco_dict, pose_covariance, transform_pose, fuse_poses, \
+    undistort_points, aruco_param, detector_params_to_dict, load_detector_params, _scaled_params, load_layout, \
+    compiled_layout_path, compile_layout
+
+cal_path = os.path.join(os.path.dirname(__file__), "..", "calibration_data", "camera_cal.npz")
+
+camera_mtx = np.array([[1400, 0, 960], [0, 1400, 540], [0, 0, 1]], dtype=np.float64)
+marker_layout = {i: [
+    [12 * (i % 3), 12 * (i // 3), 0],
+    [12 * (i % 3) + 9.5, 12 * (i // 3), 0],
+    [12 * (i % 3) + 9.5, 12 * (i // 3) + 9.5, 0],
+    [12 * (i % 3), 12 * (i // 3) + 9.5, 0],
+] for i in range(6)}
+
+
+def render_markers(r_vec, t_vec, dim=(1920, 1080)):
+    """
+    Renders the test marker layout seen from a pose onto a white greyscale image
+    """
+    image = np.full(dim[::-1], 255, dtype=np.uint8)
+    for marker_id, corners in marker_layout.items():
+        # Draw the marker with a white quiet zone around it
+        marker = cv.copyMakeBorder(aruco.drawMarker(aruco_dict, marker_id, 120), 10, 10, 10, 10,
+                                   cv.BORDER_CONSTANT, value=255)
+        corners = np.array(corners, dtype=np.float32)
+        border = (corners[2] - corners[0]) * 10 / 120
+        corners += np.array([-border, [border[0], -border[1], 0], border, [-border[0], border[1], 0]])
+        image_corners, _ = cv.projectPoints(corners, r_vec, t_vec, camera_mtx, (0, 0, 0, 0))
+        transform = cv.getPerspectiveTransform(np.float32([[0, 0], [140, 0], [140, 140], [0, 140]]),
+                                               image_corners.reshape(4, 2).astype(np.float32))
+        warped = cv.warpPerspective(marker, transform, dim, borderValue=255)
+        mask = cv.warpPerspective(np.full_like(marker, 255), transform, dim)
+        image[mask > 0] = warped[mask > 0]
+    return image
+
+
+def test_cal_data_is_cached():
+    first = load_cal_data(cal_path, (1920, 1080))
+    second = load_cal_data(cal_path, [1920, 1080])
+    assert all(a is b for a, b in zip(first, second))
+
+
+def test_cal_data_per_resolution():
+    _, full_mtx, _, full_mapx, _ = load_cal_data(cal_path, (1920, 1080))
+    _, half_mtx, _, half_mapx, _ = load_cal_data(cal_path, (960, 540))
+    assert full_mapx.shape[:2] == (1080, 1920)
+    assert half_mapx.shape[:2] == (540, 960)
+    assert not np.array_equal(full_mtx, half_mtx)
+
+
+def test_cal_data_reduced():
+    _, full_mtx, _, _, _ = load_cal_data(cal_path, (1920, 1080))
+    _, reduced_mtx, _, mapx, _ = load_cal_data(cal_path, (960, 540), reduced=2)
+    assert mapx.shape[:2] == (540, 960)
+    assert np.allclose(reduced_mtx[:2, :2], full_mtx[:2, :2] / 2, rtol=1e-3)
+    assert np.allclose(reduced_mtx[:2, 2], (full_mtx[:2, 2] + 0.5) / 2 - 0.5, atol=1)
+
+
+def test_cal_data_out_dim():
+    _, full_mtx, _, _, _ = load_cal_data(cal_path, (1920, 1080))
+    _, half_mtx, _, mapx, mapy = load_cal_data(cal_path, (1920, 1080), out_dim=(960, 540))
+    assert mapx.shape[:2] == (540, 960) and mapy.shape == (540, 960)
+    assert np.allclose(half_mtx[:2, :2], full_mtx[:2, :2] / 2, rtol=1e-2)
+    image = np.zeros((1080, 1920), dtype=np.uint8)
+    assert cv.remap(image, mapx, mapy, cv.INTER_LINEAR).shape == (540, 960)
+
+
+def test_cal_data_fixed_point_maps():
+    _, _, _, mapx, mapy = load_cal_data(cal_path, (640, 480))
+    assert mapx.dtype == np.int16 and mapx.shape == (480, 640, 2)
+    assert mapy.dtype == np.uint16 and mapy.shape == (480, 640)
+    image = np.random.default_rng(0).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+    assert cv.remap(image, mapx, mapy, cv.INTER_LINEAR).shape == image.shape
+
+
+def test_filter_markers_drops_unknown_ids():
+    layout = MarkerLayout(marker_layout)
+    assert layout.corners.shape == (250, 4, 3) and layout.valid.sum() == 6
+    boxes = tuple(np.full((1, 4, 2), i, dtype=np.float32) for i in range(4))
+    ids = np.array([[3], [200], [0], [7]], dtype=np.int32)
+    boxes, ids, world_points, image_points = filter_markers(boxes, ids, layout)
+    assert list(ids) == [3, 0]
+    assert [box[0, 0, 0] for box in boxes] == [0, 2]
+    assert np.array_equal(world_points, np.float32(marker_layout[3] + marker_layout[0]))
+    assert image_points.shape == (8, 2)
+    assert filter_markers(boxes[:1], np.array([[9]]), layout) == (None, None, None, None)
+
+
+def test_world_pos_from_image():
+    t_vec = np.array([-15.0, -10.0, 80.0])
+    image = render_markers(np.array([0.1, -0.1, 0.05]), t_vec)
+    success, r_vec, found_t_vec, ids = world_pos_from_image(image, marker_layout, camera_mtx)
+    assert success
+    assert sorted(ids) == list(range(6))
+    assert np.allclose(found_t_vec.reshape(-1), t_vec, atol=0.5)
+
+
+def distort_image(image, dist_coefficients):
+    """
+    Warps an image from the ideal test camera into one with lens distortion
+    """
+    h, w = image.shape
+    pixels = np.mgrid[:h, :w][::-1].reshape(2, -1).T.astype(np.float32)
+    ideal = cv.undistortPoints(pixels.reshape(-1, 1, 2), camera_mtx, dist_coefficients, P=camera_mtx)
+    ideal = ideal.reshape(h, w, 2)
+    return cv.remap(image, ideal[..., 0], ideal[..., 1], cv.INTER_LINEAR, borderValue=255)
+
+
+def test_world_pos_from_raw_image():
+    dist_coefficients = np.array([-0.25, 0.08, 0, 0, 0])
+    r_vec, t_vec = np.array([0.1, -0.1, 0.05]), np.array([-15.0, -10.0, 80.0])
+    raw = distort_image(render_markers(r_vec, t_vec), dist_coefficients)
+    distortion = (camera_mtx, dist_coefficients)
+    success, _, found_t_vec, ids = world_pos_from_image(raw, marker_layout, camera_mtx, distortion=distortion)
+    assert success and sorted(ids) == list(range(6))
+    assert np.allclose(found_t_vec.reshape(-1), t_vec, atol=0.5)
+    # Without undistorting the corners the pose is off
+    success, _, wrong_t_vec, _ = world_pos_from_image(raw, marker_layout, camera_mtx)
+    assert not success or not np.allclose(wrong_t_vec.reshape(-1), t_vec, atol=0.5)
+
+    corners = np.float32(marker_layout[0])
+    raw_corners, _ = cv.projectPoints(corners, r_vec, t_vec, camera_mtx, dist_coefficients)
+    expected, _ = cv.projectPoints(corners, r_vec, t_vec, camera_mtx, None)
+    assert np.abs(undistort_points(raw_corners.reshape(4, 2), camera_mtx, distortion) - expected.reshape(4, 2)).max() \
+        < 0.01
+
+    # The tracker predicts the regions on the raw image
+    tracker = MarkerTracker(marker_layout, full_search_interval=2)
+    assert tracker.world_pos_from_image(raw, camera_mtx, distortion=distortion)[0]
+    success, _, found_t_vec, _ = tracker.world_pos_from_image(raw, camera_mtx, distortion=distortion)
+    assert success and tracker.frames_since_full_search == 1
+    assert np.allclose(found_t_vec.reshape(-1), t_vec, atol=0.5)
+
+
+def test_world_pos_from_image_metrics():
+    image = render_markers(np.array([0.1, -0.1, 0.05]), np.array([-15.0, -10.0, 80.0]))
+    layout = dict(marker_layout)
+    del layout[5]
+    metrics.reset()
+    metrics.enabled = True
+    try:
+        assert world_pos_from_image(image, layout, camera_mtx)[0]
+        assert not world_pos_from_image(np.full_like(image, 255), layout, camera_mtx)[0]
+        snapshot = metrics.snapshot()
+    finally:
+        metrics.enabled = False
+        metrics.reset()
+    assert snapshot["counters"] == {"frames": 2, "misses": 1, "unknown_markers": 1}
+    assert snapshot["timers_ms"]["detect"]["count"] == 2 and snapshot["timers_ms"]["pnp"]["count"] == 1
+    assert snapshot["histograms"]["markers_found"]["max"] == 5
+
+
+def test_marker_tracker_records_each_frame_once():
+    tracker = MarkerTracker(marker_layout)
+    first = render_markers(np.array([0.1, -0.1, 0.05]), np.array([-15.0, -10.0, 80.0]))
+    # Far enough from the first pose that the regions predicted from it miss every marker
+    moved = render_markers(np.array([0.1, -0.1, 0.05]), np.array([20.0, 5.0, 80.0]))
+    metrics.reset()
+    metrics.enabled = True
+    try:
+        assert tracker.world_pos_from_image(first, camera_mtx)[0]
+        assert tracker.world_pos_from_image(moved, camera_mtx)[0]
+        snapshot = metrics.snapshot()
+    finally:
+        metrics.enabled = False
+        metrics.reset()
+    # The second frame tried the regions then fell back to a full search
+    assert tracker.frames_since_full_search == 0 and snapshot["timers_ms"]["detect_roi"]["count"] == 1
+    assert snapshot["counters"]["frames"] == 2
+    assert snapshot["timers_ms"]["filter"]["count"] == 2 and snapshot["timers_ms"]["pnp"]["count"] == 2
+
+
+def test_load_detector_params(tmp_path):
+    original = detector_params_to_dict(aruco_param)
+    path = str(tmp_path / "params.json")
+    with open(path, "w") as f:
+        json.dump({"parameters": {"adaptiveThreshWinSizeMin": 8, "adaptiveThreshConstant": 9}, "mean_ms": 1}, f)
+    _scaled_params(0.5)
+    try:
+        assert load_detector_params(path) is aruco_param
+        assert aruco_param.adaptiveThreshWinSizeMin == 8 and aruco_param.adaptiveThreshConstant == 9
+        assert aruco_param.adaptiveThreshWinSizeMax == original["adaptiveThreshWinSizeMax"]
+        assert _scaled_params(0.5).adaptiveThreshWinSizeMin == 4
+        assert sorted(find_markers(render_markers(np.array([0.1, -0.1, 0.05]), np.array([-15.0, -10.0, 80.0])))[1]
+                      .reshape(-1)) == list(range(6))
+
+        with open(path, "w") as f:
+            json.dump({"parameters": {"notAParameter": 1}}, f)
+        with pytest.raises(ValueError):
+            load_detector_params(path)
+    finally:
+        with open(path, "w") as f:
+            json.dump({"parameters": original}, f)
+        load_detector_params(path)
+    assert detector_params_to_dict(aruco_param) == original
+
+
+def test_find_markers_coarse_to_fine():
+    r_vec, t_vec = np.array([0.2, -0.1, 0.3]), np.array([-10.0, -5.0, 120.0])
+    image = render_markers(r_vec, t_vec)
+    boxes, ids = find_markers(image, scale=0.5)
+    assert sorted(ids.reshape(-1)) == list(range(6))
+    for box, marker_id in zip(boxes, ids.reshape(-1)):
+        expected, _ = cv.projectPoints(np.float32(marker_layout[marker_id]), r_vec, t_vec, camera_mtx, None)
+        assert np.abs(box.reshape(4, 2) - expected.reshape(4, 2)).max() < 1.5
+
+
+def test_marker_tracker_searches_rois():
+    tracker = MarkerTracker(marker_layout, full_search_interval=2)
+    first = render_markers(np.array([0.1, -0.1, 0.05]), np.array([-15.0, -10.0, 80.0]))
+    second = render_markers(np.array([0.1, -0.1, 0.06]), np.array([-14.0, -10.0, 80.0]))
+    assert tracker.world_pos_from_image(first, camera_mtx)[0]
+    success, _, t_vec, _ = tracker.world_pos_from_image(second, camera_mtx)
+    assert success and tracker.frames_since_full_search == 1
+    assert np.allclose(t_vec.reshape(-1), [-14, -10, 80], atol=0.5)
+    # Losing the markers falls back to a full search
+    blank = np.full_like(second, 255)
+    assert not tracker.world_pos_from_image(blank, camera_mtx)[0]
+    assert tracker.r_vec is None
+
+
+def test_pose_tracker_smooths_jitter():
+    layout = MarkerLayout(marker_layout)
+    world_points = layout.corners[layout.valid].reshape(-1, 3)
+    image_points, _ = cv.projectPoints(world_points, np.array([0.1, -0.1, 0.05]), np.array([-15.0, -10.0, 80.0]),
+                                       camera_mtx, None)
+    rng = np.random.default_rng(0)
+    pose_tracker = PoseTracker()
+    raw, smoothed = [], []
+    for frame in range(60):
+        noisy = (image_points.reshape(-1, 2) + rng.normal(0, 0.7, (24, 2))).astype(np.float32)
+        raw.append(solve_pose(world_points, noisy, camera_mtx)[1].reshape(-1))
+        smoothed.append(pose_tracker.update(world_points, noisy, camera_mtx, frame / 30)[1].reshape(-1))
+    assert np.std(smoothed[10:], axis=0)[2] < np.std(raw[10:], axis=0)[2]
+    assert np.allclose(np.mean(smoothed, axis=0), [-15, -10, 80], atol=0.2)
+
+
+def test_pose_tracker_resets_on_jump():
+    layout = MarkerLayout(marker_layout)
+    world_points = layout.corners[layout.valid].reshape(-1, 3)
+    pose_tracker = PoseTracker()
+    for frame, z in enumerate([80.0, 80.0, 120.0]):
+        image_points, _ = cv.projectPoints(world_points, np.zeros(3), np.array([0.0, 0.0, z]), camera_mtx, None)
+        _, t_vec = pose_tracker.update(world_points, image_points.reshape(-1, 2), camera_mtx, frame / 30)
+    assert abs(t_vec[2, 0] - 120) < 0.1
+
+
+def test_pose_covariance_matches_noise():
+    layout = MarkerLayout(marker_layout)
+    world_points = layout.corners[layout.valid].reshape(-1, 3)
+    image_points, _ = cv.projectPoints(world_points, np.array([0.1, -0.1, 0.05]), np.array([-15.0, -10.0, 80.0]),
+                                       camera_mtx, None)
+    rng = np.random.default_rng(0)
+    t_vecs, stds = [], []
+    for _ in range(200):
+        noisy = (image_points.reshape(-1, 2) + rng.normal(0, 0.5, (24, 2))).astype(np.float32)
+        r_vec, t_vec = solve_pose(world_points, noisy, camera_mtx)
+        t_vecs.append(t_vec.reshape(-1))
+        stds.append(np.sqrt(np.diag(pose_covariance(world_points, noisy, r_vec, t_vec, camera_mtx))[3:]))
+    ratio = np.std(t_vecs, axis=0) / np.mean(stds, axis=0)
+    assert np.all((ratio > 0.7) & (ratio < 1.4))
+
+
+def test_fuse_poses_from_two_cameras():
+    layout = MarkerLayout(marker_layout)
+    world_points = layout.corners[layout.valid].reshape(-1, 3)
+    rig_rot_m, _ = cv.Rodrigues(np.array([0.1, -0.1, 0.05]))
+    rig_t_vec = np.array([[-15.0], [-10.0], [80.0]])
+    rng = np.random.default_rng(1)
+    poses = []
+    # Camera to rig transforms for a camera at the rig origin and one 30 cm to the side turned towards the markers
+    for extrinsic_r_vec, extrinsic_t_vec in [(np.zeros(3), np.zeros(3)), (np.array([0, 0.3, 0]), np.array([30, 0, 0]))]:
+        extrinsic_rot_m, _ = cv.Rodrigues(extrinsic_r_vec)
+        r_vec, _ = cv.Rodrigues(extrinsic_rot_m.T @ rig_rot_m)
+        t_vec = extrinsic_rot_m.T @ (rig_t_vec - extrinsic_t_vec.reshape(3, 1))
+        image_points, _ = cv.projectPoints(world_points, r_vec, t_vec, camera_mtx, None)
+        noisy = (image_points.reshape(-1, 2) + rng.normal(0, 0.5, (24, 2))).astype(np.float32)
+        r_vec, t_vec = solve_pose(world_points, noisy, camera_mtx)
+        covariance = pose_covariance(world_points, noisy, r_vec, t_vec, camera_mtx)
+        poses.append(transform_pose(r_vec, t_vec, covariance, extrinsic_r_vec, extrinsic_t_vec))
+
+    r_vec, t_vec, covariance = fuse_poses(poses)
+    assert np.allclose(t_vec, rig_t_vec, atol=1)
+    assert np.allclose(cv.Rodrigues(r_vec)[0], rig_rot_m, atol=0.02)
+    assert all(np.trace(covariance[3:, 3:]) < np.trace(pose[2][3:, 3:]) for pose in poses)
+    # A single pose is returned unchanged
+    single = fuse_poses(poses[:1])
+    assert np.allclose(single[0], poses[0][0]) and np.allclose(single[1], poses[0][1])
+
+
+def write_layout(path, markers):
+    with open(path, "w") as f:
+        json.dump([{"id": i, "size": size, "x": x, "y": y} for i, size, x, y in markers], f)
+
+
+def test_load_layout_compiles(tmp_path):
+    path = str(tmp_path / "marker_layout.json")
+    write_layout(path, [(0, 9.5, 0, 0), (4, 9.5, 12, 0)])
+    marker_layout, marker_pos = load_layout(path)
+    assert sorted(marker_layout) == [0, 4] and marker_layout.valid[4] and not marker_layout.valid[1]
+    assert np.allclose(marker_layout[4], [[12, 0, 0], [21.5, 0, 0], [21.5, 9.5, 0], [12, 9.5, 0]])
+    assert marker_pos[4]["scale"] == 9.5 and np.allclose(marker_pos[4]["pos"], [[12], [0], [0]])
+    compiled_path = compiled_layout_path(path)
+    with np.load(compiled_path) as compiled:
+        assert compiled["index"][4] == 1 and compiled["index"][1] == -1
+        assert compiled["corners"].dtype == np.float32
+    # Loading again reuses the result, and the compiled file can be loaded directly
+    assert load_layout(path)[0] is marker_layout
+    assert sorted(load_layout(compiled_path)[0]) == [0, 4]
+
+    # Changing the json file regenerates the compiled file
+    write_layout(path, [(0, 9.5, 0, 0), (5, 9.5, 12, 0)])
+    os.utime(path, (0, 0))
+    assert sorted(load_layout(path)[0]) == [0, 5]
+    assert sorted(load_layout(compiled_path)[0]) == [0, 5]
+
+    # An edit of the same size that keeps the modification time is still picked up
+    mtime = os.path.getmtime(path)
+    write_layout(path, [(0, 9.5, 0, 0), (6, 9.5, 12, 0)])
+    os.utime(path, (mtime, mtime))
+    assert sorted(load_layout(path)[0]) == [0, 6]
+
+
+def test_load_layout_validates(tmp_path):
+    path = str(tmp_path / "marker_layout.json")
+    for markers, message in [
+        ([(0, 9.5, 0, 0), (0, 9.5, 12, 0)], "Duplicate"),
+        ([(0, 9.5, 0, 0), (1, 9.5, 5, 5)], "overlap"),
+        ([(0, 0, 0, 0)], "positive size"),
+        ([(1000, 9.5, 0, 0)], "dictionary"),
+    ]:
+        write_layout(path, markers)
+        with pytest.raises(ValueError, match=message):
+            load_layout(path)
+    # Touching markers are fine
+    write_layout(path, [(0, 9.5, 0, 0), (1, 9.5, 9.5, 0)])
+    assert sorted(load_layout(path)[0]) == [0, 1]
+
+
+def test_compile_layout_logs_write_failure(tmp_path, capsys):
+    path = str(tmp_path / "marker_layout.json")
+    write_layout(path, [(0, 9.5, 0, 0)])
+    # A folder in the way of the compiled file makes the write fail
+    os.mkdir(compiled_layout_path(path))
+    assert compile_layout(path)["ids"].tolist() == [0]
+    assert "Couldn't save the compiled layout" in capsys.readouterr().out
@@ -0,0 +1,44 @@
+import cv2 as cv
+import cv2.aruco as aruco
+import numpy as np
+
+from tracking_util import aruco_dict
+from tune_detector import param_sets, evaluate, pareto_front, choose, load_images
+
+
+def result(rate, mean_ms, false_ids=0):
+    return {"values": {}, "detection_rate": rate, "false_ids": false_ids, "mean_ms": mean_ms, "p95_ms": mean_ms}
+
+
+def test_param_sets_skip_invalid_windows():
+    sets = param_sets({"adaptiveThreshWinSizeMin": [3, 30], "adaptiveThreshWinSizeMax": [23, 53]})
+    assert {"adaptiveThreshWinSizeMin": 30, "adaptiveThreshWinSizeMax": 23} not in sets and len(sets) == 3
+    assert len(param_sets({"adaptiveThreshConstant": list(range(10))}, samples=4)) == 4
+
+
+def test_evaluate():
+    image = np.full((400, 600), 255, dtype=np.uint8)
+    image[100:300, 200:400] = aruco.drawMarker(aruco_dict, 3, 200)
+    found = evaluate({}, [image], [3, 4], repeat=1)
+    assert found["detection_rate"] == 0.5 and found["false_ids"] == 0 and found["mean_ms"] > 0
+    assert evaluate({}, [image], [4], repeat=1)["false_ids"] == 1
+
+
+def test_pareto_front_and_choose():
+    slow = result(1.0, 50)
+    fast = result(0.9, 10)
+    results = [slow, result(0.8, 20), fast, result(1.0, 60), result(1.0, 5, false_ids=1)]
+    assert pareto_front(results) == [fast, slow]
+    assert choose(pareto_front(results)) is slow
+    assert choose(pareto_front(results), min_rate=0.9) is fast
+    assert choose([fast]) is fast and choose([]) is None
+
+
+def test_load_images_skips_unreadable(tmp_path, capsys):
+    good = str(tmp_path / "good.png")
+    cv.imwrite(good, np.full((20, 30, 3), 128, dtype=np.uint8))
+    bad = tmp_path / "bad.jpg"
+    bad.write_text("not an image")
+    images, paths = load_images([str(bad), good])
+    assert paths == [good] and images[0].shape == (20, 30)
+    assert "Skipping" in capsys.readouterr().out
@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import glob
+import json
+import os.path
+import queue
+import threading
+import time
+
+import cv2 as cv
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from cli_tracker import iter_images, iter_video
+from pipeline_util import DropOldestQueue, ReadRetry, MAX_READ_FAILURES
+from recording_util import is_recording, iter_recording
+from tracking_util import load_cal_data, load_layout, world_pos_from_image, check_alignment, MarkerTracker, \
+    PoseTracker, load_detector_params
+
+LOCK_NAMES = ["xy_pos", "z_pos", "xy_rot", "z_rot"]
+
+
+def capture_camera(cam, camera_id, frames, stop, max_failures=MAX_READ_FAILURES):
+    """
+    Reads frames from a camera until stopped or it fails to read max_failures frames in a row
+    :param cam: The opened camera
+    :param camera_id: The id of the camera
+    :param frames: The queue to put ("camera id:frame number", timestamp, frame) tuples on
+    :param stop: An event that is set when the thread should exit
+    :param max_failures: The number of failed reads in a row to give up after, waiting longer after each one
+    """
+    index = 0
+    retry = ReadRetry(max_failures)
+    while not stop.is_set():
+        status, frame = cam.read()
+        if not status:
+            if retry.failed(stop):
+                continue
+            print(f"Failed to read from camera {camera_id} {retry.failures} times in a row, stopping")
+            break
+        retry.succeeded()
+        frames.put((f"{camera_id}:{index:06d}", time.perf_counter(), frame))
+        index += 1
+
+
+def iter_camera(camera_id, max_failures=MAX_READ_FAILURES):
+    """
+    Generates the items to track from a live camera, until it fails to read max_failures frames in a row. The camera is
+    read on its own thread and only the newest frame is kept, so frames the tracking is too slow for are skipped
+    instead of building up in the camera's buffer.
+    :param camera_id: The id of the camera
+    :param max_failures: The number of failed reads in a row to give up after, waiting longer after each one
+    :return: A generator of ("camera id:frame number", timestamp, frame) tuples, timed by when the frame was read
+    """
+    cam = cv.VideoCapture(camera_id, cv.CAP_DSHOW)
+    if not cam.isOpened():
+        print(f"Failed to open camera {camera_id}")
+        return
+    frames = DropOldestQueue(1)
+    stop = threading.Event()
+    thread = threading.Thread(target=capture_camera, args=(cam, camera_id, frames, stop, max_failures), daemon=True)
+    thread.start()
+    try:
+        while True:
+            try:
+                yield frames.get(timeout=0.1)
+            except queue.Empty:
+                # The last frame is put on the queue before the thread ends, so nothing is missed
+                if not thread.is_alive():
+                    break
+    finally:
+        stop.set()
+        thread.join()
+        cam.release()
+
+
+def make_message(name, timestamp, result, target_pos, latency):
+    """
+    Makes the message sent to the subscribers for one frame
+    :param name: The name of the frame
+    :param timestamp: The time the frame was captured in seconds
+    :param result: The tuple returned by world_pos_from_image
+    :param target_pos: The target position as a 3x1 vector (cm)
+    :param latency: The time it took to track the frame in seconds
+    :return: A dictionary that can be encoded as json
+    """
+    success, rvec, tvec, ids = result
+    message = {"frame": name, "timestamp": timestamp, "latency": latency, "found": bool(success)}
+    if success:
+        # The same checks the GUI makes
+        euler = Rotation.from_rotvec(rvec.reshape(3)).as_euler('zyx', degrees=True)
+        locks = check_alignment(target_pos - tvec, euler)
+        message.update({
+            "tvec": tvec.reshape(3).tolist(),
+            "rvec": rvec.reshape(3).tolist(),
+            "euler": euler.tolist(),
+            "ids": [int(marker_id) for marker_id in np.reshape(ids, -1)],
+            "locks": dict(zip(LOCK_NAMES, locks)),
+            "aligned": all(locks),
+        })
+    return message
+
+
+class PoseServer:
+    """
+    Publishes messages to every connected client as json lines. Each client only ever gets the newest message, so a
+    slow client skips poses instead of falling behind or slowing down the tracking.
+    """
+
+    def __init__(self):
+        self.latest = None
+        self.published = 0
+        self.closed = False
+        self._subscribers = set()
+        # The task handling each client mapped to its stream writer
+        self._clients = {}
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def publish(self, message):
+        """
+        Sends a message to every client, replacing any message they haven't been sent yet. Must be called from the
+        event loop's thread (use loop.call_soon_threadsafe from other threads).
+        :param message: A dictionary that can be encoded as json
+        """
+        self.latest = (json.dumps(message) + "\n").encode()
+        self.published += 1
+        for ready in self._subscribers:
+            ready.set()
+
+    async def close(self, timeout=1.0):
+        """
+        Disconnects every client (they are sent the newest message first if they haven't had it yet)
+        :param timeout: The longest to wait for the clients to be sent the last message in seconds
+        """
+        self.closed = True
+        for ready in self._subscribers:
+            ready.set()
+        if self._clients:
+            await asyncio.wait(list(self._clients), timeout=timeout)
+        # Clients that aren't reading are dropped
+        for writer in list(self._clients.values()):
+            writer.transport.abort()
+        if self._clients:
+            await asyncio.wait(list(self._clients))
+
+    async def handle_client(self, reader, writer):
+        """
+        Sends the messages to one client until it disconnects or the server is closed
+        :param reader: The client's stream reader
+        :param writer: The client's stream writer
+        """
+        ready = asyncio.Event()
+        self._subscribers.add(ready)
+        task = asyncio.current_task()
+        self._clients[task] = writer
+        # New clients get the current pose straight away
+        ready.set()
+        sent = 0
+        # Clients don't send anything, so this only finishes when they disconnect
+        closed = asyncio.ensure_future(reader.read())
+        try:
+            while True:
+                waiter = asyncio.ensure_future(ready.wait())
+                await asyncio.wait({waiter, closed}, return_when=asyncio.FIRST_COMPLETED)
+                if closed.done():
+                    waiter.cancel()
+                    break
+                ready.clear()
+                if sent != self.published:
+                    sent = self.published
+                    writer.write(self.latest)
+                    await writer.drain()
+                if self.closed:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._subscribers.discard(ready)
+            del self._clients[task]
+            closed.cancel()
+            writer.close()
+
+
+def tracking_loop(items, cal_path, marker_layout, target_pos, publish, stop, scale=1, tracker=None,
+                  pose_tracker=None, realtime=False):
+    """
+    Tracks the frames from a source and publishes the result of each one until the source ends or the loop is stopped
+    :param items: An iterable of (name, timestamp, frame or image path) tuples
+    :param cal_path: The path to the npz camera calibration data
+    :param marker_layout: The marker layout returned by load_layout
+    :param target_pos: The target position as a 3x1 vector (cm)
+    :param publish: A function that is called with each message (must be thread safe)
+    :param stop: An event that is set when the thread should exit
+    :param scale: The scale to initially search for the markers at (see find_markers)
+    :param tracker: An optional MarkerTracker to only search around the last pose
+    :param pose_tracker: An optional PoseTracker to warm start and smooth the pose with
+    :param realtime: If true the frames are published at the rate they were captured at (only for file sources,
+    whose timestamps start from 0)
+    """
+    start_time = time.perf_counter()
+    for name, timestamp, frame in items:
+        if stop.is_set():
+            break
+        if realtime:
+            time.sleep(max(0.0, start_time + timestamp - time.perf_counter()))
+        start = time.perf_counter()
+        if isinstance(frame, str):
+            frame = cv.imread(frame, cv.IMREAD_COLOR)
+            if frame is None:
+                continue
+
+        dist_coefficients, camera_mtx, roi, mapx, mapy = load_cal_data(cal_path, frame.shape[1::-1])
+        # Nothing is displayed, so only the greyscale image is undistorted
+        gray = cv.remap(cv.cvtColor(frame, cv.COLOR_BGR2GRAY), mapx, mapy, cv.INTER_LINEAR)
+        if tracker is not None:
+            result = tracker.world_pos_from_image(gray, camera_mtx, timestamp=timestamp)
+        else:
+            result = world_pos_from_image(gray, marker_layout, camera_mtx, scale=scale, pose_tracker=pose_tracker,
+                                          timestamp=timestamp)
+        publish(make_message(name, timestamp, result, target_pos, time.perf_counter() - start))
+
+
+async def serve(items, host, port, **kwargs):
+    """
+    Runs the server until the source ends
+    :param items: An iterable of (name, timestamp, frame or image path) tuples
+    :param host: The address to listen on
+    :param port: The port to listen on
+    :param kwargs: The rest of the arguments to tracking_loop
+    """
+    loop = asyncio.get_running_loop()
+    pose_server = PoseServer()
+    server = await asyncio.start_server(pose_server.handle_client, host, port)
+    print(f"Serving poses on {', '.join(str(sock.getsockname()) for sock in server.sockets)}")
+
+    stop = threading.Event()
+
+    def publish(message):
+        # The tracking blocks, so it runs on a thread and hands the messages to the event loop
+        if not stop.is_set():
+            loop.call_soon_threadsafe(pose_server.publish, message)
+
+    try:
+        async with server:
+            await loop.run_in_executor(None, lambda: tracking_loop(items, publish=publish, stop=stop, **kwargs))
+            await pose_server.close()
+    finally:
+        stop.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--src", default="0",
+                        help="The camera id, video file, recording (see gui_tracker.py --record) or folder of images "
+                             "to track (defaults to camera 0)")
+    parser.add_argument("--cal", type=str, help="The path to the npz camera calibration data")
+    parser.add_argument("--layout", type=str, help='The marker layout json file')
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on")
+    parser.add_argument("--port", type=int, default=5499, help="The port to listen on")
+    parser.add_argument("--target", type=float, nargs=3, default=[0, 0, 0], metavar=("X", "Y", "Z"),
+                        help="The target position (cm) used for the alignment checks")
+    parser.add_argument("--detection-scale", type=float, default=1,
+                        help="Search for the markers on the image downscaled by this factor then refine the corners at "
+                             "full resolution (1 searches the full resolution image)")
+    parser.add_argument("--track", action="store_true", help="Only search around the markers found in the last frame")
+    parser.add_argument("--smooth", action="store_true", help="Warm start and smooth the pose using the last frames")
+    parser.add_argument("--realtime", action="store_true",
+                        help="Play video files, recordings and image folders back at the rate they were captured at "
+                             "(cameras are always live)")
+    parser.add_argument("--fps", type=float, default=30, help="The frame rate of image folders")
+    parser.add_argument("--detector-params", type=str,
+                        help="A json file of detector parameters from tune_detector.py to find the markers with")
+
+    args = parser.parse_args()
+    if args.detector_params:
+        load_detector_params(args.detector_params)
+
+    # The calibration data and layout are looked for next to file sources
+    if args.src.isdigit():
+        if args.realtime:
+            parser.error("--realtime only applies to file sources, cameras are already tracked as they capture")
+        items = iter_camera(int(args.src))
+        src_dir = "."
+    elif is_recording(args.src):
+        items = iter_recording(args.src)
+        src_dir = args.src
+    elif os.path.isdir(args.src):
+        paths = sorted(glob.glob(os.path.join(args.src, "*.jpg")) + glob.glob(os.path.join(args.src, "*.png")))
+        items = iter_images(paths, args.fps)
+        src_dir = args.src
+    else:
+        items = iter_video(args.src)
+        src_dir = os.path.dirname(args.src)
+    cal_path = args.cal if args.cal else os.path.join(src_dir, 'camera_cal.npz')
+    layout_path = args.layout if args.layout else os.path.join(src_dir, 'marker_layout.json')
+
+    marker_layout, marker_pos = load_layout(layout_path)
+    pose_tracker = PoseTracker() if args.smooth else None
+    tracker = MarkerTracker(marker_layout, scale=args.detection_scale, pose_tracker=pose_tracker) if args.track \
+        else None
+
+    try:
+        asyncio.run(serve(items, args.host, args.port, cal_path=cal_path, marker_layout=marker_layout,
+                          target_pos=np.array(args.target, dtype=np.float64).reshape(3, 1),
+                          scale=args.detection_scale, tracker=tracker, pose_tracker=pose_tracker,
+                          realtime=args.realtime))
+    except KeyboardInterrupt:
+        pass
@@ -1,9 +1,16 @@
+import functools
+import hashlib
 import json
+import os.path
+import time
 
 import cv2 as cv
 import cv2.aruco as aruco
 import numpy as np
 
+from file_util import atomic_write
+from metrics_util import metrics
+
 aruco_dict = aruco.getPredefinedDictionary(aruco.DICT_4X4_250)
 aruco_param = aruco.DetectorParameters_create()
 aruco_param.adaptiveThreshWinSizeMax = 100
@@ -12,94 +19,878 @@ aruco_param.perspectiveRemovePixelPerCell = 15
 aruco_param.perspectiveRemoveIgnoredMarginPerCell = 0.2
 
 
-def load_cal_data(cal_data_path, dim, alpha=1):
+# The maximum number of (calibration file, image size, alpha) combinations to keep undistortion maps for
+CAL_CACHE_SIZE = 8
+# Bump this if the compiled layout format changes so old files are regenerated
+LAYOUT_VERSION = 1
+
+
+def load_cal_data(cal_data_path, dim, alpha=1, reduced=1, out_dim=None):
     """
     Loads the camera calibration data from a file
+    The undistortion maps are cached for each calibration file, image size, alpha value, reduction and output size so
+    calling this for every frame is cheap. The returned arrays are shared between callers and must not be modified.
     :param cal_data_path: The path to the camera calibration data
-    :param dim: The dimensions of the output image
+    :param dim: The dimensions of the image
     :param alpha: A value between 0 and 1 that describes how much of the unusable image will be kept
     (1=keep whole image, 0=crop out all invalid areas)
-    :return: dist_coefficients, camera matrix, roi, mapx, mapy
+    :param reduced: The factor the images were downscaled by when they were decoded (see loader_util.read_image), the
+    calibration is for the full resolution images
+    :param out_dim: The dimensions of the undistorted image (defaults to dim). A smaller size undistorts and downscales
+    the image in the same remap, which costs less the fewer output pixels there are.
+    :return: dist_coefficients, camera matrix (of the undistorted image), roi, mapx, mapy (mapx and mapy are in the
+    fixed point CV_16SC2 + interpolation table form, which can be passed to cv.remap the same way as floating point
+    maps)
     """
+    # The modification time is part of the key so a recalibrated file is picked up without restarting
+    cal_data_path = os.path.abspath(cal_data_path)
+    dim = tuple(int(x) for x in dim)
+    out_dim = dim if out_dim is None else tuple(int(x) for x in out_dim)
+    return _load_cal_data(cal_data_path, os.path.getmtime(cal_data_path), dim, alpha, reduced, out_dim)
+
+
+@functools.lru_cache(maxsize=CAL_CACHE_SIZE)
+def _load_cal_data(cal_data_path, mtime, dim, alpha, reduced, out_dim):
     # https://stackoverflow.com/questions/39432322/what-does-the-getoptimalnewcameramatrix-do-in-opencv
     data = np.load(cal_data_path)
-    camera_mtx = data["k"]
+    camera_mtx = scale_camera_matrix(data["k"], 1 / reduced)
     dist_coefficients = data["d"]
-    new_camera_mtx, roi = cv.getOptimalNewCameraMatrix(camera_mtx, dist_coefficients, dim, alpha)
-    mapx, mapy = cv.initUndistortRectifyMap(camera_mtx, dist_coefficients, None, new_camera_mtx, dim, 5)
+    new_camera_mtx, roi = cv.getOptimalNewCameraMatrix(camera_mtx, dist_coefficients, dim, alpha, out_dim)
+    # Fixed point maps are half the size of the CV_32FC1 ones and are faster to remap with
+    mapx, mapy = cv.initUndistortRectifyMap(camera_mtx, dist_coefficients, None, new_camera_mtx, out_dim, cv.CV_16SC2)
 
     return dist_coefficients, new_camera_mtx, roi, mapx, mapy
 
 
+def load_distortion(cal_data_path, reduced=1):
+    """
+    Loads the camera matrix and distortion coefficients of the raw (distorted) camera, which are needed to detect the
+    markers on the raw image and only undistort their corners (see undistort_points)
+    :param cal_data_path: The path to the camera calibration data
+    :param reduced: The factor the images were downscaled by when they were decoded (see load_cal_data)
+    :return: A (camera matrix, distortion coefficients) tuple, shared between callers so it must not be modified
+    """
+    cal_data_path = os.path.abspath(cal_data_path)
+    return _load_distortion(cal_data_path, os.path.getmtime(cal_data_path), reduced)
+
+
+@functools.lru_cache(maxsize=CAL_CACHE_SIZE)
+def _load_distortion(cal_data_path, mtime, reduced):
+    with np.load(cal_data_path) as data:
+        return scale_camera_matrix(data["k"], 1 / reduced), data["d"]
+
+
+def scale_camera_matrix(camera_mtx, scale):
+    """
+    Makes the camera matrix for the same camera with its images resized
+    :param camera_mtx: The camera matrix
+    :param scale: The factor the images were resized by
+    :return: The new camera matrix (the same array if the scale is 1)
+    """
+    if scale == 1:
+        return camera_mtx
+    scaled = np.array(camera_mtx, dtype=np.float64)
+    scaled[:2, :2] *= scale
+    # Pixel centers are at +0.5, so the principal point doesn't scale exactly
+    scaled[:2, 2] = (scaled[:2, 2] + 0.5) * scale - 0.5
+    return scaled
+
+
+def undistort_points(image_points, camera_mtx, distortion):
+    """
+    Moves points found on the raw image to where they are in the undistorted image that load_cal_data's maps make
+    :param image_points: The Nx2 points on the raw image
+    :param camera_mtx: The camera matrix of the undistorted image (from load_cal_data)
+    :param distortion: The (camera matrix, distortion coefficients) tuple of the raw image from load_distortion
+    :return: The Nx2 points on the undistorted image
+    """
+    raw_camera_mtx, dist_coefficients = distortion
+    points = np.ascontiguousarray(image_points, dtype=np.float32).reshape(-1, 1, 2)
+    return cv.undistortPoints(points, raw_camera_mtx, dist_coefficients, P=camera_mtx).reshape(-1, 2)
+
+
+class MarkerLayout(dict):
+    """
+    The mapping between marker ids and the coordinates of their corners. Also holds a dense array of the corners
+    indexed by id and a mask of which ids are in the layout, so the markers found in an image can be matched up with
+    their corners using numpy indexing instead of python loops.
+    """
+
+    def __init__(self, corners_by_id):
+        """
+        :param corners_by_id: A mapping between marker ids and a list of the coordinates of their four corners
+        """
+        super().__init__(corners_by_id)
+        # Every id the dictionary can return is a valid index, so the detected ids don't need to be bounds checked
+        size = max(len(aruco_dict.bytesList), max(self, default=-1) + 1)
+        self.corners = np.zeros((size, 4, 3), dtype=np.float32)
+        self.valid = np.zeros(size, dtype=bool)
+        for marker_id, corners in self.items():
+            self.corners[marker_id] = corners
+            self.valid[marker_id] = True
+
+
+def _as_marker_layout(marker_layout):
+    # Plain dictionaries still work, they just have the arrays built each time
+    if isinstance(marker_layout, MarkerLayout):
+        return marker_layout
+    return MarkerLayout(marker_layout)
+
+
 def load_layout(path):
     """
     Loads the marker layout json file
+    The layout is checked and compiled to an npz file next to the json file (see compile_layout) the first time it is
+    loaded, and later loads read the compiled file until the json file's contents change. The npz file is only a cache and can
+    be deleted at any time. A compiled npz file can also be loaded
+    directly. The result is cached, so loading the same layout again returns the same objects, which must not be
+    modified.
     :param path: The path of the layout json file
     :return: marker_layout, marker_pos => layout is used to pass to world_pos_from_image
     and pos can be used to draw the marker axis
+    :raises ValueError: If the layout has duplicate ids, overlapping markers or other errors (see validate_layout)
     """
-    with open(path) as f:
-        layout_json = json.load(f)
-
-    marker_layout = {int(x["id"]): [
-        [x["x"], x["y"], 0],
-        [x["x"] + x["size"], x["y"], 0],
-        [x["x"] + x["size"], x["y"] + x["size"], 0],
-        [x["x"], x["y"] + x["size"], 0]
-    ] for x in layout_json}
-
-    marker_pos = {int(x["id"]): {
-        "scale": x["size"],
-        "pos": np.array([x["x"], x["y"], 0]).reshape(3, 1)
-    } for x in layout_json}
+    path = os.path.abspath(path)
+    # The result is cached by the checksum of the file, the same check the compiled file is validated with, so an edit
+    # that keeps the modification time is still picked up
+    with open(path, "rb") as f:
+        checksum = hashlib.sha256(f.read()).hexdigest()
+    return _load_layout(path, checksum)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_layout(path, checksum):
+    if path.endswith(".npz"):
+        compiled = _read_compiled_layout(path)
+        if compiled is None:
+            raise ValueError(f"{path} was compiled by a different version, compile the json file again")
+    else:
+        with open(path, "rb") as f:
+            source = f.read()
+        checksum = hashlib.sha256(source).hexdigest()
+        compiled_path = compiled_layout_path(path)
+        compiled = _read_compiled_layout(compiled_path) if os.path.isfile(compiled_path) else None
+        if compiled is None or compiled["sha256"] != checksum:
+            compiled = compile_layout(path, source)
+
+    ids = compiled["ids"].tolist()
+    marker_layout = MarkerLayout(dict(zip(ids, compiled["corners"])))
+    marker_pos = {marker_id: {
+        "scale": float(size),
+        "pos": pos.astype(np.float64).reshape(3, 1)
+    } for marker_id, size, pos in zip(ids, compiled["size"], compiled["pos"])}
     return marker_layout, marker_pos
 
 
-def find_markers(image):
+def compiled_layout_path(path):
+    """
+    Gets where the compiled form of a layout json file is saved
+    :param path: The path of the layout json file
+    :return: The path of the npz file
+    """
+    return os.path.splitext(path)[0] + ".npz"
+
+
+def validate_layout(layout_json):
+    """
+    Checks a marker layout for mistakes that would otherwise give wrong poses
+    :param layout_json: The list of markers from the layout json file
+    :raises ValueError: If a marker is missing a property, an id is used twice or isn't in the aruco dictionary, a
+    marker doesn't have a positive size or two markers overlap
+    """
+    if not isinstance(layout_json, list):
+        raise ValueError("The layout must be a list of markers")
+    for i, marker in enumerate(layout_json):
+        missing = [key for key in ("id", "size", "x", "y") if key not in marker]
+        if missing:
+            raise ValueError(f"Marker {i} is missing {', '.join(missing)}")
+    ids = np.array([int(marker["id"]) for marker in layout_json], dtype=np.int64)
+    sizes = np.array([marker["size"] for marker in layout_json], dtype=np.float64)
+    corners = np.array([[marker["x"], marker["y"]] for marker in layout_json], dtype=np.float64).reshape(-1, 2)
+
+    unique, counts = np.unique(ids, return_counts=True)
+    if np.any(counts > 1):
+        raise ValueError(f"Duplicate marker ids {unique[counts > 1].tolist()}")
+    invalid = ids[(ids < 0) | (ids >= len(aruco_dict.bytesList))]
+    if invalid.size:
+        raise ValueError(f"Marker ids {invalid.tolist()} aren't in the aruco dictionary")
+    if np.any(sizes <= 0):
+        raise ValueError(f"Markers {ids[sizes <= 0].tolist()} don't have a positive size")
+
+    # Two squares overlap if they overlap along both axes (touching edges is fine)
+    start = corners[:, None, :]
+    end = (corners + sizes[:, None])[:, None, :]
+    overlap = np.all((start < end.transpose(1, 0, 2)) & (start.transpose(1, 0, 2) < end), axis=2)
+    np.fill_diagonal(overlap, False)
+    first, second = np.nonzero(np.triu(overlap))
+    if first.size:
+        pairs = ", ".join(f"{ids[i]} and {ids[j]}" for i, j in zip(first, second))
+        raise ValueError(f"Markers {pairs} overlap")
+
+
+def compile_layout(path, source=None):
+    """
+    Checks a layout json file and saves it in the compiled form load_layout reads. The compiled file is an npz file
+    with the ids, an id to index table, the corners as float32, the size and position of each marker and the sha256
+    checksum of the json file it was made from. If the folder can't be written to, the failure is logged and the
+    layout is still returned (compiling it again on the next load).
+    :param path: The path of the layout json file
+    :param source: The contents of the json file if they have already been read
+    :return: A dictionary with the compiled arrays
+    :raises ValueError: If the layout fails validate_layout
+    """
+    if source is None:
+        with open(path, "rb") as f:
+            source = f.read()
+    layout_json = json.loads(source)
+    validate_layout(layout_json)
+
+    ids = np.array([int(marker["id"]) for marker in layout_json], dtype=np.int32)
+    size = np.array([marker["size"] for marker in layout_json], dtype=np.float32)
+    pos = np.array([[marker["x"], marker["y"], 0] for marker in layout_json], dtype=np.float32).reshape(-1, 3)
+    # The corners go clockwise from the upper left one, the same order aruco returns them in
+    offsets = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]], dtype=np.float32)
+    corners = pos[:, None, :] + size[:, None, None] * offsets
+    index = np.full(len(aruco_dict.bytesList), -1, dtype=np.int32)
+    index[ids] = np.arange(len(ids), dtype=np.int32)
+    compiled = {
+        "version": np.int32(LAYOUT_VERSION),
+        "sha256": hashlib.sha256(source).hexdigest(),
+        "ids": ids,
+        "index": index,
+        "corners": corners,
+        "size": size,
+        "pos": pos,
+    }
+
+    compiled_path = compiled_layout_path(path)
+    try:
+        with atomic_write(compiled_path) as f:
+            np.savez(f, **compiled)
+    except OSError as e:
+        print(f"Couldn't save the compiled layout to {compiled_path}: {e}")
+    return compiled
+
+
+def _read_compiled_layout(path):
+    # Older versions are read as missing, so they are regenerated
+    with np.load(path) as data:
+        if "version" not in data or int(data["version"]) != LAYOUT_VERSION:
+            return None
+        compiled = {name: data[name] for name in data.files}
+    compiled["sha256"] = str(compiled["sha256"])
+    return compiled
+
+
+def detector_params_to_dict(params):
+    """
+    Lists the settings of a set of detector parameters
+    :param params: The aruco DetectorParameters
+    :return: A dictionary of parameter name to value that can be encoded as json
+    """
+    values = {}
+    for name in dir(params):
+        value = getattr(params, name)
+        if not name.startswith("_") and not callable(value):
+            values[name] = value
+    return values
+
+
+def detector_params_from_dict(values, base=None):
+    """
+    Makes a set of detector parameters
+    :param values: A dictionary of parameter name to value to set
+    :param base: The DetectorParameters to copy the rest of the settings from (defaults to OpenCV's defaults)
+    :return: The new aruco DetectorParameters
+    """
+    params = aruco.DetectorParameters_create()
+    if base is not None:
+        values = {**detector_params_to_dict(base), **values}
+    for name, value in values.items():
+        if name.startswith("_") or not hasattr(params, name):
+            raise ValueError(f"Unknown detector parameter {name}")
+        # Json doesn't keep ints and floats apart reliably, so use the type OpenCV expects
+        setattr(params, name, type(getattr(params, name))(value))
+    return params
+
+
+def load_detector_params(path):
+    """
+    Loads detector parameters saved by tune_detector.py and uses them for all marker detection from now on. The
+    module's aruco_param is updated in place, so modules that imported it see the new values too.
+    :param path: The json file with the parameters under "parameters" (any other keys are ignored)
+    :return: The updated aruco_param
+    """
+    with open(path) as f:
+        values = json.load(f)["parameters"]
+    params = detector_params_from_dict(values, aruco_param)
+    for name, value in detector_params_to_dict(params).items():
+        setattr(aruco_param, name, value)
+    # The downscaled parameters were made from the old values
+    _scaled_params.cache_clear()
+    return aruco_param
+
+
+def find_markers(image, scale=1, cache=None):
     """
     Find the location of the markers on an image
     :param image: A greyscale image
+    :param scale: If less than 1 the markers are found on an image downscaled by this factor and the corners are then
+    refined on the full resolution image, which is much faster for large images with large markers
+    :param cache: An optional DetectionCache to reuse the markers found in an identical image
     :return: A tuple containing a list of bounding boxes, a list of marker ids
     """
+    if cache is not None:
+        key = cache.key(image, aruco_dict, aruco_param, scale)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached[:2]
 
-    # todo: look into implementing ourselves to see if we can get better performance with over exposed images
-    boxes, ids, _ = aruco.detectMarkers(image, aruco_dict, parameters=aruco_param)
+    if scale < 1:
+        boxes, ids = _find_markers_coarse_to_fine(image, scale)
+    else:
+        # todo: look into implementing ourselves to see if we can get better performance with over exposed images
+        boxes, ids, _ = aruco.detectMarkers(image, aruco_dict, parameters=aruco_param)
+
+    if cache is not None:
+        boxes, ids, _ = cache.put(key, (boxes, ids, ()))
     return boxes, ids
 
 
-def world_pos_from_image(image, marker_layout, camera_mtx, draw_img=None):
+# Stop refining a corner after 30 iterations or when it moves less than 0.01 pixels
+subpix_criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+
+
+@functools.lru_cache(maxsize=4)
+def _scaled_params(scale):
+    # The adaptive threshold window sizes are in pixels, so they are shrunk along with the image
+    params = detector_params_from_dict({}, aruco_param)
+    params.adaptiveThreshWinSizeMin = max(3, int(aruco_param.adaptiveThreshWinSizeMin * scale))
+    params.adaptiveThreshWinSizeMax = max(params.adaptiveThreshWinSizeMin,
+                                          int(aruco_param.adaptiveThreshWinSizeMax * scale))
+    return params
+
+
+def _find_markers_coarse_to_fine(image, scale):
+    small = cv.resize(image, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+    boxes, ids, _ = aruco.detectMarkers(small, aruco_dict, parameters=_scaled_params(scale))
+    if ids is None:
+        return boxes, ids
+
+    # Map the corners back to full resolution (pixel centers are at +0.5) and refine them in a window that covers
+    # the error from the downscaling, which only looks at the image right around each corner
+    corners = (np.array(boxes, dtype=np.float32).reshape(-1, 1, 2) + 0.5) / scale - 0.5
+    win_size = max(5, int(np.ceil(2 / scale)))
+    cv.cornerSubPix(image, corners, (win_size, win_size), (-1, -1), subpix_criteria)
+    return tuple(corners.reshape(-1, 1, 4, 2)), ids
+
+
+def world_pos_from_image(image, marker_layout, camera_mtx, draw_img=None, scale=1, pose_tracker=None,
+                         timestamp=None, cache=None, distortion=None):
     """
     Takes an image with aruco markers and returns the world location and position of the camera
     :param draw_img:
     :param image: The image to process
     :param marker_layout: The mapping between marker ids and the coordinates of their corners
     :param camera_mtx: The camera matrix
+    :param scale: The scale to initially search for the markers at (see find_markers)
+    :param pose_tracker: An optional PoseTracker to warm start and smooth the pose with
+    :param timestamp: The time the image was captured in seconds, used by the pose tracker
+    :param cache: An optional DetectionCache to reuse the markers found in an identical image
+    :param distortion: If the image is the raw (distorted) image, the (camera matrix, distortion coefficients) tuple
+    from load_distortion. Only the corners of the markers found are undistorted, into the image camera_mtx describes.
     :return: A tuple containing a boolean to indicate the status of the operation and
     the rotation vector, translation vector and ids if it was successful
     """
 
-    bounding_boxes, ids = find_markers(image)
-    # Make the ids a row vector
+    if metrics.enabled:
+        start = time.perf_counter()
+    bounding_boxes, ids = find_markers(image, scale, cache)
+    if metrics.enabled:
+        metrics.add_time("detect", time.perf_counter() - start)
+    result = pose_from_markers(bounding_boxes, ids, marker_layout, camera_mtx, draw_img, pose_tracker, timestamp,
+                               distortion)
+    if metrics.enabled:
+        _record_frame(result, start)
+    return result
+
+
+def _record_frame(result, start):
+    # Per frame counters, recorded once for each frame by the top level tracking functions
+    metrics.add_time("frame", time.perf_counter() - start)
+    metrics.count("frames")
+    if not result[0]:
+        metrics.count("misses")
+    metrics.observe("markers_found", 0 if result[3] is None else len(result[3]))
+
+
+def pose_from_markers(bounding_boxes, ids, marker_layout, camera_mtx, draw_img=None, pose_tracker=None,
+                      timestamp=None, distortion=None):
+    """
+    Finds the world location and position of the camera from markers that have already been found in an image
+    :param bounding_boxes: The bounding boxes returned by find_markers
+    :param ids: The ids returned by find_markers
+    :param marker_layout: The mapping between marker ids and the coordinates of their corners
+    :param camera_mtx: The camera matrix
+    :param draw_img: An optional image to draw the markers on
+    :param pose_tracker: An optional PoseTracker to warm start and smooth the pose with
+    :param timestamp: The time the image was captured in seconds, used by the pose tracker
+    :param distortion: The raw camera's (camera matrix, distortion coefficients) if the markers were found on the raw
+    image (see world_pos_from_image)
+    :return: The same tuple as world_pos_from_image
+    """
+    stats = {} if metrics.enabled else None
+    result = _pose_from_markers(bounding_boxes, ids, marker_layout, camera_mtx, draw_img, pose_tracker, timestamp,
+                                distortion, stats)
+    if stats is not None:
+        _record_stats(stats)
+    return result
+
+
+def _record_stats(stats):
+    # The stage times and counts collected by _pose_from_markers
+    for name, seconds in stats.items():
+        if name == "unknown_markers":
+            metrics.count(name, seconds)
+        else:
+            metrics.add_time(name, seconds)
+
+
+def _pose_from_markers(bounding_boxes, ids, marker_layout, camera_mtx, draw_img, pose_tracker, timestamp, distortion,
+                       stats):
+    # pose_from_markers, with the metrics collected in stats (if it isn't None) so the caller decides whether they are
+    # recorded
+    if stats is not None:
+        start = time.perf_counter()
+        found = 0 if ids is None else len(ids)
+    bounding_boxes, ids, world_points, image_points = filter_markers(bounding_boxes, ids, marker_layout)
+    if stats is not None:
+        stats["filter"] = time.perf_counter() - start
+        stats["unknown_markers"] = found - (0 if ids is None else len(ids))
+    if ids is not None and distortion is not None:
+        # Only the known markers are undistorted
+        image_points = undistort_points(image_points, camera_mtx, distortion)
+        bounding_boxes = tuple(image_points.reshape(-1, 1, 4, 2))
     if ids is not None:
-        found_ids = ids.reshape(-1)
-        # Intersection of the found ids and the ids we know about from the marker layout
-        ids = np.array([i for i in found_ids if i in marker_layout])
-        # Discard bounding boxes that match unknown ids and make sure they still are in the same order as the ids
-        bounding_boxes = [bounding_boxes[np.where(found_ids == i)[0][0]] for i in ids]
         # Optionally draw the markers on an image
         if draw_img is not None:
             aruco.drawDetectedMarkers(draw_img, bounding_boxes, ids)
-        # Order the marker world positions in the same order as the bounding boxes returned by find_markers (ignoring
-        # any unknown ids)
-        world_points = [marker_layout[marker_id] for marker_id in ids if marker_id in marker_layout]
-        if world_points:
-            # Flatten the arrays of bounding boxes to just be lists of points in R^2 and R^3
-            world_points = np.array(world_points, dtype=np.float32).reshape(-1, 3)
-            image_points = np.array(bounding_boxes, dtype=np.float32).reshape(-1, 2)
-            # Run opencv's pose estimation algorithm (iterative by default)
-            status, r_vec, t_vec = cv.solvePnP(world_points, image_points, camera_mtx, (0, 0, 0, 0), cv.SOLVEPNP_IPPE)
-            # Should not fail to compute transform
-            assert status
-            return True, r_vec, t_vec, ids
+        if stats is not None:
+            start = time.perf_counter()
+        if pose_tracker is not None:
+            r_vec, t_vec = pose_tracker.update(world_points, image_points, camera_mtx, timestamp)
+        else:
+            r_vec, t_vec = solve_pose(world_points, image_points, camera_mtx)
+        if stats is not None:
+            stats["pnp"] = time.perf_counter() - start
+        return True, r_vec, t_vec, ids
 
     return False, None, None, None
+
+
+def filter_markers(bounding_boxes, ids, marker_layout):
+    """
+    Discards the markers with ids that aren't in the marker layout and matches the rest up with their world coordinates
+    :param bounding_boxes: The bounding boxes returned by find_markers
+    :param ids: The ids returned by find_markers
+    :param marker_layout: The mapping between marker ids and the coordinates of their corners
+    :return: A tuple containing the known bounding boxes, their ids and the matching world and image points as Nx3 and
+    Nx2 float32 arrays (all None if there are no known markers)
+    """
+    marker_layout = _as_marker_layout(marker_layout)
+    if ids is not None:
+        # Make the ids a row vector
+        found_ids = ids.reshape(-1)
+        # Mask of the found ids that we know about from the marker layout
+        known = found_ids < len(marker_layout.valid)
+        known[known] = marker_layout.valid[found_ids[known]]
+        if known.any():
+            ids = found_ids[known]
+            # Discard bounding boxes that match unknown ids, keeping them in the same order as the ids
+            boxes = np.asarray(bounding_boxes, dtype=np.float32)[known]
+            # Flatten the arrays of bounding boxes and world corners to just be lists of points in R^2 and R^3
+            image_points = boxes.reshape(-1, 2)
+            world_points = marker_layout.corners[ids].reshape(-1, 3)
+            return tuple(boxes), ids, world_points, image_points
+
+    return None, None, None, None
+
+
+def solve_pose(world_points, image_points, camera_mtx):
+    """
+    Finds the pose of the markers relative to the camera from matching world and image points
+    :param world_points: The Nx3 float32 array of marker corners in world coordinates
+    :param image_points: The Nx2 float32 array of the same corners in the (undistorted) image
+    :param camera_mtx: The camera matrix
+    :return: The rotation and translation vectors
+    """
+    # Run opencv's pose estimation algorithm (iterative by default)
+    status, r_vec, t_vec = cv.solvePnP(world_points, image_points, camera_mtx, (0, 0, 0, 0), cv.SOLVEPNP_IPPE)
+    # Should not fail to compute transform
+    assert status
+    return r_vec, t_vec
+
+
+def find_markers_in_rois(image, rois, scale=1):
+    """
+    Find the location of the markers inside regions of an image
+    :param image: A greyscale image
+    :param rois: A list of (x0, y0, x1, y1) regions to search
+    :param scale: The scale to initially search for the markers at (see find_markers)
+    :return: The same tuple as find_markers, with the bounding boxes in full image coordinates
+    """
+    boxes = []
+    found_ids = []
+    for x0, y0, x1, y1 in rois:
+        roi_boxes, roi_ids = find_markers(image[y0:y1, x0:x1], scale)
+        if roi_ids is None:
+            continue
+        offset = np.array([x0, y0], dtype=np.float32)
+        for box, marker_id in zip(roi_boxes, roi_ids.reshape(-1)):
+            # Merged regions don't overlap, but a marker cut by the edge of one region could still show up in another
+            if marker_id not in found_ids:
+                boxes.append(box + offset)
+                found_ids.append(marker_id)
+
+    if not found_ids:
+        return (), None
+    return tuple(boxes), np.array(found_ids, dtype=np.int32).reshape(-1, 1)
+
+
+def predict_marker_rois(marker_layout, r_vec, t_vec, camera_mtx, dim, padding=0.5, min_padding=16, distortion=None):
+    """
+    Predicts the regions of an image the markers will be in by projecting the marker layout using a known pose
+    :param marker_layout: The mapping between marker ids and the coordinates of their corners
+    :param r_vec: The rotation vector of the pose
+    :param t_vec: The translation vector of the pose
+    :param camera_mtx: The camera matrix
+    :param dim: The dimensions of the image
+    :param padding: The amount to grow each marker's box by as a fraction of its size
+    :param min_padding: The minimum number of pixels to grow each marker's box by
+    :param distortion: The raw camera's (camera matrix, distortion coefficients) to predict the regions on the raw
+    image instead (the pose is the same for both)
+    :return: A list of non overlapping (x0, y0, x1, y1) regions
+    """
+    marker_layout = _as_marker_layout(marker_layout)
+    world_points = marker_layout.corners[marker_layout.valid].reshape(-1, 3)
+    if distortion is not None:
+        camera_mtx, dist_coefficients = distortion
+    else:
+        dist_coefficients = (0, 0, 0, 0)
+    image_points, _ = cv.projectPoints(world_points, r_vec, t_vec, camera_mtx, dist_coefficients)
+    image_points = image_points.reshape(-1, 4, 2)
+
+    width, height = dim
+    rois = []
+    for corners in image_points:
+        x0, y0 = corners.min(axis=0)
+        x1, y1 = corners.max(axis=0)
+        pad = max(padding * max(x1 - x0, y1 - y0), min_padding)
+        x0, y0 = max(int(x0 - pad), 0), max(int(y0 - pad), 0)
+        x1, y1 = min(int(x1 + pad) + 1, width), min(int(y1 + pad) + 1, height)
+        # Skip markers that are predicted to be off screen
+        if x1 > x0 and y1 > y0:
+            rois.append([x0, y0, x1, y1])
+
+    # Merge overlapping regions so nothing is searched twice
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rois)):
+            for j in range(i + 1, len(rois)):
+                a, b = rois[i], rois[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rois[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del rois[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple(roi) for roi in rois]
+
+
+class MarkerTracker:
+    """
+    Finds the position of the camera in a stream of images by only searching for the markers around where the last
+    pose says they should be. Falls back to searching the whole image when the markers are lost and every
+    full_search_interval frames, so markers that come into view are still picked up.
+    """
+
+    def __init__(self, marker_layout, full_search_interval=30, padding=0.5, scale=1, pose_tracker=None, cache=None):
+        """
+        :param marker_layout: The mapping between marker ids and the coordinates of their corners
+        :param full_search_interval: The maximum number of frames between searches of the whole image
+        :param padding: The amount to grow each predicted marker box by as a fraction of its size
+        :param scale: The scale to initially search for the markers at (see find_markers)
+        :param pose_tracker: An optional PoseTracker to warm start and smooth the pose with
+        :param cache: An optional DetectionCache for the full image searches
+        """
+        self.marker_layout = marker_layout
+        self.scale = scale
+        self.pose_tracker = pose_tracker
+        self.cache = cache
+        self.full_search_interval = full_search_interval
+        self.padding = padding
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the last pose so the next frame searches the whole image
+        """
+        self.r_vec = None
+        self.t_vec = None
+        self.dim = None
+        self.frames_since_full_search = 0
+
+    def world_pos_from_image(self, image, camera_mtx, draw_img=None, timestamp=None, distortion=None):
+        """
+        Takes an image with aruco markers and returns the world location and position of the camera
+        :param image: The image to process
+        :param camera_mtx: The camera matrix
+        :param draw_img: An optional image to draw the markers on
+        :param timestamp: The time the image was captured in seconds, used by the pose tracker
+        :param distortion: The raw camera's (camera matrix, distortion coefficients) if the image is the raw image (see
+        world_pos_from_image)
+        :return: The same tuple as world_pos_from_image
+        """
+        dim = image.shape[1::-1]
+        if dim != self.dim:
+            self.reset()
+            self.dim = dim
+
+        if self.r_vec is not None and self.frames_since_full_search < self.full_search_interval:
+            self.frames_since_full_search += 1
+            if metrics.enabled:
+                start = time.perf_counter()
+            rois = predict_marker_rois(self.marker_layout, self.r_vec, self.t_vec, camera_mtx, dim, self.padding,
+                                       distortion=distortion)
+            bounding_boxes, ids = find_markers_in_rois(image, rois, self.scale)
+            if metrics.enabled:
+                metrics.add_time("detect_roi", time.perf_counter() - start)
+            stats = {} if metrics.enabled else None
+            result = _pose_from_markers(bounding_boxes, ids, self.marker_layout, camera_mtx, draw_img,
+                                        self.pose_tracker, timestamp, distortion, stats)
+            if result[0]:
+                if stats is not None:
+                    # Frames that lose the markers are recorded by the full search below instead, so every frame is
+                    # only recorded once
+                    _record_stats(stats)
+                    _record_frame(result, start)
+                self.r_vec, self.t_vec = result[1], result[2]
+                return result
+
+        self.frames_since_full_search = 0
+        result = world_pos_from_image(image, self.marker_layout, camera_mtx, draw_img, self.scale,
+                                      self.pose_tracker, timestamp, self.cache, distortion)
+        self.r_vec, self.t_vec = result[1], result[2]
+        return result
+
+
+class PoseTracker:
+    """
+    Estimates the pose from a stream of images. The previous pose is used as the starting point for a few
+    Levenberg-Marquardt iterations instead of solving from scratch, and the result is smoothed with an alpha-beta
+    (constant velocity) filter on the translation and rotation to remove the frame to frame jitter.
+    """
+
+    def __init__(self, alpha=0.5, beta=0.1, refine_iterations=5, max_reprojection_error=2.0, max_jump=(10.0, 15.0),
+                 max_gap=0.5):
+        """
+        :param alpha: How much of the difference between the measured and predicted pose to apply (0-1, lower is
+        smoother but lags more)
+        :param beta: How much of the difference to apply to the velocity (0-1)
+        :param refine_iterations: The maximum number of LM iterations when starting from the previous pose
+        :param max_reprojection_error: The RMS reprojection error (pixels) above which the warm started solution is
+        thrown away and the pose is solved from scratch
+        :param max_jump: The (translation (cm), rotation (deg)) difference from the predicted pose above which the
+        filter is reset to the measurement instead of smoothing it
+        :param max_gap: The time in seconds without a pose after which the filter is reset
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.max_reprojection_error = max_reprojection_error
+        self.max_jump = max_jump
+        self.max_gap = max_gap
+        self.criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_COUNT, refine_iterations, 1e-6)
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the previous pose so the next one is solved from scratch
+        """
+        self.timestamp = None
+        self.translation = None
+        self.velocity = None
+        self.rotation = None
+        self.angular_velocity = None
+
+    def predict(self, timestamp):
+        """
+        Predicts the pose at a time using the constant velocity model
+        :param timestamp: The time in seconds
+        :return: The predicted translation (3,) and rotation matrix
+        """
+        dt = timestamp - self.timestamp
+        translation = self.translation + self.velocity * dt
+        rotation = cv.Rodrigues(self.angular_velocity * dt)[0] @ self.rotation
+        return translation, rotation
+
+    def update(self, world_points, image_points, camera_mtx, timestamp=None):
+        """
+        Finds the pose from matching world and image points and adds it to the filter
+        :param world_points: The Nx3 float32 array of marker corners in world coordinates
+        :param image_points: The Nx2 float32 array of the same corners in the (undistorted) image
+        :param camera_mtx: The camera matrix
+        :param timestamp: The time the image was captured in seconds (defaults to now)
+        :return: The filtered rotation and translation vectors
+        """
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        if self.timestamp is not None and not 0 < timestamp - self.timestamp <= self.max_gap:
+            self.reset()
+
+        r_vec = t_vec = None
+        if self.timestamp is not None:
+            translation, rotation = self.predict(timestamp)
+            r_vec = cv.Rodrigues(rotation)[0]
+            t_vec = translation.reshape(3, 1).copy()
+            cv.solvePnPRefineLM(world_points, image_points, camera_mtx, (0, 0, 0, 0), r_vec, t_vec, self.criteria)
+            projected, _ = cv.projectPoints(world_points, r_vec, t_vec, camera_mtx, (0, 0, 0, 0))
+            error = np.sqrt(np.mean(np.sum((projected.reshape(-1, 2) - image_points) ** 2, axis=1)))
+            if not error <= self.max_reprojection_error:
+                r_vec = t_vec = None
+        if r_vec is None:
+            r_vec, t_vec = solve_pose(world_points, image_points, camera_mtx)
+
+        measured_translation = t_vec.reshape(3)
+        measured_rotation = cv.Rodrigues(r_vec)[0]
+        if self.timestamp is None:
+            self._set(timestamp, measured_translation, measured_rotation)
+        else:
+            dt = timestamp - self.timestamp
+            translation, rotation = self.predict(timestamp)
+            translation_residual = measured_translation - translation
+            rotation_residual = cv.Rodrigues(measured_rotation @ rotation.T)[0].reshape(3)
+            if (np.linalg.norm(translation_residual) > self.max_jump[0] or
+                    np.rad2deg(np.linalg.norm(rotation_residual)) > self.max_jump[1]):
+                # A real jump (or a flip to the other planar solution) shouldn't be smoothed over
+                self._set(timestamp, measured_translation, measured_rotation)
+            else:
+                self.timestamp = timestamp
+                self.translation = translation + self.alpha * translation_residual
+                self.velocity = self.velocity + self.beta * translation_residual / dt
+                self.rotation = cv.Rodrigues(self.alpha * rotation_residual)[0] @ rotation
+                self.angular_velocity = self.angular_velocity + self.beta * rotation_residual / dt
+
+        return cv.Rodrigues(self.rotation)[0], self.translation.reshape(3, 1).copy()
+
+    def _set(self, timestamp, translation, rotation):
+        self.timestamp = timestamp
+        self.translation = translation
+        self.velocity = np.zeros(3)
+        self.rotation = rotation
+        self.angular_velocity = np.zeros(3)
+
+
+def check_alignment(terror, euler, pos_tolerance=0.5, rot_tolerance=5):
+    """
+    Checks if the camera is aligned with the target position
+    :param terror: The translation error (target position - translation vector) as a 3x1 vector (cm)
+    :param euler: The zyx euler angles of the rotation (deg)
+    :param pos_tolerance: The maximum position error to be considered locked (cm)
+    :param rot_tolerance: The maximum rotation error to be considered locked (deg)
+    :return: A tuple of booleans for xy position, z position, xy rotation and z rotation being locked
+    """
+    xyPosLocked = bool(np.linalg.norm(terror[0:2]) < pos_tolerance)
+    zPosLocked = bool(abs(terror[2, 0]) < pos_tolerance)
+    xyRotLocked = bool(np.linalg.norm(euler[1:]) < rot_tolerance)
+    zRotLocked = bool(abs(euler[0]) < rot_tolerance)
+    return xyPosLocked, zPosLocked, xyRotLocked, zRotLocked
+
+
+def _skew(v):
+    """
+    Makes the cross product matrix of a vector
+    :param v: The vector (3,)
+    :return: The 3x3 matrix such that _skew(v) @ u == np.cross(v, u)
+    """
+    return np.array([[0, -v[2], v[1]], [v[2], 0, -v[0]], [-v[1], v[0], 0]])
+
+
+def pose_covariance(world_points, image_points, r_vec, t_vec, camera_mtx, min_sigma=0.1):
+    """
+    Estimates the covariance of a pose from the jacobian of the reprojection, sigma^2 * (J^T J)^-1, with sigma
+    estimated from the reprojection residuals
+    :param world_points: The Nx3 world points the pose was found from
+    :param image_points: The matching Nx2 image points
+    :param r_vec: The rotation vector
+    :param t_vec: The translation vector
+    :param camera_mtx: The camera matrix of the undistorted image
+    :param min_sigma: The smallest image point noise (px) to assume, so a perfect fit isn't treated as exact
+    :return: The 6x6 covariance of a small rotation (applied on the left, rad) and the translation (cm)
+    """
+    projected, jacobian = cv.projectPoints(world_points, r_vec, t_vec, camera_mtx, None)
+    residuals = projected.reshape(-1, 2) - image_points
+    dof = max(residuals.size - 6, 1)
+    sigma2 = max(float(np.sum(residuals ** 2)) / dof, min_sigma ** 2)
+    jacobian = jacobian[:, :6]
+    covariance = sigma2 * np.linalg.pinv(jacobian.T @ jacobian)
+
+    # The jacobian is with respect to the rotation vector, convert it to a rotation applied on the left of the
+    # rotation matrix (the left jacobian of SO(3)) so poses from different cameras can be compared
+    r_vec = np.reshape(r_vec, 3)
+    theta = np.linalg.norm(r_vec)
+    left = np.eye(3)
+    if theta > 1e-9:
+        k = _skew(r_vec)
+        left += (1 - np.cos(theta)) / theta ** 2 * k + (theta - np.sin(theta)) / theta ** 3 * (k @ k)
+    to_left = np.eye(6)
+    to_left[:3, :3] = left
+    return to_left @ covariance @ to_left.T
+
+
+def transform_pose(r_vec, t_vec, covariance, extrinsic_r_vec, extrinsic_t_vec):
+    """
+    Moves a pose from a camera's coordinates into the rig's coordinates
+    :param r_vec: The rotation vector of the markers in camera coordinates
+    :param t_vec: The translation vector of the markers in camera coordinates
+    :param covariance: The 6x6 covariance from pose_covariance (None to skip it)
+    :param extrinsic_r_vec: The rotation of the camera in the rig (rig = R @ camera + t)
+    :param extrinsic_t_vec: The position of the camera in the rig (cm)
+    :return: The rotation vector, translation vector and covariance of the markers in rig coordinates
+    """
+    extrinsic_rot_m, _ = cv.Rodrigues(np.asarray(extrinsic_r_vec, dtype=np.float64).reshape(3, 1))
+    rot_m, _ = cv.Rodrigues(np.asarray(r_vec, dtype=np.float64).reshape(3, 1))
+    r_vec, _ = cv.Rodrigues(extrinsic_rot_m @ rot_m)
+    t_vec = extrinsic_rot_m @ np.reshape(t_vec, (3, 1)) + np.reshape(extrinsic_t_vec, (3, 1))
+    if covariance is not None:
+        rotate = np.zeros((6, 6))
+        rotate[:3, :3] = rotate[3:, 3:] = extrinsic_rot_m
+        covariance = rotate @ covariance @ rotate.T
+    return r_vec, t_vec, covariance
+
+
+def fuse_poses(poses):
+    """
+    Fuses several estimates of the same pose (e.g. from different cameras, in the same coordinates) by weighting each
+    with the inverse of its covariance. The rotations are fused as small rotations from the most certain estimate.
+    :param poses: A list of (rotation vector, translation vector, covariance) tuples, see pose_covariance
+    :return: The fused rotation vector, translation vector and covariance
+    """
+    reference = min(range(len(poses)), key=lambda i: np.trace(poses[i][2]))
+    ref_rot_m, _ = cv.Rodrigues(np.reshape(poses[reference][0], (3, 1)).astype(np.float64))
+
+    information = np.zeros((6, 6))
+    weighted = np.zeros(6)
+    for r_vec, t_vec, covariance in poses:
+        rot_m, _ = cv.Rodrigues(np.reshape(r_vec, (3, 1)).astype(np.float64))
+        delta, _ = cv.Rodrigues(rot_m @ ref_rot_m.T)
+        pose_information = np.linalg.pinv(covariance)
+        information += pose_information
+        weighted += pose_information @ np.concatenate((delta.reshape(3), np.reshape(t_vec, 3)))
+
+    covariance = np.linalg.pinv(information)
+    fused = covariance @ weighted
+    rot_m, _ = cv.Rodrigues(fused[:3].reshape(3, 1))
+    r_vec, _ = cv.Rodrigues(rot_m @ ref_rot_m)
+    return r_vec, fused[3:].reshape(3, 1), covariance
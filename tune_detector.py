@@ -0,0 +1,219 @@
+import argparse
+import glob
+import itertools
+import json
+import multiprocessing
+import os.path
+import random
+import time
+
+import cv2 as cv
+import cv2.aruco as aruco
+import numpy as np
+
+from tracking_util import aruco_dict, aruco_param, detector_params_to_dict, detector_params_from_dict
+
+# The values swept by default, around the hand tuned settings in tracking_util
+DEFAULT_GRID = {
+    "adaptiveThreshWinSizeMin": [3, 8, 16],
+    "adaptiveThreshWinSizeMax": [23, 53, 100],
+    "adaptiveThreshWinSizeStep": [10, 20, 40],
+    "adaptiveThreshConstant": [5, 7, 12],
+    "perspectiveRemovePixelPerCell": [4, 8, 15],
+    "perspectiveRemoveIgnoredMarginPerCell": [0.13, 0.2],
+    "minMarkerPerimeterRate": [0.03, 0.05],
+}
+
+# The greyscale images each worker process evaluates the parameters on
+_images = None
+
+
+def param_sets(grid, samples=0, seed=0):
+    """
+    Lists the combinations of parameter values to try
+    :param grid: A dictionary of parameter name to the list of values to try
+    :param samples: If more than 0 only this many randomly chosen combinations are returned
+    :param seed: The random seed used to choose the combinations
+    :return: A list of dictionaries of parameter name to value
+    """
+    names = sorted(grid)
+    sets = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        values = dict(zip(names, values))
+        # OpenCV rejects a window range that ends before it starts
+        win_min = values.get("adaptiveThreshWinSizeMin", aruco_param.adaptiveThreshWinSizeMin)
+        win_max = values.get("adaptiveThreshWinSizeMax", aruco_param.adaptiveThreshWinSizeMax)
+        if win_max >= win_min:
+            sets.append(values)
+    if 0 < samples < len(sets):
+        sets = random.Random(seed).sample(sets, samples)
+    return sets
+
+
+def evaluate(values, images, valid_ids, repeat=3):
+    """
+    Measures how well and how fast a set of parameters detects the markers
+    :param values: A dictionary of parameter name to value, applied on top of tracking_util's aruco_param
+    :param images: A list of greyscale images that every valid id is visible in
+    :param valid_ids: The ids that should be found in every image
+    :param repeat: The number of times to detect each image, the fastest time is kept
+    :return: A dictionary with the values, the fraction of the valid ids found, the number of invalid ids found and the
+    per frame latency statistics in milliseconds
+    """
+    params = detector_params_from_dict(values, aruco_param)
+    valid_ids = set(valid_ids)
+    found = 0
+    false_ids = 0
+    times = []
+    for image in images:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            _, ids, _ = aruco.detectMarkers(image, aruco_dict, parameters=params)
+            best = min(best, time.perf_counter() - start)
+        times.append(best * 1000)
+        ids = set() if ids is None else set(ids.reshape(-1).tolist())
+        found += len(ids & valid_ids)
+        false_ids += len(ids - valid_ids)
+    times = np.array(times)
+    return {
+        "values": values,
+        "detection_rate": found / (len(images) * len(valid_ids)) if images and valid_ids else 0.0,
+        "false_ids": false_ids,
+        "mean_ms": float(times.mean()),
+        "p95_ms": float(np.percentile(times, 95)),
+    }
+
+
+def pareto_front(results):
+    """
+    Finds the results that no other result beats on both detection rate and latency. Results that found invalid ids
+    are left out.
+    :param results: A list of dictionaries from evaluate
+    :return: The front sorted from fastest to slowest (so also from lowest to highest detection rate)
+    """
+    front = []
+    for result in sorted(results, key=lambda r: (r["mean_ms"], -r["detection_rate"])):
+        if result["false_ids"] == 0 and (not front or result["detection_rate"] > front[-1]["detection_rate"]):
+            front.append(result)
+    return front
+
+
+def choose(front, min_rate=1.0):
+    """
+    Picks the fastest result on the front that detects enough of the markers
+    :param front: The front from pareto_front
+    :param min_rate: The minimum detection rate
+    :return: The chosen result, or the one with the highest detection rate if none are good enough (None if the front
+    is empty)
+    """
+    for result in front:
+        if result["detection_rate"] >= min_rate:
+            return result
+    return front[-1] if front else None
+
+
+def load_images(paths, warn=True):
+    """
+    Loads the images to tune the detector on
+    :param paths: The paths of the images
+    :param warn: If true a warning is printed for each image that couldn't be read
+    :return: A list of the greyscale images and a list of the paths they were read from (images that couldn't be read
+    are skipped)
+    """
+    images = []
+    read_paths = []
+    for path in paths:
+        image = cv.imread(path, cv.IMREAD_COLOR)
+        if image is None:
+            if warn:
+                print(f"Skipping {path}, it couldn't be read as an image")
+            continue
+        images.append(cv.cvtColor(image, cv.COLOR_BGR2GRAY))
+        read_paths.append(path)
+    return images, read_paths
+
+
+def _init_worker(paths):
+    global _images
+    # Every worker times its own detections, so OpenCV's threads would only compete with the other workers
+    cv.setNumThreads(1)
+    _images, _ = load_images(paths, warn=False)
+
+
+def _evaluate(values, valid_ids, repeat):
+    return evaluate(values, _images, valid_ids, repeat)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--src", type=str, required=True, help="The folder of images to tune the detector on")
+    parser.add_argument("--ids", type=int, nargs="+", required=True, help="The ids that are visible in every image")
+    parser.add_argument("--grid", type=str,
+                        help="A json file of parameter name to the list of values to try (defaults to a grid around "
+                             "the current settings)")
+    parser.add_argument("--samples", type=int, default=0,
+                        help="Only try this many randomly chosen combinations from the grid (0 tries them all)")
+    parser.add_argument("--seed", type=int, default=0, help="The random seed used to choose the combinations")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="The number of times to detect each image, the fastest time is kept")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="The number of processes to spread the combinations across (0 uses every core)")
+    parser.add_argument("--min-rate", type=float, default=1.0,
+                        help="The detection rate the chosen parameters must reach")
+    parser.add_argument("-o", "--output", type=str, default="detector_params.json",
+                        help="The json file to save the chosen parameters to")
+
+    args = parser.parse_args()
+
+    paths = glob.glob(os.path.join(args.src, "*.jpg"))
+    paths += glob.glob(os.path.join(args.src, "*.png"))
+    paths.sort()
+    # Check every image can be read before starting, so the workers are only given the good ones
+    paths = load_images(paths)[1]
+    if not paths:
+        raise SystemExit(f"No images found in {args.src}")
+
+    grid = DEFAULT_GRID
+    if args.grid:
+        with open(args.grid) as f:
+            grid = json.load(f)
+    current = detector_params_to_dict(aruco_param)
+    # The current settings are always tried, so there is something to compare with
+    sets = [{name: current[name] for name in grid}] + param_sets(grid, args.samples, args.seed)
+
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    print(f"Trying {len(sets)} parameter sets on {len(paths)} images with {workers} workers")
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(paths,)) as pool:
+        results = pool.starmap(_evaluate, [(values, args.ids, args.repeat) for values in sets], chunksize=1)
+    print(f"Done in {time.perf_counter() - start:.1f}s, latencies are single threaded")
+
+    baseline = results[0]
+    front = pareto_front(results)
+    print(f"{'rate':>8}{'mean ms':>10}{'p95 ms':>10}  parameters")
+    for result in front:
+        print(f"{result['detection_rate']:>8.3f}{result['mean_ms']:>10.2f}{result['p95_ms']:>10.2f}  "
+              f"{json.dumps(result['values'])}")
+    print(f"current settings: rate {baseline['detection_rate']:.3f}, {baseline['mean_ms']:.2f} ms, "
+          f"{baseline['false_ids']} invalid ids")
+
+    chosen = choose(front, args.min_rate)
+    if chosen is None:
+        raise SystemExit("Every parameter set found invalid ids")
+    if chosen["detection_rate"] < args.min_rate:
+        print(f"No parameter set reached a detection rate of {args.min_rate}, saving the best one")
+    print(f"chosen: rate {chosen['detection_rate']:.3f}, {chosen['mean_ms']:.2f} ms")
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "parameters": detector_params_to_dict(detector_params_from_dict(chosen["values"], aruco_param)),
+            "detection_rate": chosen["detection_rate"],
+            "mean_ms": chosen["mean_ms"],
+            "p95_ms": chosen["p95_ms"],
+            "src": os.path.abspath(args.src),
+            "ids": args.ids,
+            "opencv": cv.__version__,
+            "front": front,
+        }, f, indent=2)
+    print(f"Saved the parameters to {args.output}")